@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""Benchmark measuring how long it takes to import schnibble modules."""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import subprocess
+import sys
+
+# Each sample runs in a fresh interpreter so nothing is imported yet.
+# The baseline is subtracted to discount interpreter startup.
+TEMPLATE = """
+import time
+start = time.time()
+{}
+print(time.time() - start)
+"""
+
+
+def sample(statement):
+    output = subprocess.check_output(
+        [sys.executable, '-c', TEMPLATE.format(statement)])
+    return float(output)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-n', '--repeat', metavar='N', type=int, default=20,
+        help="number of samples of each module")
+    parser.add_argument(
+        'modules', metavar='MODULE', nargs='*',
+        default=['schnibble', 'schnibble.common', 'schnibble.cpy27',
+                 'schnibble.binfmt.elf', 'schnibble.arch.x86.instructions'])
+    ns = parser.parse_args()
+    baseline = min(sample('pass') for _ in range(ns.repeat))
+    for module in ns.modules:
+        samples = sorted(
+            sample('import ' + module) for _ in range(ns.repeat))
+        print("{:40} min {:7.2f} ms  median {:7.2f} ms".format(
+            module, (samples[0] - baseline) * 1000,
+            (samples[len(samples) // 2] - baseline) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,18 +11,15 @@ import sys
 from ctypes import sizeof
 
 from schnibble.binfmt import pe
+from schnibble.arch.x86.assembler import assemble
 from schnibble.arch.x86.instructions import ADD, MOV, RET
 from schnibble.arch.x86.operands import imm32
+from schnibble.arch.x86.regalloc import allocate, vreg
 from schnibble.arch.x86.registers import EAX
 
 
 def emit_code(*asm):
-    buf = bytearray()
-    for line in asm:
-        inst = line[0]
-        args = line[1:]
-        inst.emit(buf, *args)
-    return buf
+    return assemble(allocate(asm).lines)
 
 
 def main():
@@ -46,9 +43,11 @@ def main():
     nt_headers.OptionalHeader.SizeOfHeaders = 0x140
     nt_headers.OptionalHeader.Subsystem = pe.IMAGE_SUBSYSTEM_WINDOWS_CUI
 
+    value = vreg(32)
     code = emit_code(
-        (MOV, EAX, imm32(42)),
-        (ADD, EAX, 1),
+        (MOV, value, imm32(42)),
+        (ADD, value, imm32(1)),
+        (MOV, EAX, value),
         (RET,),
     )
     with ns.output as stream:
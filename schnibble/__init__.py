@@ -1 +1,4 @@
 """Schnibble is a Python bytecode toolkit."""
+from schnibble import _lazy
+
+_lazy.install(__name__, ('arch', 'binfmt'))
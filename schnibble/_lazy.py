@@ -0,0 +1,37 @@
+"""Lazy loading of subpackages and submodules."""
+import importlib
+import sys
+import types
+
+
+class LazyPackage(types.ModuleType):
+    """Package that imports selected submodules on first attribute access."""
+
+    _lazy_submodules = frozenset()
+
+    def __getattr__(self, name):
+        """Import a lazy submodule, called only for missing attributes."""
+        if name in self._lazy_submodules:
+            return importlib.import_module('{}.{}'.format(self.__name__, name))
+        raise AttributeError("module {!r} has no attribute {!r}".format(
+            self.__name__, name))
+
+
+def install(name, submodules):
+    """
+    Make the submodules of a package load lazily.
+
+    :param name:
+        Name of the package, call this with ``__name__`` from the
+        ``__init__`` module of the package.
+    :param submodules:
+        Names of submodules that are imported on first access.
+
+    Python 2 has no module-level ``__getattr__`` so the package module in
+    ``sys.modules`` is replaced with an equivalent :class:`LazyPackage`.
+    """
+    module = sys.modules[name]
+    lazy = LazyPackage(name, module.__doc__)
+    lazy.__dict__.update(module.__dict__)
+    lazy._lazy_submodules = frozenset(submodules)
+    sys.modules[name] = lazy
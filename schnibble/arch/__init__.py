@@ -0,0 +1,4 @@
+"""Machine architectures."""
+from schnibble import _lazy
+
+_lazy.install(__name__, ('msp430', 'x86'))
@@ -0,0 +1,322 @@
+# coding: utf-8
+"""
+Batch assembler.
+
+An :class:`Assembler` collects instructions, resolving the encoding of each
+one and computing its size as it is added. :meth:`Assembler.assemble()` then
+allocates the code buffer once, with the exact total size, and writes every
+instruction in place with slice assignment and :meth:`struct.Struct.pack_into`.
+No intermediate buffer is created for any instruction.
+
+Branches may target a :class:`Label` instead of a displacement. They start
+with the short (``rel8``) encoding and :meth:`Assembler.relax()` widens the
+ones whose target is out of reach to ``rel32``. Widening a branch only moves
+code by a few bytes, so only short branches within 128 bytes of it are
+checked again. Each branch is widened at most once and the pass takes time
+linear in the size of the code.
+"""
+
+from __future__ import absolute_import, print_function
+
+import collections
+
+from schnibble import trace
+
+from .operands import rel8, rel32
+
+__all__ = ('Label', 'Layout', 'Assembler', 'assemble')
+
+#: Final layout of assembled code.
+#:
+#: ``size`` is the size of the code, ``offsets`` has the offset of each line
+#: (instructions and labels), ``labels`` maps labels to their offsets,
+#: ``short`` and ``long`` are the numbers of branches to labels with 8-bit
+#: and 32-bit displacements.
+Layout = collections.namedtuple('Layout', 'size offsets labels short long')
+
+# Displacements of short branches are measured from the end of the branch
+_SHORT_FORWARD = 127
+_SHORT_BACKWARD = 128
+
+
+class Label(object):
+    """Position in assembled code, the target of branches."""
+
+    def __init__(self, name=None):
+        """
+        Initialize a label.
+
+        :param name:
+            Name of the label, only used in representations.
+        """
+        self.name = name
+
+    def __repr__(self):
+        if self.name is None:
+            return "Label()"
+        return "Label({!r})".format(self.name)
+
+
+class _Branch(object):
+    """Branch to a label, with its short and long encodings."""
+
+    __slots__ = ('label', 'short', 'long', 'wide')
+
+    def __init__(self, instruction, label):
+        self.label = label
+        self.short = None
+        try:
+            self.short = self._encoding(instruction, rel8(0))
+        except ValueError:
+            pass
+        self.long = self._encoding(instruction, rel32(0))
+        # True when the long encoding is used
+        self.wide = self.short is None
+
+    @staticmethod
+    def _encoding(instruction, operand):
+        form = instruction.find_form((operand,))
+        length, head = form.layout((operand,))
+        return length, head, form.imm_struct, form.imm_mask
+
+
+class Assembler(object):
+    """
+    Sequence of instructions assembled into one buffer.
+
+    :attribute size:
+        Size of the assembled code, in bytes. Branches to labels count as
+        short until :meth:`relax()` widens them.
+    """
+
+    def __init__(self, lines=()):
+        """
+        Initialize an assembler.
+
+        :param lines:
+            Iterable of instructions, see :meth:`extend()`.
+        """
+        self.size = 0
+        self._items = []
+        # Branches to labels and labels, by the index of their line
+        self._branches = {}
+        self._labels = {}
+        self._layout = None
+        self.extend(lines)
+
+    def __len__(self):
+        """Get the number of lines, instructions and labels."""
+        return len(self._items)
+
+    def append(self, instruction, *operands):
+        """
+        Add an instruction.
+
+        :param instruction:
+            An :class:`~schnibble.arch.x86.instructions.Instruction` class.
+        :param operands:
+            Operands of the instruction. A branch instruction may have
+            a :class:`Label` as its only operand.
+        :returns:
+            Index of the instruction, see :attr:`Layout.offsets`.
+        :raises ValueError:
+            If there is no encoding for the given operands.
+        """
+        index = len(self._items)
+        self.extend([(instruction,) + operands])
+        return index
+
+    def bind(self, label):
+        """
+        Place a label after the instructions added so far.
+
+        :returns:
+            Index of the label, see :attr:`Layout.offsets`.
+        :raises ValueError:
+            If the label is already bound.
+        """
+        if label in self._labels:
+            raise ValueError("label is already bound: {!r}".format(label))
+        index = len(self._items)
+        self._labels[label] = index
+        self._items.append((0, b'', None, 0))
+        self._layout = None
+        return index
+
+    def extend(self, lines):
+        """
+        Add instructions.
+
+        :param lines:
+            Iterable of tuples, each with an instruction class followed by
+            its operands, e.g. ``(MOV, EAX, imm32(42))`` or ``(JMP, label)``.
+            A :class:`Label` instead of a tuple is bound at that position.
+        """
+        items = self._items
+        size = self.size
+        self._layout = None
+        try:
+            for line in lines:
+                if isinstance(line, Label):
+                    self.bind(line)
+                    continue
+                operands = line[1:]
+                if len(operands) == 1 and isinstance(operands[0], Label):
+                    branch = _Branch(line[0], operands[0])
+                    self._branches[len(items)] = branch
+                    item = branch.long if branch.wide else branch.short
+                    items.append(item)
+                    size += item[0]
+                    continue
+                form = line[0].find_form(operands)
+                length, head = form.layout(operands)
+                if form.imm is None:
+                    items.append((length, head, None, 0))
+                else:
+                    items.append((length, head, form.imm_struct,
+                                  operands[form.imm].value & form.imm_mask))
+                size += length
+        finally:
+            self.size = size
+
+    def _fits(self, index, target):
+        """Check whether a branch reaches its target with a short form."""
+        items = self._items
+        distance = 0
+        if target > index:
+            for i in xrange(index + 1, target):
+                distance += items[i][0]
+                if distance > _SHORT_FORWARD:
+                    return False
+        else:
+            for i in xrange(target, index + 1):
+                distance += items[i][0]
+                if distance > _SHORT_BACKWARD:
+                    return False
+        return True
+
+    def relax(self):
+        """
+        Choose the encoding of branches to labels and compute the layout.
+
+        :returns:
+            A :class:`Layout`.
+        :raises ValueError:
+            If a branch targets a label that is not bound.
+        """
+        if self._layout is not None:
+            return self._layout
+        items = self._items
+        branches = self._branches
+        targets = {}
+        for index, branch in branches.iteritems():
+            try:
+                targets[index] = self._labels[branch.label]
+            except KeyError:
+                raise ValueError("label is not bound: {!r}".format(
+                    branch.label))
+        worklist = sorted(
+            (index for index, branch in branches.iteritems()
+             if not branch.wide), reverse=True)
+        queued = set(worklist)
+        while worklist:
+            index = worklist.pop()
+            queued.discard(index)
+            branch = branches[index]
+            if branch.wide or self._fits(index, targets[index]):
+                continue
+            branch.wide = True
+            items[index] = branch.long
+            self.size += branch.long[0] - branch.short[0]
+            # Short branches spanning the widened one may not fit anymore,
+            # they are all within reach of it.
+            distance = 0
+            i = index - 1
+            while i >= 0 and distance <= _SHORT_FORWARD:
+                if (i in branches and not branches[i].wide
+                        and targets[i] > index and i not in queued):
+                    worklist.append(i)
+                    queued.add(i)
+                distance += items[i][0]
+                i -= 1
+            distance = 0
+            i = index + 1
+            while i < len(items) and distance <= _SHORT_BACKWARD:
+                if (i in branches and not branches[i].wide
+                        and targets[i] <= index and i not in queued):
+                    worklist.append(i)
+                    queued.add(i)
+                distance += items[i][0]
+                i += 1
+        offsets = []
+        offset = 0
+        for item in items:
+            offsets.append(offset)
+            offset += item[0]
+        for index, branch in branches.iteritems():
+            length, head, imm_struct, mask = (
+                branch.long if branch.wide else branch.short)
+            displacement = offsets[targets[index]] - (offsets[index] + length)
+            items[index] = (length, head, imm_struct, displacement & mask)
+        wide = sum(1 for branch in branches.itervalues() if branch.wide)
+        self._layout = Layout(
+            self.size, offsets,
+            dict((label, offsets[index])
+                 for label, index in self._labels.iteritems()),
+            len(branches) - wide, wide)
+        return self._layout
+
+    def assemble_into(self, buf, offset=0):
+        """
+        Write the code into an existing buffer.
+
+        :param buf:
+            A bytearray with at least :attr:`size` bytes available at
+            ``offset``.
+        :param offset:
+            Position of the code in the buffer.
+        :returns:
+            Offset just past the code.
+        """
+        self.relax()
+        if len(buf) < offset + self.size:
+            raise ValueError("buffer is too small: {} < {}".format(
+                len(buf) - offset, self.size))
+        for length, head, imm_struct, value in self._items:
+            end = offset + len(head)
+            buf[offset:end] = head
+            if imm_struct is not None:
+                imm_struct.pack_into(buf, end, value)
+            offset += length
+        return offset
+
+    def assemble(self):
+        """
+        Assemble the code.
+
+        :returns:
+            A bytearray of exactly :attr:`size` bytes.
+        """
+        traced = trace.enabled
+        if traced:
+            token = trace.begin('x86.assemble', instructions=len(self))
+        self.relax()
+        buf = bytearray(self.size)
+        self.assemble_into(buf)
+        if traced:
+            trace.end('x86.assemble', token, instructions=len(self),
+                      size=self.size)
+        return buf
+
+
+def assemble(lines):
+    """
+    Assemble a sequence of instructions.
+
+    :param lines:
+        Iterable of tuples, each with an instruction class followed by its
+        operands, and labels.
+    :returns:
+        A bytearray with the code.
+    """
+    return Assembler(lines).assemble()
@@ -0,0 +1,620 @@
+# coding: utf-8
+"""
+x86-64 disassembler.
+
+The decoder walks a buffer (a string, bytearray, :class:`memoryview` or
+a :class:`mmap.mmap` of a code section) without copying it whole. Instruction
+lengths are computed from 256-entry tables of the one-byte and two-byte
+opcode maps, legacy prefixes, REX, VEX and EVEX prefixes and the ModRM and
+SIB decode tables of :mod:`schnibble.arch.x86.special`.
+
+:func:`iter_lengths()` only splits the buffer into instructions. It measures
+instructions without legacy prefixes from precomputed length tables and
+copies the buffer to a bytearray one window of 64 KiB at a time to index it
+faster, over a million instructions per second on typical code.
+:func:`disassemble()` also identifies instructions that have an encoding in
+:data:`schnibble.arch.x86.instructions.ENCODINGS` and decodes their operands
+into the same operand objects that are used for encoding them.
+"""
+
+from __future__ import absolute_import, print_function
+
+import collections
+import struct
+
+from .instructions import ENCODINGS, MNEMONICS
+from .operands import imm8, imm16, imm32, imm64, simm8, rel8, rel32, mem, reg
+from .registers import GPR, GPR8_REX, VECTOR
+from .special import MODRM, SIB
+
+__all__ = ('DecodeError', 'Decoded', 'iter_lengths', 'disassemble',
+           'format_instruction')
+
+#: Decoded instruction.
+#:
+#: ``offset`` and ``length`` locate the instruction in the buffer.
+#: ``mnemonic`` is the index of the instruction class in
+#: :data:`~schnibble.arch.x86.instructions.MNEMONICS`, zero if the
+#: instruction is not known. ``operands`` is a tuple of operand objects or
+#: None if they cannot be decoded.
+Decoded = collections.namedtuple("Decoded", "offset length mnemonic operands")
+
+
+class DecodeError(ValueError):
+    """Exception raised for invalid or truncated instructions."""
+
+
+# Properties of opcodes
+_MODRM = 0x1
+_IMM8 = 0x2
+_IMM16 = 0x4
+_IMMZ = 0x8  # 16 or 32 bits, depending on the operand size
+_IMMV = 0x10  # 16, 32 or 64 bits, depending on the operand size
+_MOFFS = 0x20  # 64-bit address, 32-bit with the address size prefix
+_GROUP3 = 0x40  # F6 and F7, TEST (/0 and /1) has an immediate
+_INVALID = 0x80
+_PREFIX = 0x100
+_REX = 0x200
+_ESCAPE = 0x400
+_VEX2 = 0x800
+_VEX3 = 0x1000
+_MAP38 = 0x2000
+_MAP3A = 0x4000
+_EVEX = 0x8000
+_IMMEDIATE = _IMM8 | _IMM16 | _IMMZ | _IMMV | _MOFFS
+
+# Opcode maps of legacy instructions
+MAP_ONE_BYTE, MAP_0F, MAP_0F38, MAP_0F3A = 1, 2, 3, 4
+# VEX and EVEX opcode maps are numbered from these, plus the map field of the
+# prefix: 1 for 0F, 2 for 0F38, 3 for 0F3A (and 5, 6 for EVEX)
+MAP_VEX = 4
+MAP_EVEX = 8
+
+# Bits of mandatory prefixes
+_P66, _PF2, _PF3 = 1, 2, 4
+_MANDATORY = {0x66: _P66, 0xF2: _PF2, 0xF3: _PF3}
+
+
+def _one_byte_map():
+    t = [0] * 256
+    for row in range(0x00, 0x40, 8):
+        for b in range(row, row + 4):
+            t[b] = _MODRM
+        t[row + 4] = _IMM8
+        t[row + 5] = _IMMZ
+        # PUSH/POP of segment registers, DAA, DAS, AAA and AAS
+        t[row + 6] = t[row + 7] = _INVALID
+    t[0x0F] = _ESCAPE
+    for b in (0x26, 0x2E, 0x36, 0x3E, 0x64, 0x65, 0x66, 0x67, 0xF0, 0xF2,
+              0xF3):
+        t[b] = _PREFIX
+    for b in range(0x40, 0x50):
+        t[b] = _REX
+    t[0x60] = t[0x61] = _INVALID
+    t[0x62] = _EVEX
+    t[0x63] = _MODRM
+    t[0x68] = _IMMZ
+    t[0x69] = _MODRM | _IMMZ
+    t[0x6A] = _IMM8
+    t[0x6B] = _MODRM | _IMM8
+    for b in range(0x70, 0x80):
+        t[b] = _IMM8
+    t[0x80] = t[0x83] = _MODRM | _IMM8
+    t[0x81] = _MODRM | _IMMZ
+    t[0x82] = _INVALID
+    for b in range(0x84, 0x90):
+        t[b] = _MODRM
+    t[0x9A] = _INVALID
+    for b in range(0xA0, 0xA4):
+        t[b] = _MOFFS
+    t[0xA8] = _IMM8
+    t[0xA9] = _IMMZ
+    for b in range(0xB0, 0xB8):
+        t[b] = _IMM8
+    for b in range(0xB8, 0xC0):
+        t[b] = _IMMV
+    t[0xC0] = t[0xC1] = t[0xC6] = _MODRM | _IMM8
+    t[0xC2] = t[0xCA] = _IMM16
+    t[0xC4] = _VEX3
+    t[0xC5] = _VEX2
+    t[0xC7] = _MODRM | _IMMZ
+    t[0xC8] = _IMM16 | _IMM8
+    t[0xCD] = _IMM8
+    t[0xCE] = _INVALID
+    for b in range(0xD0, 0xD4):
+        t[b] = _MODRM
+    t[0xD4] = t[0xD5] = t[0xD6] = _INVALID
+    for b in range(0xD8, 0xE0):
+        t[b] = _MODRM
+    for b in range(0xE0, 0xE8):
+        t[b] = _IMM8
+    t[0xE8] = t[0xE9] = _IMMZ
+    t[0xEA] = _INVALID
+    t[0xEB] = _IMM8
+    t[0xF6] = t[0xF7] = _MODRM | _GROUP3
+    t[0xFE] = t[0xFF] = _MODRM
+    return tuple(t)
+
+
+def _two_byte_map():
+    t = [_MODRM] * 256
+    for b in (0x04, 0x0A, 0x0C, 0x24, 0x25, 0x26, 0x27, 0x36, 0x39, 0x3B,
+              0x3C, 0x3D, 0x3E, 0x3F, 0xA6, 0xA7):
+        t[b] = _INVALID
+    for b in (0x05, 0x06, 0x07, 0x08, 0x09, 0x0B, 0x0E, 0x30, 0x31, 0x32,
+              0x33, 0x34, 0x35, 0x37, 0x77, 0xA0, 0xA1, 0xA2, 0xA8, 0xA9,
+              0xAA):
+        t[b] = 0
+    for b in range(0xC8, 0xD0):
+        t[b] = 0
+    for b in (0x0F, 0x70, 0x71, 0x72, 0x73, 0xA4, 0xAC, 0xBA, 0xC2, 0xC4,
+              0xC5, 0xC6):
+        t[b] = _MODRM | _IMM8
+    for b in range(0x80, 0x90):
+        t[b] = _IMMZ
+    t[0x38] = _MAP38
+    t[0x3A] = _MAP3A
+    return tuple(t)
+
+
+_ONE_BYTE = _one_byte_map()
+_TWO_BYTE = _two_byte_map()
+
+# Properties of opcodes in VEX and EVEX maps, which all have a ModRM byte
+# except VZEROUPPER and VZEROALL
+_VEX_MAPS = {
+    1: lambda opcode: (0 if opcode == 0x77
+                       else _MODRM | (_TWO_BYTE[opcode] & _IMM8)),
+    2: lambda opcode: _MODRM,
+    3: lambda opcode: _MODRM | _IMM8,
+    5: lambda opcode: _MODRM,
+    6: lambda opcode: _MODRM,
+}
+
+_MAX_LENGTH = 15
+
+
+def _length_table(flags_map, rex_w):
+    """
+    Precompute the lengths of opcodes without legacy prefixes.
+
+    :returns:
+        Tuple of 256 entries, ``(modrm, imm_size)`` for opcodes whose length
+        only depends on the ModRM and SIB bytes, None for the ones that need
+        :func:`_scan()`.
+    """
+    table = []
+    for flags in flags_map:
+        if flags & (_INVALID | _PREFIX | _REX | _ESCAPE | _VEX2 | _VEX3 |
+                    _EVEX | _MAP38 | _MAP3A | _GROUP3 | _MOFFS):
+            table.append(None)
+            continue
+        imm_size = 0
+        if flags & _IMM8:
+            imm_size += 1
+        if flags & _IMM16:
+            imm_size += 2
+        if flags & _IMMZ:
+            imm_size += 4
+        if flags & _IMMV:
+            imm_size += 8 if rex_w else 4
+        table.append((flags & _MODRM, imm_size))
+    return tuple(table)
+
+
+_LENGTHS = _length_table(_ONE_BYTE, False)
+_LENGTHS_W = _length_table(_ONE_BYTE, True)
+_LENGTHS_0F = _length_table(_TWO_BYTE, False)
+
+# Bytes following each ModRM byte, -1 when it depends on the SIB byte
+_MODRM_LENGTHS = tuple(
+    -1 if entry.sib and entry.mod == 0 else entry.sib + entry.disp_size + 1
+    for entry in MODRM)
+
+# Size of the pieces of a buffer which are copied for scanning lengths
+_WINDOW = 1 << 16
+
+
+def _scan(data, pos, end):
+    """
+    Scan one instruction.
+
+    :returns:
+        Tuple ``(length, opmap, opcode, modrm_pos, imm_pos, imm_size, rex,
+        mandatory, addr32, vex)``. ``modrm_pos`` is None when there is no
+        ModRM byte. ``mandatory`` has bits of the 66, F2 and F3 prefixes.
+        ``vex`` is None without a VEX or EVEX prefix, otherwise a tuple
+        ``(L, vvvv)`` of the vector length and the extra register.
+    """
+    start = pos
+    limit = min(end, start + _MAX_LENGTH)
+    opsize16 = addr32 = False
+    rex = mandatory = 0
+    vex = None
+    try:
+        while True:
+            if pos >= limit:
+                raise DecodeError("truncated instruction at {:#x}".format(
+                    start))
+            opcode = ord(data[pos])
+            pos += 1
+            flags = _ONE_BYTE[opcode]
+            if flags & _PREFIX:
+                if opcode == 0x66:
+                    opsize16 = True
+                elif opcode == 0x67:
+                    addr32 = True
+                mandatory |= _MANDATORY.get(opcode, 0)
+                # REX is ignored unless it immediately precedes the opcode
+                rex = 0
+            elif flags & _REX:
+                rex = opcode
+            else:
+                break
+        opmap = MAP_ONE_BYTE
+        if flags & _ESCAPE:
+            opcode = ord(data[pos])
+            pos += 1
+            flags = _TWO_BYTE[opcode]
+            opmap = MAP_0F
+            if flags & (_MAP38 | _MAP3A):
+                if flags & _MAP38:
+                    opmap, flags = MAP_0F38, _MODRM
+                else:
+                    opmap, flags = MAP_0F3A, _MODRM | _IMM8
+                opcode = ord(data[pos])
+                pos += 1
+        elif flags & (_VEX2 | _VEX3 | _EVEX):
+            byte1 = ord(data[pos])
+            if flags & _VEX2:
+                pos += 1
+                # R is stored inverted
+                rex = 0x40 | ((~byte1 >> 5) & 4)
+                field = 1
+                opmap = MAP_VEX + field
+                pp = byte1 & 3
+                vex = (byte1 >> 2) & 1, (~byte1 >> 3) & 0xF
+            else:
+                byte2 = ord(data[pos + 1])
+                # R, X and B are stored inverted
+                rex = 0x40 | ((byte2 >> 4) & 8) | ((~byte1 >> 5) & 7)
+                pp = byte2 & 3
+                if flags & _VEX3:
+                    pos += 2
+                    field = byte1 & 0x1F
+                    if field > 3:
+                        raise DecodeError(
+                            "invalid VEX map at {:#x}".format(start))
+                    opmap = MAP_VEX + field
+                    vex = (byte2 >> 2) & 1, (~byte2 >> 3) & 0xF
+                else:
+                    pos += 3
+                    field = byte1 & 7
+                    opmap = MAP_EVEX + field
+                    # L'L is in the last byte of the prefix, V' is ignored
+                    vex = ((ord(data[pos - 1]) >> 5) & 3,
+                           (~byte2 >> 3) & 0xF)
+            mandatory = (0, _P66, _PF3, _PF2)[pp]
+            opcode = ord(data[pos])
+            pos += 1
+            try:
+                flags = _VEX_MAPS[field](opcode)
+            except KeyError:
+                raise DecodeError("invalid VEX map at {:#x}".format(start))
+        if flags & _INVALID:
+            raise DecodeError("invalid opcode at {:#x}".format(start))
+        modrm_pos = None
+        if flags & _MODRM:
+            modrm_pos = pos
+            modrm = ord(data[pos])
+            pos += 1
+            entry = MODRM[modrm]
+            if entry.sib:
+                if entry.mod == 0 and ord(data[pos]) & 7 == 5:
+                    pos += 4
+                pos += 1
+            pos += entry.disp_size
+            if flags & _GROUP3 and not modrm & 0x30:
+                flags |= _IMM8 if opcode == 0xF6 else _IMMZ
+        imm_pos = pos
+        if flags & _IMMEDIATE:
+            if flags & _IMM8:
+                pos += 1
+            if flags & _IMM16:
+                pos += 2
+            if flags & _IMMZ:
+                pos += 2 if opsize16 else 4
+            if flags & _IMMV:
+                pos += 8 if rex & 8 else 2 if opsize16 else 4
+            if flags & _MOFFS:
+                pos += 4 if addr32 else 8
+    except IndexError:
+        raise DecodeError("truncated instruction at {:#x}".format(start))
+    if pos > limit:
+        raise DecodeError("truncated instruction at {:#x}".format(start))
+    return (pos - start, opmap, opcode, modrm_pos, imm_pos, pos - imm_pos,
+            rex, mandatory, addr32, vex)
+
+
+def _view(data):
+    if isinstance(data, bytearray):
+        # Index a view of a bytearray to get characters, like other buffers
+        return memoryview(data)
+    return data
+
+
+def iter_lengths(data, start=0, end=None, strict=True):
+    """
+    Split a buffer into instructions.
+
+    :param data:
+        Buffer with 64-bit code.
+    :param start:
+        Offset of the first instruction.
+    :param end:
+        Offset just past the last instruction, the end of ``data`` by
+        default.
+    :param strict:
+        If False, undecodable bytes are reported as instructions of length
+        one instead of raising :class:`DecodeError`.
+    :returns:
+        Generator of ``(offset, length)`` pairs.
+    """
+    data = _view(data)
+    if end is None:
+        end = len(data)
+    pos = start
+    scan = _scan
+    lengths, lengths_w, lengths_0f = _LENGTHS, _LENGTHS_W, _LENGTHS_0F
+    modrm_lengths = _MODRM_LENGTHS
+    while pos < end:
+        if end - pos <= _MAX_LENGTH:
+            try:
+                length = scan(data, pos, end)[0]
+            except DecodeError:
+                if strict:
+                    raise
+                length = 1
+            yield pos, length
+            pos += length
+            continue
+        # Common instructions are measured with the tables in a bytearray,
+        # which is indexed much faster than other buffers. Copying a window
+        # at a time keeps memory use bounded. The last bytes of the window
+        # are left for the next one so that instructions never cross it.
+        window = bytearray(data[pos:min(end, pos + _WINDOW)])
+        stop = len(window) - _MAX_LENGTH
+        i = 0
+        while i < stop:
+            j = i
+            opcode = window[j]
+            if 0x40 <= opcode < 0x50:
+                j += 1
+                entry = (lengths_w if opcode & 8 else lengths)[window[j]]
+                opcode = window[j]
+            else:
+                entry = lengths[opcode]
+            if entry is None and opcode == 0x0F:
+                j += 1
+                entry = lengths_0f[window[j]]
+            if entry is None:
+                try:
+                    length = scan(data, pos + i, end)[0]
+                except DecodeError:
+                    if strict:
+                        raise
+                    length = 1
+            else:
+                j += 1
+                if entry[0]:
+                    extra = modrm_lengths[window[j]]
+                    if extra < 0:
+                        # No base register, a 32-bit displacement follows
+                        extra = 6 if window[j + 1] & 7 == 5 else 2
+                    j += extra
+                length = j + entry[1] - i
+            yield pos + i, length
+            i += length
+        pos += i
+
+
+class _Tables(object):
+    """Decoding tables derived from the encoding table."""
+
+    def __init__(self):
+        self.size = len(ENCODINGS)
+        self.forms = {}
+        ids = dict((cls.__name__, cls.mnemonic_id) for cls in MNEMONICS[1:])
+        seen = set()
+        for form in ENCODINGS.values():
+            if id(form) in seen:
+                continue
+            seen.add(id(form))
+            opcode = list(form.opcode)
+            if opcode[:2] == [0x0F, 0x38]:
+                opmap, opcode = MAP_0F38, opcode[2:]
+            elif opcode[:2] == [0x0F, 0x3A]:
+                opmap, opcode = MAP_0F3A, opcode[2:]
+            elif opcode[:1] == [0x0F]:
+                opmap, opcode = MAP_0F, opcode[1:]
+            else:
+                opmap = MAP_ONE_BYTE
+            if form.vex is not None:
+                # 0F, 0F38 and 0F3A are the VEX maps 1, 2 and 3
+                opmap += MAP_VEX + 1 - MAP_0F
+            mandatory = 0
+            for prefix in form.prefix:
+                mandatory |= _MANDATORY.get(prefix, 0)
+            codes = [opcode[0]]
+            if form.plus_r is not None:
+                codes = range(opcode[0], opcode[0] + 8)
+            for code in codes:
+                self.forms.setdefault((opmap, code), []).append(
+                    (mandatory, form, ids[form.mnemonic]))
+
+
+_tables = None
+
+
+def _get_tables():
+    global _tables
+    if _tables is None or _tables.size != len(ENCODINGS):
+        _tables = _Tables()
+    return _tables
+
+
+_IMMEDIATES = {
+    'imm8': (imm8, struct.Struct('<B')),
+    'imm16': (imm16, struct.Struct('<H')),
+    'imm32': (imm32, struct.Struct('<I')),
+    'imm64': (imm64, struct.Struct('<Q')),
+    'simm8': (simm8, struct.Struct('<b')),
+    'rel8': (rel8, struct.Struct('<b')),
+    'rel32': (rel32, struct.Struct('<i')),
+}
+_ACCUMULATORS = {'AL': 8, 'AX': 16, 'EAX': 32, 'RAX': 64}
+_DISP8 = struct.Struct('<b')
+_DISP32 = struct.Struct('<i')
+
+
+_VECTORS = {'xmm': VECTOR[128], 'ymm': VECTOR[256]}
+
+
+def _register(kind, number, rex):
+    if kind in _VECTORS:
+        return _VECTORS[kind][number]
+    width = int(kind[1:])
+    if width == 8:
+        return (GPR8_REX if rex else GPR[8])[number]
+    return GPR[width][number]
+
+
+def _memory(data, width, modrm_pos, rex):
+    entry = MODRM[ord(data[modrm_pos])]
+    pos = modrm_pos + 1
+    if entry.rip_relative:
+        return mem(width, disp=_DISP32.unpack_from(data, pos)[0],
+                   rip_relative=True)
+    base = entry.r_m | ((rex & 1) << 3)
+    index = None
+    scale = 1
+    disp_size = entry.disp_size
+    if entry.sib:
+        sib = SIB[ord(data[pos])]
+        pos += 1
+        index = sib.index | ((rex & 2) << 2)
+        if index == 4:
+            index = None
+        else:
+            scale = sib.scale
+        base = sib.base | ((rex & 1) << 3)
+        if entry.mod == 0 and sib.base == 5:
+            base = None
+            disp_size = 4
+    disp = 0
+    if disp_size == 1:
+        disp = _DISP8.unpack_from(data, pos)[0]
+    elif disp_size == 4:
+        disp = _DISP32.unpack_from(data, pos)[0]
+    return mem(width, None if base is None else GPR[64][base],
+               None if index is None else GPR[64][index], scale, disp)
+
+
+def _operands(form, data, scanned):
+    (length, opmap, opcode, modrm_pos, imm_pos, imm_size, rex, mandatory,
+     addr32, vex) = scanned
+    operands = []
+    modrm = None if modrm_pos is None else ord(data[modrm_pos])
+    for i, kind in enumerate(form.kinds):
+        if i == form.imm:
+            cls, fmt = _IMMEDIATES[kind]
+            operands.append(cls(fmt.unpack_from(data, imm_pos)[0]))
+        elif i == form.reg:
+            operands.append(_register(
+                kind, ((modrm >> 3) & 7) | ((rex & 4) << 1), rex))
+        elif i == form.r_m:
+            if modrm >= 0xC0:
+                operands.append(_register(
+                    kind, (modrm & 7) | ((rex & 1) << 3), rex))
+            elif addr32:
+                # 32-bit addresses cannot be represented
+                return None
+            else:
+                width = int(form.memory_kind[1:])
+                operands.append(_memory(data, width, modrm_pos, rex))
+        elif i == form.vvvv:
+            operands.append(_register(kind, vex[1], rex))
+        elif i == form.plus_r:
+            operands.append(_register(
+                kind, (opcode & 7) | ((rex & 1) << 3), rex))
+        else:
+            operands.append(GPR[_ACCUMULATORS[kind]][0])
+    return tuple(operands)
+
+
+def _match(candidates, data, scanned):
+    modrm_pos, rex, mandatory, vex = (
+        scanned[3], scanned[6], scanned[7], scanned[9])
+    rex_w = bool(rex & 8)
+    for form_mandatory, form, mnemonic in candidates:
+        if form_mandatory != mandatory or form.rex_w != rex_w:
+            continue
+        if form.vex is not None and form.vex != vex[0]:
+            continue
+        if form.digit is not None and (
+                modrm_pos is None
+                or (ord(data[modrm_pos]) >> 3) & 7 != form.digit):
+            continue
+        return form, mnemonic
+    return None, 0
+
+
+def disassemble(data, start=0, end=None, strict=True):
+    """
+    Decode instructions in a buffer.
+
+    :param data:
+        Buffer with 64-bit code.
+    :param start:
+        Offset of the first instruction.
+    :param end:
+        Offset just past the last instruction, the end of ``data`` by
+        default.
+    :param strict:
+        If False, undecodable bytes are reported as unknown instructions of
+        length one instead of raising :class:`DecodeError`.
+    :returns:
+        Generator of :class:`Decoded` records.
+    """
+    data = _view(data)
+    if end is None:
+        end = len(data)
+    forms = _get_tables().forms
+    pos = start
+    while pos < end:
+        try:
+            scanned = _scan(data, pos, end)
+        except DecodeError:
+            if strict:
+                raise
+            yield Decoded(pos, 1, 0, None)
+            pos += 1
+            continue
+        candidates = forms.get((scanned[1], scanned[2]))
+        form, mnemonic = (_match(candidates, data, scanned) if candidates
+                          else (None, 0))
+        yield Decoded(pos, scanned[0], mnemonic,
+                      form and _operands(form, data, scanned))
+        pos += scanned[0]
+
+
+def format_instruction(decoded):
+    """Format a decoded instruction in Intel syntax."""
+    cls = MNEMONICS[decoded.mnemonic]
+    if cls is None:
+        return '(unknown)'
+    if not decoded.operands:
+        return cls.__name__
+    return '{} {}'.format(cls.__name__, ', '.join(
+        repr(op) if isinstance(op, (reg, mem)) else str(op.value)
+        for op in decoded.operands))
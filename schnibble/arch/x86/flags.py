@@ -2,50 +2,81 @@
 """
 x86 control flags.
 
-All of the flags in this module belong to the {r,e,}flags register.
+All of the flags in this module belong to the {r,e,}flags register. Sets of
+flags are immutable integers with one bit for each flag, at the position of
+the flag in the register, so that they can be combined and tested with
+plain bitwise operators.
 """
 from __future__ import absolute_import, print_function
 
-__all__ = ('OF', 'DF', 'SF', 'ZF', 'AF', 'PF', 'CF')
+__all__ = ('FlagSet', 'Flag', 'OF', 'DF', 'SF', 'ZF', 'AF', 'PF', 'CF',
+           'STATUS_FLAGS')
 
 
-class FlagSet(set):
-    """Set specialized for holiding Flag objects."""
+class FlagSet(int):
+    """Immutable set of flags, a bitmask of the flags register."""
+
+    __slots__ = ()
+
+    def __new__(cls, flags=0):
+        """
+        Create a set of flags.
+
+        :param flags:
+            A bitmask or an iterable of :class:`Flag`.
+        """
+        if not isinstance(flags, (int, long)):
+            mask = 0
+            for flag in flags:
+                mask |= flag
+            flags = mask
+        return super(FlagSet, cls).__new__(cls, flags)
 
     @property
     def mask(self):
         """Mask of all the flags in the set."""
-        m = 0
-        for flag in self:
-            m |= int(flag)
-        return m
+        return int(self)
 
     def __or__(self, other):
-        if isinstance(other, Flag):
-            self.add(other)
-            return self
-        return super(FlagSet, self).__or__(other)
+        return FlagSet(int(self) | other)
+
+    __ror__ = __or__
+
+    def __and__(self, other):
+        return FlagSet(int(self) & other)
 
+    __rand__ = __and__
 
-class Flag(object):
-    """Object representing a binary flag."""
+    def __sub__(self, other):
+        return FlagSet(int(self) & ~other)
 
-    def __init__(self, bit, name):
+    def __contains__(self, flag):
+        return int(self) & flag == flag
+
+    def __iter__(self):
+        for flag in _FLAGS:
+            if int(self) & flag:
+                yield flag
+
+    def __len__(self):
+        return bin(self).count('1')
+
+    def __repr__(self):
+        return "FlagSet({})".format('|'.join(repr(flag) for flag in self))
+
+
+class Flag(FlagSet):
+    """Object representing a binary flag, a set with one flag."""
+
+    def __new__(cls, bit, name):
+        self = super(Flag, cls).__new__(cls, 1 << bit)
         self.bit = bit
         self.name = name
-
-    def __int__(self):
-        return 1 << self.bit
+        return self
 
     def __repr__(self):
         return self.name
 
-    def __or__(self, other):
-        if isinstance(other, FlagSet):
-            other.add(self)
-            return other
-        return FlagSet([self, other])
-
 
 #: Overflow Flag
 OF = Flag(11, "OF")
@@ -67,3 +98,8 @@ PF = Flag(2, "PF")
 
 #: Carry Flag.
 CF = Flag(0, "CF")
+
+_FLAGS = (OF, DF, SF, ZF, AF, PF, CF)
+
+#: Flags set by arithmetic instructions
+STATUS_FLAGS = OF | SF | ZF | AF | PF | CF
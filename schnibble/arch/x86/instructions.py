@@ -3,20 +3,458 @@
 
 from __future__ import absolute_import, print_function
 
-from .registers import AL, AX, EAX, RAX
+import itertools
+import struct
+
+from schnibble import trace
+
 from .flags import OF, SF, ZF, AF, PF, CF
-from .flags import FlagSet
-from .operands import imm8, imm16, imm32, imm64, reg8, reg16, reg32, reg64
+from .flags import FlagSet, STATUS_FLAGS
+from .registers import AX, RSP, ALL_REGISTERS
+
+
+__all__ = ('AAA', 'ADD', 'SUB', 'IMUL', 'NEG', 'XOR', 'MOV', 'LEA', 'PUSH',
+           'POP', 'JMP', 'CALL', 'JO', 'JNO', 'JB', 'JAE', 'JE', 'JNE', 'JBE',
+           'JA', 'JS', 'JNS', 'JP', 'JNP', 'JL', 'JGE', 'JLE', 'JG', 'JC',
+           'JNAE', 'JNB', 'JNC', 'JZ', 'JNZ', 'JNA', 'JNBE', 'JPE', 'JPO',
+           'JNGE', 'JNL', 'JNG', 'JNLE', 'INT', 'RET', 'ADDPS', 'ADDPD',
+           'MULPS', 'MULPD', 'PADDD', 'PADDQ', 'PMULLD', 'MOVUPS', 'MOVUPD',
+           'MOVDQU', 'VADDPS', 'VADDPD', 'VMULPS', 'VMULPD', 'VPADDD',
+           'VPADDQ', 'VPMULLD', 'VMOVUPS', 'VMOVUPD', 'VMOVDQU',
+           'VBROADCASTSS', 'VBROADCASTSD', 'VPBROADCASTD', 'VPBROADCASTQ',
+           'Form', 'ENCODINGS', 'MNEMONICS')
+
+#: Encoding table, maps ``(mnemonic, signature)`` to :class:`Form`. The
+#: signature is a tuple with the ``kind`` of each operand.
+ENCODINGS = {}
+
+#: Instruction classes indexed by their ``mnemonic_id``. The first element,
+#: None, stands for unknown instructions.
+MNEMONICS = [None]
+
+_PREFIXES = ('66', 'F2', 'F3')
+_IMMEDIATES = {
+    'ib': 1, 'iw': 2, 'id': 4, 'iq': 8,
+    'cb': 1, 'cw': 2, 'cd': 4,
+}
+_FORMATS = {1: '<B', 2: '<H', 4: '<I', 8: '<Q'}
+_REGISTER_KINDS = {'r8': 'AL', 'r16': 'AX', 'r32': 'EAX', 'r64': 'RAX'}
+_VECTOR_KINDS = ('xmm', 'ymm')
+_MEMORY_KINDS = ('m8', 'm16', 'm32', 'm64', 'm128', 'm256')
+# Escape bytes of the opcode maps of VEX prefixes
+_VEX_MAPS = {'0F': (0x0F,), '0F38': (0x0F, 0x38), '0F3A': (0x0F, 0x3A)}
+# Fields of VEX prefixes: implied legacy prefix (pp), opcode map (m-mmmm)
+_VEX_PP = {0x66: 1, 0xF3: 2, 0xF2: 3}
+_VEX_FIELDS = {(0x0F,): 1, (0x0F, 0x38): 2, (0x0F, 0x3A): 3}
+# Room for immediate values, indexed by their size
+_ZEROS = tuple(b'\0' * size for size in range(9))
+
+
+def _is_high_byte(op):
+    """Check whether a register operand is AH, CH, DH or BH."""
+    return op.width == 8 and 4 <= op.number < 8 and not op.rex_required
+
+
+class Form(object):
+    """
+    One encoding of an instruction.
+
+    Forms are compiled from the notation used in the instruction reference
+    of the AMD64 Architecture Programmer's Manual, for example
+    ``Form('ADD', 'r/m64, imm32', 'REX.W 81 /0 id')``. The operand list uses
+    ``r8`` ... ``r64``, ``m8`` ... ``m64``, ``r/m8`` ... ``r/m64``,
+    ``imm8`` ... ``imm64``, ``simm8`` (sign-extended to the operand size),
+    ``rel32`` and the accumulator registers ``AL``, ``AX``, ``EAX`` and
+    ``RAX`` for implied operands. The
+    encoding is a sequence of legacy prefixes, ``REX.W``, opcode bytes (the
+    last one optionally with ``+r``), ``/r`` or ``/digit`` for the ModRM
+    byte and ``ib``, ``iw``, ``id``, ``iq`` or ``cb``, ``cd`` for the
+    immediate value or displacement.
+
+    Vector instructions use ``xmm`` and ``ymm`` registers, ``m128`` and
+    ``m256`` memory and ``xmm/m128``, ``ymm/m256`` or ``xmm/m32`` operands
+    for the ModRM r/m field. Their encoding starts with a legacy
+    mandatory prefix (SSE) or with a VEX prefix in the notation of the
+    Intel manual (AVX), for example
+    ``Form('VADDPS', 'ymm, ymm, ymm/m256', 'VEX.256.0F.WIG 58 /r')``. The
+    second register operand of a VEX form is encoded in VEX.vvvv.
+
+    The implied prefix of a VEX form is kept in ``prefix`` and its opcode
+    map in the first bytes of ``opcode``, like in the equivalent legacy
+    encoding. ``vex`` is the VEX.L bit, None for legacy encodings.
+    """
+
+    __slots__ = ('mnemonic', 'operands', 'encoding', 'kinds', 'prefix',
+                 'rex_w', 'opcode', 'plus_r', 'reg', 'digit', 'r_m', 'imm',
+                 'imm_struct', 'imm_mask', 'imm_size', 'layouts', 'vex',
+                 'vvvv', 'memory_kind')
+
+    def __init__(self, mnemonic, operands, encoding):
+        """
+        Compile a form.
+
+        :param mnemonic:
+            Mnemonic of the instruction, e.g. ``'ADD'``.
+        :param operands:
+            Comma-separated operand list.
+        :param encoding:
+            Space-separated encoding.
+        :raises ValueError:
+            If the notation is not understood.
+        """
+        self.mnemonic = mnemonic
+        self.operands = tuple(
+            op.strip() for op in operands.split(',') if op.strip())
+        self.encoding = encoding
+        self.prefix = bytearray()
+        self.rex_w = False
+        self.opcode = bytearray()
+        self.plus_r = self.reg = self.digit = self.r_m = self.imm = None
+        self.vex = self.vvvv = self.memory_kind = None
+        self.imm_struct = None
+        self.imm_mask = self.imm_size = 0
+        # Layouts by register operands, see layout()
+        self.layouts = {}
+        tokens = encoding.split()
+        while len(tokens) > 1 and tokens[0] in _PREFIXES:
+            self.prefix.append(int(tokens.pop(0), 16))
+        plus_r = modrm_reg = False
+        for token in tokens:
+            if token == 'REX.W':
+                self.rex_w = True
+            elif token.startswith('VEX.'):
+                self._parse_vex(token)
+            elif token == '/r':
+                modrm_reg = True
+            elif len(token) == 2 and token[0] == '/' and token[1].isdigit():
+                self.digit = int(token[1])
+            elif token in _IMMEDIATES:
+                size = _IMMEDIATES[token]
+                self.imm_struct = struct.Struct(_FORMATS[size])
+                self.imm_mask = (1 << (size * 8)) - 1
+                self.imm_size = size
+            elif token.endswith('+r'):
+                self.opcode.append(int(token[:-2], 16))
+                plus_r = True
+            else:
+                try:
+                    self.opcode.append(int(token, 16))
+                except ValueError:
+                    raise ValueError("unknown token {!r} in {!r}".format(
+                        token, encoding))
+        kinds = []
+        for i, op in enumerate(self.operands):
+            if '/' in op:
+                register, self.memory_kind = op.split('/')
+                if register == 'r':
+                    register += self.memory_kind[1:]
+                self.r_m = i
+                kinds.append(register)
+            elif op in _MEMORY_KINDS:
+                self.r_m = i
+                self.memory_kind = op
+                kinds.append(op)
+            elif op in _REGISTER_KINDS or op in _VECTOR_KINDS:
+                if plus_r:
+                    self.plus_r = i
+                elif modrm_reg and self.reg is None:
+                    self.reg = i
+                elif self.vex is not None and self.vvvv is None:
+                    self.vvvv = i
+                else:
+                    raise ValueError("register {} of {!r} is not encoded"
+                                     .format(op, encoding))
+                kinds.append(op)
+            elif op.startswith(('imm', 'simm', 'rel')):
+                self.imm = i
+                kinds.append(op)
+            elif op in _REGISTER_KINDS.values():
+                kinds.append(op)
+            else:
+                raise ValueError("unknown operand {!r}".format(op))
+        self.kinds = tuple(kinds)
+
+    def _parse_vex(self, token):
+        """Parse a VEX prefix like ``VEX.128.66.0F38.W0``."""
+        fields = token.split('.')[1:]
+        try:
+            self.vex = ('128', '256').index(fields.pop(0))
+            if fields[0] in _PREFIXES:
+                self.prefix.append(int(fields.pop(0), 16))
+            self.opcode.extend(_VEX_MAPS[fields.pop(0)])
+            w, = fields
+            if w not in ('W0', 'W1', 'WIG'):
+                raise ValueError(w)
+        except (ValueError, KeyError, IndexError):
+            raise ValueError("invalid VEX prefix {!r}".format(token))
+        self.rex_w = w == 'W1'
+
+    def __repr__(self):
+        """Compute the representation of a Form."""
+        return "Form({!r}, {!r}, {!r})".format(
+            self.mnemonic, ', '.join(self.operands), self.encoding)
+
+    @property
+    def signatures(self):
+        """
+        All signatures matched by this form.
+
+        A register operand also matches the accumulator of the same width,
+        which has a distinct kind so that it may have shorter encodings.
+        An ``r/m`` operand also matches memory.
+        """
+        choices = []
+        for i, kind in enumerate(self.kinds):
+            choice = [kind]
+            if kind in _REGISTER_KINDS:
+                choice.append(_REGISTER_KINDS[kind])
+            if i == self.r_m and kind != self.memory_kind:
+                choice.append(self.memory_kind)
+            choices.append(choice)
+        return list(itertools.product(*choices))
+
+    def _head(self, operands):
+        """Encode everything but the immediate value."""
+        if self.vex is not None:
+            buf = bytearray()
+        else:
+            buf = bytearray(self.prefix)
+        rex = 0x48 if self.rex_w else 0x40
+        # Set when a register needs a REX prefix even without any bits in it
+        bare_rex = False
+        # Set when AH, CH, DH or BH is used, they can't have a REX prefix
+        high_byte = False
+        if self.reg is not None:
+            op = operands[self.reg]
+            reg = op.number
+            rex |= (reg >> 3) << 2
+            bare_rex = op.rex_required
+            high_byte = _is_high_byte(op)
+        else:
+            reg = self.digit
+        tail = None
+        if self.r_m is not None:
+            op = operands[self.r_m]
+            if op.kind[0] == 'm':
+                rex |= op.rex
+                modrm = op.modrm | ((reg & 7) << 3)
+                tail = op.tail
+            else:
+                r_m = op.number
+                rex |= r_m >> 3
+                bare_rex = bare_rex or op.rex_required
+                high_byte = high_byte or _is_high_byte(op)
+                # Register-direct addressing
+                modrm = 0xC0 | ((reg & 7) << 3) | (r_m & 7)
+        elif self.plus_r is not None:
+            op = operands[self.plus_r]
+            r_m = op.number
+            rex |= r_m >> 3
+            bare_rex = bare_rex or op.rex_required
+            high_byte = high_byte or _is_high_byte(op)
+        if high_byte and (rex != 0x40 or bare_rex):
+            raise ValueError("AH, CH, DH and BH cannot be encoded with a "
+                             "REX prefix: {} {}".format(
+                                 self.mnemonic, ', '.join(
+                                     repr(op) for op in operands)))
+        opcode = self.opcode
+        if self.vex is not None:
+            buf.extend(self._vex_prefix(rex, operands))
+            # The escape bytes of the opcode map are in the VEX prefix
+            opcode = opcode[-1:]
+        elif rex != 0x40 or bare_rex:
+            buf.append(rex)
+        if self.plus_r is not None:
+            buf.extend(opcode[:-1])
+            buf.append(opcode[-1] + (r_m & 7))
+        else:
+            buf.extend(opcode)
+        if self.r_m is not None:
+            buf.append(modrm)
+            if tail:
+                buf.extend(tail)
+        return bytes(buf)
+
+    def _vex_prefix(self, rex, operands):
+        """Encode a VEX prefix with the REX bits computed by _head()."""
+        pp = _VEX_PP.get(self.prefix[0], 0) if self.prefix else 0
+        field = _VEX_FIELDS[tuple(self.opcode[:-1])]
+        vvvv = 0 if self.vvvv is None else operands[self.vvvv].number
+        # R, X, B and vvvv are stored inverted
+        low = ((~vvvv & 0xF) << 3) | (self.vex << 2) | pp
+        if not rex & 0xB and field == 1:
+            # The two-byte form has no X, B and W bits and implies 0F
+            return bytearray((0xC5, ((~rex & 4) << 5) | low))
+        return bytearray(
+            (0xC4, ((~rex & 7) << 5) | field, ((rex & 8) << 4) | low))
+
+    def layout(self, operands):
+        """
+        Compute the parts of the encoding that depend on the operands.
+
+        :param operands:
+            Operands matching the signature of this form.
+        :returns:
+            Tuple ``(size, head)``. ``size`` is the length of the
+            instruction and ``head`` has all of its bytes but the immediate
+            value.
+
+        The layout doesn't depend on immediate values, it is computed once
+        for each combination of registers.
+        """
+        r_m = self.r_m
+        if r_m is not None and operands[r_m].kind[0] == 'm':
+            head = self._head(operands)
+            return len(head) + self.imm_size, head
+        # The immediate value is always the last operand
+        key = operands if self.imm is None else operands[:-1]
+        try:
+            return self.layouts[key]
+        except KeyError:
+            head = self._head(operands)
+            layout = self.layouts[key] = (len(head) + self.imm_size, head)
+            return layout
+
+    def encode(self, buf, operands):
+        """
+        Append the encoded instruction to a buffer.
+
+        :param buf:
+            A bytearray.
+        :param operands:
+            Operands matching the signature of this form.
+        """
+        buf.extend(self.layout(operands)[1])
+        if self.imm is not None:
+            offset = len(buf)
+            buf.extend(_ZEROS[self.imm_size])
+            self.imm_struct.pack_into(
+                buf, offset, operands[self.imm].value & self.imm_mask)
+
 
+class InstructionMeta(type):
+    """
+    Meta-class of instructions.
+
+    Compiles the ``forms`` of each instruction into :data:`ENCODINGS`.
+    """
 
-__all__ = ('AAA', 'ADD', 'MOV', 'RET')
+    def __new__(mcls, name, bases, ns):
+        cls = super(InstructionMeta, mcls).__new__(mcls, name, bases, ns)
+        if ns.get('forms'):
+            cls.mnemonic_id = len(MNEMONICS)
+            MNEMONICS.append(cls)
+        forms = [Form(name, operands, encoding)
+                 for operands, encoding in ns.get('forms', ())]
+        # Exact signatures take precedence over the accumulator variants of
+        # generic forms, earlier forms take precedence over later ones.
+        for form in forms:
+            ENCODINGS.setdefault((name, form.kinds), form)
+        for form in forms:
+            for signature in form.signatures:
+                ENCODINGS.setdefault((name, signature), form)
+        return cls
 
 
 class Instruction(object):
 
+    """
+    Base class for instructions.
+
+    :attribute forms:
+        Sequence of ``(operands, encoding)`` pairs, see :class:`Form`.
+    :attribute mnemonic_id:
+        Index of the class in :data:`MNEMONICS`.
+    :attribute operand_access:
+        How each explicit operand is used, ``'r'`` (read), ``'w'``
+        (written) or ``'rw'`` (both).
+    :attribute implicit_reads:
+        Mask of registers read by the instruction without being operands,
+        see :attr:`~schnibble.arch.x86.operands.reg.mask`.
+    :attribute implicit_writes:
+        Mask of registers written by the instruction without being
+        operands.
+    :attribute flags_read:
+        :class:`~schnibble.arch.x86.flags.FlagSet` of flags used by the
+        instruction.
+    :attribute flags_written:
+        Flags modified by the instruction, including the ones left
+        undefined.
+    :attribute control_flow:
+        None for instructions that continue with the next one, ``'jump'``,
+        ``'branch'`` (conditional jump), ``'call'`` or ``'return'``.
+    """
+
+    __metaclass__ = InstructionMeta
+
+    forms = ()
+    mnemonic_id = 0
+    operand_access = ()
+    implicit_reads = implicit_writes = 0
+    flags_read = flags_written = FlagSet()
+    control_flow = None
+
+    @classmethod
+    def access(cls, *operands):
+        """
+        Compute the registers used by the instruction.
+
+        :param operands:
+            Operands of the instruction.
+        :returns:
+            Tuple ``(reads, writes)`` of register masks. Registers used to
+            compute memory addresses are read.
+        """
+        reads = cls.implicit_reads
+        writes = cls.implicit_writes
+        for op, mode in zip(operands, cls.operand_access):
+            reads |= op.address_mask
+            if mode != 'w':
+                reads |= op.mask
+            if mode != 'r':
+                writes |= op.write_mask
+        return reads, writes
+
     @classmethod
     def emit(cls, buf, *operands):
-        raise NotImplementedError
+        """
+        Emit instruction into a code buffer.
+
+        :raises ValueError:
+            If there is no encoding for the given operands.
+        """
+        assert isinstance(buf, bytearray)
+        if trace.enabled:
+            return cls._emit_traced(buf, operands)
+        cls.find_form(operands).encode(buf, operands)
+
+    @classmethod
+    def _emit_traced(cls, buf, operands):
+        """Emit the instruction, reporting the x86.emit event."""
+        size = len(buf)
+        token = trace.begin('x86.emit', instruction=cls)
+        try:
+            cls.find_form(operands).encode(buf, operands)
+        finally:
+            trace.end('x86.emit', token, instruction=cls,
+                      size=len(buf) - size)
+
+    @classmethod
+    def find_form(cls, operands):
+        """
+        Find the encoding of the instruction with the given operands.
+
+        :returns:
+            A :class:`Form`.
+        :raises ValueError:
+            If there is no encoding for the given operands.
+        """
+        try:
+            return ENCODINGS[cls.__name__, tuple([op.kind for op in operands])]
+        except (KeyError, AttributeError):
+            raise ValueError("don't know how to encode: {} {}".format(
+                cls.__name__, ', '.join(
+                    op.__class__.__name__ for op in operands)))
 
 
 class AAA(Instruction):
@@ -39,76 +477,444 @@ class AAA(Instruction):
     nibble ‘3’.
     """
 
-    affected_rflags = AF | CF
+    flags_read = AF
+    # OF, SF, ZF and PF are undefined
+    flags_written = STATUS_FLAGS
+    implicit_reads = implicit_writes = AX.mask
 
-    @classmethod
-    def emit(cls, buf):
-        """Emit instruction into a code buffer."""
-        # AMD64 Architecture Programmer’s Manual Volume 3:
-        # General-Purpose and System Instructions
-        #
-        # Page 73 (109 pdf page)
-        assert isinstance(buf, bytearray)
-        buf.append(0x37)
+    # AMD64 Architecture Programmer’s Manual Volume 3:
+    # General-Purpose and System Instructions
+    #
+    # Page 73 (109 pdf page)
+    forms = (
+        ('', '37'),
+    )
 
 
 class ADD(Instruction):
     """Signed or Unsigned Add."""
 
-    affected_rflags = OF | SF | ZF | AF | PF | CF
+    flags_written = STATUS_FLAGS
+    operand_access = ('rw', 'r')
+
+    # AMD64 Architecture Programmer’s Manual Volume 3:
+    # General-Purpose and System Instructions
+    #
+    # Page 79 (115 pdf page)
+    forms = (
+        ('AL, imm8', '04 ib'),
+        ('AX, imm16', '66 05 iw'),
+        ('EAX, imm32', '05 id'),
+        ('RAX, imm32', 'REX.W 05 id'),
+        ('r/m8, imm8', '80 /0 ib'),
+        ('r/m16, imm16', '66 81 /0 iw'),
+        ('r/m32, imm32', '81 /0 id'),
+        ('r/m64, imm32', 'REX.W 81 /0 id'),
+        # The 8-bit immediate is sign-extended
+        ('r/m16, simm8', '66 83 /0 ib'),
+        ('r/m32, simm8', '83 /0 ib'),
+        ('r/m64, simm8', 'REX.W 83 /0 ib'),
+        ('r/m8, r8', '00 /r'),
+        ('r/m16, r16', '66 01 /r'),
+        ('r/m32, r32', '01 /r'),
+        ('r/m64, r64', 'REX.W 01 /r'),
+        ('r8, r/m8', '02 /r'),
+        ('r16, r/m16', '66 03 /r'),
+        ('r32, r/m32', '03 /r'),
+        ('r64, r/m64', 'REX.W 03 /r'),
+    )
+
+
+class SUB(Instruction):
+    """Subtract."""
+
+    flags_written = STATUS_FLAGS
+    operand_access = ('rw', 'r')
+
+    forms = (
+        ('AL, imm8', '2C ib'),
+        ('AX, imm16', '66 2D iw'),
+        ('EAX, imm32', '2D id'),
+        ('RAX, imm32', 'REX.W 2D id'),
+        ('r/m8, imm8', '80 /5 ib'),
+        ('r/m16, imm16', '66 81 /5 iw'),
+        ('r/m32, imm32', '81 /5 id'),
+        ('r/m64, imm32', 'REX.W 81 /5 id'),
+        # The 8-bit immediate is sign-extended
+        ('r/m16, simm8', '66 83 /5 ib'),
+        ('r/m32, simm8', '83 /5 ib'),
+        ('r/m64, simm8', 'REX.W 83 /5 ib'),
+        ('r/m8, r8', '28 /r'),
+        ('r/m16, r16', '66 29 /r'),
+        ('r/m32, r32', '29 /r'),
+        ('r/m64, r64', 'REX.W 29 /r'),
+        ('r8, r/m8', '2A /r'),
+        ('r16, r/m16', '66 2B /r'),
+        ('r32, r/m32', '2B /r'),
+        ('r64, r/m64', 'REX.W 2B /r'),
+    )
+
+
+class IMUL(Instruction):
+    """Signed Multiply."""
+
+    # SF, ZF, AF and PF are undefined
+    flags_written = STATUS_FLAGS
+    operand_access = ('rw', 'r')
+
+    forms = (
+        ('r16, r/m16', '66 0F AF /r'),
+        ('r32, r/m32', '0F AF /r'),
+        ('r64, r/m64', 'REX.W 0F AF /r'),
+    )
+
+
+class NEG(Instruction):
+    """Two's Complement Negation."""
+
+    flags_written = STATUS_FLAGS
+    operand_access = ('rw',)
+
+    forms = (
+        ('r/m8', 'F6 /3'),
+        ('r/m16', '66 F7 /3'),
+        ('r/m32', 'F7 /3'),
+        ('r/m64', 'REX.W F7 /3'),
+    )
+
+
+class XOR(Instruction):
+    """Exclusive OR."""
+
+    # AF is undefined
+    flags_written = STATUS_FLAGS
+    operand_access = ('rw', 'r')
+
+    forms = (
+        ('AL, imm8', '34 ib'),
+        ('AX, imm16', '66 35 iw'),
+        ('EAX, imm32', '35 id'),
+        ('RAX, imm32', 'REX.W 35 id'),
+        ('r/m8, imm8', '80 /6 ib'),
+        ('r/m16, imm16', '66 81 /6 iw'),
+        ('r/m32, imm32', '81 /6 id'),
+        ('r/m64, imm32', 'REX.W 81 /6 id'),
+        # The 8-bit immediate is sign-extended
+        ('r/m16, simm8', '66 83 /6 ib'),
+        ('r/m32, simm8', '83 /6 ib'),
+        ('r/m64, simm8', 'REX.W 83 /6 ib'),
+        ('r/m8, r8', '30 /r'),
+        ('r/m16, r16', '66 31 /r'),
+        ('r/m32, r32', '31 /r'),
+        ('r/m64, r64', 'REX.W 31 /r'),
+        ('r8, r/m8', '32 /r'),
+        ('r16, r/m16', '66 33 /r'),
+        ('r32, r/m32', '33 /r'),
+        ('r64, r/m64', 'REX.W 33 /r'),
+    )
 
     @classmethod
-    def emit(cls, buf, dest, src):
-        """Emit instruction into a code buffer."""
-        # AMD64 Architecture Programmer’s Manual Volume 3:
-        # General-Purpose and System Instructions
-        #
-        # Page 79 (115 pdf page)
-        assert isinstance(buf, bytearray)
-        if dest is AL and isinstance(src, imm8):
-            buf.append(0x04)
-            buf.extend(src.bytes)
-        elif dest is AX and isinstance(src, imm16):
-            buf.append(0x05)
-            buf.extend(src.bytes)
-        elif dest is EAX and isinstance(src, imm32):
-            buf.append(0x05)
-            buf.extend(src.bytes)
-        elif dest is RAX and isinstance(src, imm32):
-            buf.append(0x05)
-            buf.extend(src.bytes)
-        else:
-            # Lots of reg/mem encodings...
-            raise NotImplemented("don't know how to encode: {} {} {}".format(
-                cls.__name__, dest.__class__.__name__, src.__class__.__name__))
+    def access(cls, *operands):
+        if len(operands) == 2 and operands[0] is operands[1]:
+            # Zeroing idiom, the previous value is not used
+            return 0, operands[0].write_mask
+        return super(XOR, cls).access(*operands)
 
 
 class MOV(Instruction):
     """Move."""
 
-    @classmethod
-    def emit(cls, buf, dest, src):
-        """Emit instruction into a code buffer."""
-        # AMD64 Architecture Programmer’s Manual Volume 3:
-        # General-Purpose and System Instructions
-        #
-        # Page 217-218 (253-254 pdf page)
-        assert isinstance(buf, bytearray)
-        if isinstance(dest, reg8) and isinstance(src, imm8):
-            buf.append(0xB0 + dest.plus_rb)
-            buf.extend(src.bytes)
-        elif isinstance(dest, reg16) and isinstance(src, imm16):
-            buf.append(0xB8 + dest.plus_rw)
-            buf.extend(src.bytes)
-        elif isinstance(dest, reg32) and isinstance(src, imm32):
-            buf.append(0xB8 + dest.plus_rd)
-            buf.extend(src.bytes)
-        elif isinstance(dest, reg64) and isinstance(src, imm64):
-            buf.append(0xB8 + dest.plus_rq)
-            buf.extend(src.bytes)
-        else:
-            raise NotImplemented("don't know how to encode: {} {} {}".format(
-                cls.__name__, dest.__class__.__name__, src.__class__.__name__))
+    operand_access = ('w', 'r')
+
+    # AMD64 Architecture Programmer’s Manual Volume 3:
+    # General-Purpose and System Instructions
+    #
+    # Page 217-218 (253-254 pdf page)
+    forms = (
+        ('r/m8, r8', '88 /r'),
+        ('r/m16, r16', '66 89 /r'),
+        ('r/m32, r32', '89 /r'),
+        ('r/m64, r64', 'REX.W 89 /r'),
+        ('r8, r/m8', '8A /r'),
+        ('r16, r/m16', '66 8B /r'),
+        ('r32, r/m32', '8B /r'),
+        ('r64, r/m64', 'REX.W 8B /r'),
+        ('r8, imm8', 'B0+r ib'),
+        ('r16, imm16', '66 B8+r iw'),
+        ('r32, imm32', 'B8+r id'),
+        ('r64, imm64', 'REX.W B8+r iq'),
+        ('r/m8, imm8', 'C6 /0 ib'),
+        ('r/m16, imm16', '66 C7 /0 iw'),
+        ('r/m32, imm32', 'C7 /0 id'),
+        # The immediate is sign-extended to 64 bits
+        ('r/m64, imm32', 'REX.W C7 /0 id'),
+    )
+
+
+class LEA(Instruction):
+    """Load Effective Address."""
+
+    operand_access = ('w', 'r')
+
+    # Only the address is computed, the width of the memory operand must be
+    # the width of the register.
+    forms = (
+        ('r16, m16', '66 8D /r'),
+        ('r32, m32', '8D /r'),
+        ('r64, m64', 'REX.W 8D /r'),
+    )
+
+
+class PUSH(Instruction):
+    """Push onto Stack."""
+
+    operand_access = ('r',)
+    implicit_reads = implicit_writes = RSP.mask
+
+    # The operand size is 64 bits by default in 64-bit mode
+    forms = (
+        ('r64', '50+r'),
+    )
+
+
+class POP(Instruction):
+    """Pop Stack."""
+
+    operand_access = ('w',)
+    implicit_reads = implicit_writes = RSP.mask
+
+    forms = (
+        ('r64', '58+r'),
+    )
+
+
+class JMP(Instruction):
+    """Near Jump."""
+
+    control_flow = 'jump'
+
+    forms = (
+        ('rel8', 'EB cb'),
+        ('rel32', 'E9 cd'),
+    )
+
+
+class CALL(Instruction):
+    """Procedure Call (near)."""
+
+    implicit_reads = implicit_writes = RSP.mask
+    control_flow = 'call'
+
+    forms = (
+        ('rel32', 'E8 cd'),
+    )
+
+
+class JO(Instruction):
+    """Jump if Overflow (OF = 1)."""
+
+    flags_read = OF
+    control_flow = 'branch'
+
+    forms = (
+        ('rel8', '70 cb'),
+        ('rel32', '0F 80 cd'),
+    )
+
+
+class JNO(Instruction):
+    """Jump if Not Overflow (OF = 0)."""
+
+    flags_read = OF
+    control_flow = 'branch'
+
+    forms = (
+        ('rel8', '71 cb'),
+        ('rel32', '0F 81 cd'),
+    )
+
+
+class JB(Instruction):
+    """Jump if Below (CF = 1)."""
+
+    flags_read = CF
+    control_flow = 'branch'
+
+    forms = (
+        ('rel8', '72 cb'),
+        ('rel32', '0F 82 cd'),
+    )
+
+
+class JAE(Instruction):
+    """Jump if Above or Equal (CF = 0)."""
+
+    flags_read = CF
+    control_flow = 'branch'
+
+    forms = (
+        ('rel8', '73 cb'),
+        ('rel32', '0F 83 cd'),
+    )
+
+
+class JE(Instruction):
+    """Jump if Equal (ZF = 1)."""
+
+    flags_read = ZF
+    control_flow = 'branch'
+
+    forms = (
+        ('rel8', '74 cb'),
+        ('rel32', '0F 84 cd'),
+    )
+
+
+class JNE(Instruction):
+    """Jump if Not Equal (ZF = 0)."""
+
+    flags_read = ZF
+    control_flow = 'branch'
+
+    forms = (
+        ('rel8', '75 cb'),
+        ('rel32', '0F 85 cd'),
+    )
+
+
+class JBE(Instruction):
+    """Jump if Below or Equal (CF = 1 or ZF = 1)."""
+
+    flags_read = CF | ZF
+    control_flow = 'branch'
+
+    forms = (
+        ('rel8', '76 cb'),
+        ('rel32', '0F 86 cd'),
+    )
+
+
+class JA(Instruction):
+    """Jump if Above (CF = 0 and ZF = 0)."""
+
+    flags_read = CF | ZF
+    control_flow = 'branch'
+
+    forms = (
+        ('rel8', '77 cb'),
+        ('rel32', '0F 87 cd'),
+    )
+
+
+class JS(Instruction):
+    """Jump if Sign (SF = 1)."""
+
+    flags_read = SF
+    control_flow = 'branch'
+
+    forms = (
+        ('rel8', '78 cb'),
+        ('rel32', '0F 88 cd'),
+    )
+
+
+class JNS(Instruction):
+    """Jump if Not Sign (SF = 0)."""
+
+    flags_read = SF
+    control_flow = 'branch'
+
+    forms = (
+        ('rel8', '79 cb'),
+        ('rel32', '0F 89 cd'),
+    )
+
+
+class JP(Instruction):
+    """Jump if Parity (PF = 1)."""
+
+    flags_read = PF
+    control_flow = 'branch'
+
+    forms = (
+        ('rel8', '7A cb'),
+        ('rel32', '0F 8A cd'),
+    )
+
+
+class JNP(Instruction):
+    """Jump if Not Parity (PF = 0)."""
+
+    flags_read = PF
+    control_flow = 'branch'
+
+    forms = (
+        ('rel8', '7B cb'),
+        ('rel32', '0F 8B cd'),
+    )
+
+
+class JL(Instruction):
+    """Jump if Less (SF <> OF)."""
+
+    flags_read = SF | OF
+    control_flow = 'branch'
+
+    forms = (
+        ('rel8', '7C cb'),
+        ('rel32', '0F 8C cd'),
+    )
+
+
+class JGE(Instruction):
+    """Jump if Greater or Equal (SF = OF)."""
+
+    flags_read = SF | OF
+    control_flow = 'branch'
+
+    forms = (
+        ('rel8', '7D cb'),
+        ('rel32', '0F 8D cd'),
+    )
+
+
+class JLE(Instruction):
+    """Jump if Less or Equal (ZF = 1 or SF <> OF)."""
+
+    flags_read = ZF | SF | OF
+    control_flow = 'branch'
+
+    forms = (
+        ('rel8', '7E cb'),
+        ('rel32', '0F 8E cd'),
+    )
+
+
+class JG(Instruction):
+    """Jump if Greater (ZF = 0 and SF = OF)."""
+
+    flags_read = ZF | SF | OF
+    control_flow = 'branch'
+
+    forms = (
+        ('rel8', '7F cb'),
+        ('rel32', '0F 8F cd'),
+    )
+
+
+# Alternative mnemonics of conditional jumps
+JC = JNAE = JB
+JNB = JNC = JAE
+JZ = JE
+JNZ = JNE
+JNA = JBE
+JNBE = JA
+JPE = JP
+JPO = JNP
+JNGE = JL
+JNL = JGE
+JNG = JLE
+JNLE = JG
 
 
 class INT(Instruction):
@@ -119,30 +925,293 @@ class INT(Instruction):
     (IDT).
     """
 
-    @classmethod
-    def emit(cls, buf, op):
-        """Emit instruction into a code buffer."""
-        assert isinstance(buf, bytearray)
-        if isinstance(op, imm8):
-            # Call interrupt service routine specified by interrupt vector imm8
-            buf.append(0xCD)
-            buf.extend(op.bytes)
-        else:
-            raise ValueError("unexpected operand: {!r}".format(op))
+    # The interrupt handler may use any register and flag
+    implicit_reads = implicit_writes = ALL_REGISTERS
+    flags_read = STATUS_FLAGS
+
+    forms = (
+        # Call interrupt service routine specified by interrupt vector imm8
+        ('imm8', 'CD ib'),
+    )
 
 
 class RET(Instruction):
     """Return (near) from Called Procedure."""
 
-    affected_rflags = FlagSet()
+    implicit_reads = implicit_writes = RSP.mask
+    control_flow = 'return'
 
-    @classmethod
-    def emit(cls, buf, op=None):
-        assert isinstance(buf, bytearray)
-        if op is None:
-            buf.append(0xc3)
-        elif isinstance(op, imm16):
-            buf.append(0xc2)
-            buf.extend(op.bytes)
-        else:
-            raise ValueError("unexpected operand: {!r}".format(op))
+    forms = (
+        ('', 'C3'),
+        ('imm16', 'C2 iw'),
+    )
+
+
+# SSE and AVX instructions. The vector registers are not tracked in register
+# masks, see schnibble.arch.x86.registers, and the instructions below don't
+# modify flags.
+#
+# Intel® 64 and IA-32 Architectures Software Developer’s Manual Volume 2:
+# Instruction Set Reference
+
+
+class ADDPS(Instruction):
+    """Add Packed Single-Precision Floating-Point Values."""
+
+    operand_access = ('rw', 'r')
+
+    forms = (
+        ('xmm, xmm/m128', '0F 58 /r'),
+    )
+
+
+class ADDPD(Instruction):
+    """Add Packed Double-Precision Floating-Point Values."""
+
+    operand_access = ('rw', 'r')
+
+    forms = (
+        ('xmm, xmm/m128', '66 0F 58 /r'),
+    )
+
+
+class MULPS(Instruction):
+    """Multiply Packed Single-Precision Floating-Point Values."""
+
+    operand_access = ('rw', 'r')
+
+    forms = (
+        ('xmm, xmm/m128', '0F 59 /r'),
+    )
+
+
+class MULPD(Instruction):
+    """Multiply Packed Double-Precision Floating-Point Values."""
+
+    operand_access = ('rw', 'r')
+
+    forms = (
+        ('xmm, xmm/m128', '66 0F 59 /r'),
+    )
+
+
+class PADDD(Instruction):
+    """Add Packed Doubleword Integers."""
+
+    operand_access = ('rw', 'r')
+
+    forms = (
+        ('xmm, xmm/m128', '66 0F FE /r'),
+    )
+
+
+class PADDQ(Instruction):
+    """Add Packed Quadword Integers."""
+
+    operand_access = ('rw', 'r')
+
+    forms = (
+        ('xmm, xmm/m128', '66 0F D4 /r'),
+    )
+
+
+class PMULLD(Instruction):
+    """Multiply Packed Signed Dword Integers and Store Low Result (SSE4.1)."""
+
+    operand_access = ('rw', 'r')
+
+    forms = (
+        ('xmm, xmm/m128', '66 0F 38 40 /r'),
+    )
+
+
+class MOVUPS(Instruction):
+    """Move Unaligned Packed Single-Precision Floating-Point Values."""
+
+    operand_access = ('w', 'r')
+
+    forms = (
+        ('xmm, xmm/m128', '0F 10 /r'),
+        ('xmm/m128, xmm', '0F 11 /r'),
+    )
+
+
+class MOVUPD(Instruction):
+    """Move Unaligned Packed Double-Precision Floating-Point Values."""
+
+    operand_access = ('w', 'r')
+
+    forms = (
+        ('xmm, xmm/m128', '66 0F 10 /r'),
+        ('xmm/m128, xmm', '66 0F 11 /r'),
+    )
+
+
+class MOVDQU(Instruction):
+    """Move Unaligned Double Quadword."""
+
+    operand_access = ('w', 'r')
+
+    forms = (
+        ('xmm, xmm/m128', 'F3 0F 6F /r'),
+        ('xmm/m128, xmm', 'F3 0F 7F /r'),
+    )
+
+
+class VADDPS(Instruction):
+    """Add Packed Single-Precision Floating-Point Values (AVX)."""
+
+    operand_access = ('w', 'r', 'r')
+
+    forms = (
+        ('xmm, xmm, xmm/m128', 'VEX.128.0F.WIG 58 /r'),
+        ('ymm, ymm, ymm/m256', 'VEX.256.0F.WIG 58 /r'),
+    )
+
+
+class VADDPD(Instruction):
+    """Add Packed Double-Precision Floating-Point Values (AVX)."""
+
+    operand_access = ('w', 'r', 'r')
+
+    forms = (
+        ('xmm, xmm, xmm/m128', 'VEX.128.66.0F.WIG 58 /r'),
+        ('ymm, ymm, ymm/m256', 'VEX.256.66.0F.WIG 58 /r'),
+    )
+
+
+class VMULPS(Instruction):
+    """Multiply Packed Single-Precision Floating-Point Values (AVX)."""
+
+    operand_access = ('w', 'r', 'r')
+
+    forms = (
+        ('xmm, xmm, xmm/m128', 'VEX.128.0F.WIG 59 /r'),
+        ('ymm, ymm, ymm/m256', 'VEX.256.0F.WIG 59 /r'),
+    )
+
+
+class VMULPD(Instruction):
+    """Multiply Packed Double-Precision Floating-Point Values (AVX)."""
+
+    operand_access = ('w', 'r', 'r')
+
+    forms = (
+        ('xmm, xmm, xmm/m128', 'VEX.128.66.0F.WIG 59 /r'),
+        ('ymm, ymm, ymm/m256', 'VEX.256.66.0F.WIG 59 /r'),
+    )
+
+
+class VPADDD(Instruction):
+    """Add Packed Doubleword Integers (AVX, AVX2 for YMM)."""
+
+    operand_access = ('w', 'r', 'r')
+
+    forms = (
+        ('xmm, xmm, xmm/m128', 'VEX.128.66.0F.WIG FE /r'),
+        ('ymm, ymm, ymm/m256', 'VEX.256.66.0F.WIG FE /r'),
+    )
+
+
+class VPADDQ(Instruction):
+    """Add Packed Quadword Integers (AVX, AVX2 for YMM)."""
+
+    operand_access = ('w', 'r', 'r')
+
+    forms = (
+        ('xmm, xmm, xmm/m128', 'VEX.128.66.0F.WIG D4 /r'),
+        ('ymm, ymm, ymm/m256', 'VEX.256.66.0F.WIG D4 /r'),
+    )
+
+
+class VPMULLD(Instruction):
+    """Multiply Packed Dword Integers, Store Low Result (AVX, AVX2)."""
+
+    operand_access = ('w', 'r', 'r')
+
+    forms = (
+        ('xmm, xmm, xmm/m128', 'VEX.128.66.0F38.WIG 40 /r'),
+        ('ymm, ymm, ymm/m256', 'VEX.256.66.0F38.WIG 40 /r'),
+    )
+
+
+class VMOVUPS(Instruction):
+    """Move Unaligned Packed Single-Precision Values (AVX)."""
+
+    operand_access = ('w', 'r')
+
+    forms = (
+        ('xmm, xmm/m128', 'VEX.128.0F.WIG 10 /r'),
+        ('xmm/m128, xmm', 'VEX.128.0F.WIG 11 /r'),
+        ('ymm, ymm/m256', 'VEX.256.0F.WIG 10 /r'),
+        ('ymm/m256, ymm', 'VEX.256.0F.WIG 11 /r'),
+    )
+
+
+class VMOVUPD(Instruction):
+    """Move Unaligned Packed Double-Precision Values (AVX)."""
+
+    operand_access = ('w', 'r')
+
+    forms = (
+        ('xmm, xmm/m128', 'VEX.128.66.0F.WIG 10 /r'),
+        ('xmm/m128, xmm', 'VEX.128.66.0F.WIG 11 /r'),
+        ('ymm, ymm/m256', 'VEX.256.66.0F.WIG 10 /r'),
+        ('ymm/m256, ymm', 'VEX.256.66.0F.WIG 11 /r'),
+    )
+
+
+class VMOVDQU(Instruction):
+    """Move Unaligned Packed Integer Values (AVX)."""
+
+    operand_access = ('w', 'r')
+
+    forms = (
+        ('xmm, xmm/m128', 'VEX.128.F3.0F.WIG 6F /r'),
+        ('xmm/m128, xmm', 'VEX.128.F3.0F.WIG 7F /r'),
+        ('ymm, ymm/m256', 'VEX.256.F3.0F.WIG 6F /r'),
+        ('ymm/m256, ymm', 'VEX.256.F3.0F.WIG 7F /r'),
+    )
+
+
+class VBROADCASTSS(Instruction):
+    """Broadcast a Single-Precision Value (AVX, AVX2 for registers)."""
+
+    operand_access = ('w', 'r')
+
+    forms = (
+        ('xmm, xmm/m32', 'VEX.128.66.0F38.W0 18 /r'),
+        ('ymm, xmm/m32', 'VEX.256.66.0F38.W0 18 /r'),
+    )
+
+
+class VBROADCASTSD(Instruction):
+    """Broadcast a Double-Precision Value (AVX, AVX2 for registers)."""
+
+    operand_access = ('w', 'r')
+
+    forms = (
+        ('ymm, xmm/m64', 'VEX.256.66.0F38.W0 19 /r'),
+    )
+
+
+class VPBROADCASTD(Instruction):
+    """Broadcast a Doubleword Integer (AVX2)."""
+
+    operand_access = ('w', 'r')
+
+    forms = (
+        ('xmm, xmm/m32', 'VEX.128.66.0F38.W0 58 /r'),
+        ('ymm, xmm/m32', 'VEX.256.66.0F38.W0 58 /r'),
+    )
+
+
+class VPBROADCASTQ(Instruction):
+    """Broadcast a Quadword Integer (AVX2)."""
+
+    operand_access = ('w', 'r')
+
+    forms = (
+        ('xmm, xmm/m64', 'VEX.128.66.0F38.W0 59 /r'),
+        ('ymm, xmm/m64', 'VEX.256.66.0F38.W0 59 /r'),
+    )
@@ -0,0 +1,254 @@
+# coding: utf-8
+"""
+Liveness of flags and registers in x86 code.
+
+The analyses work on the lines accepted by
+:class:`~schnibble.arch.x86.assembler.Assembler`: tuples of an instruction
+class and its operands, and :class:`~schnibble.arch.x86.assembler.Label`
+objects. They go backwards over the lines and propagate what is live before
+each label to the branches that target it, repeating until nothing changes
+for code with loops. Flags and registers are bitmasks, the transfer function
+of each instruction is ``(live & ~writes) | reads``.
+
+Branches to anything but a label of the analyzed lines are assumed to use
+everything. Calls follow the System V AMD64 calling convention: they may
+read any register and they leave the status flags undefined.
+"""
+
+from __future__ import absolute_import, print_function
+
+from .assembler import Label
+from .flags import FlagSet, STATUS_FLAGS
+from .instructions import ADD, SUB, MOV, LEA
+from .operands import imm, mem32, mem64, reg
+from .registers import ALL_REGISTERS, GPR, RSP
+
+__all__ = ('dataflow', 'flag_liveness', 'register_liveness', 'prefer_lea')
+
+# Width of immediate values, they are sign-extended to the operand size
+_IMM_BITS = {'imm8': 8, 'imm16': 16, 'imm32': 32, 'simm8': 8}
+
+
+def dataflow(lines, use_def, live_out, unknown):
+    """
+    Compute what is live after each line.
+
+    :param lines:
+        Sequence of lines, see
+        :meth:`~schnibble.arch.x86.assembler.Assembler.extend()`.
+    :param use_def:
+        Function returning the masks ``(reads, writes)`` of an instruction
+        line.
+    :param live_out:
+        Mask of what is used after the last line and after returns.
+    :param unknown:
+        Mask of what is live at the targets of branches that are not labels
+        of ``lines``.
+    :returns:
+        Tuple ``(after, live_in)`` of the list of masks live after each
+        line and the dictionary of masks live at each label.
+
+    :func:`flag_liveness()` and :func:`register_liveness()` are built on
+    this analysis, other bitmasks work too.
+    """
+    labels = set(line for line in lines if isinstance(line, Label))
+    live_in = {}
+    after = [0] * len(lines)
+    while True:
+        changed = False
+        live = live_out
+        for index in xrange(len(lines) - 1, -1, -1):
+            line = lines[index]
+            if isinstance(line, Label):
+                after[index] = live
+                if live != live_in.get(line, 0):
+                    live_in[line] = live
+                    changed = True
+                continue
+            flow = line[0].control_flow
+            if flow == 'return':
+                live = live_out
+            elif flow == 'jump' or flow == 'branch':
+                target = line[1] if len(line) == 2 else None
+                if target in labels:
+                    target_live = live_in.get(target, 0)
+                else:
+                    target_live = unknown
+                if flow == 'jump':
+                    live = target_live
+                else:
+                    live |= target_live
+            after[index] = live
+            reads, writes = use_def(line)
+            live = (live & ~writes) | reads
+        if not changed:
+            return after, live_in
+
+
+def _flag_use_def(line):
+    instruction = line[0]
+    if instruction.control_flow == 'call':
+        return 0, STATUS_FLAGS
+    return instruction.flags_read, instruction.flags_written
+
+
+def flag_liveness(lines, live_out=FlagSet()):
+    """
+    Compute the flags live after each line.
+
+    :param lines:
+        Sequence of lines, see
+        :meth:`~schnibble.arch.x86.assembler.Assembler.extend()`.
+    :param live_out:
+        Flags used after the last line and after returns.
+    :returns:
+        List of :class:`~schnibble.arch.x86.flags.FlagSet`, one for each
+        line.
+    """
+    after, _ = dataflow(lines, _flag_use_def, live_out, STATUS_FLAGS)
+    return [FlagSet(live) for live in after]
+
+
+def _register_use_def(line):
+    instruction = line[0]
+    reads, writes = instruction.access(*line[1:])
+    if instruction.control_flow == 'call':
+        reads |= ALL_REGISTERS
+    return reads, writes
+
+
+def register_liveness(lines, live_out=0):
+    """
+    Compute the registers live after each line.
+
+    :param lines:
+        Sequence of lines, see
+        :meth:`~schnibble.arch.x86.assembler.Assembler.extend()`.
+    :param live_out:
+        Mask of registers used after the last line and after returns, see
+        :attr:`~schnibble.arch.x86.operands.reg.mask`.
+    :returns:
+        List of register masks, one for each line.
+    """
+    after, _ = dataflow(lines, _register_use_def, live_out, ALL_REGISTERS)
+    return after
+
+
+def _is_gpr(op):
+    return isinstance(op, reg) and op.width in (32, 64)
+
+
+def _displacement(op, negate):
+    """Get an immediate value as a displacement, or None."""
+    bits = _IMM_BITS[op.kind]
+    value = op.value & ((1 << bits) - 1)
+    if value >> (bits - 1):
+        value -= 1 << bits
+    if negate:
+        value = -value
+    if not -0x80000000 <= value <= 0x7FFFFFFF:
+        return None
+    return value
+
+
+def _address(dst, base, index=None, disp=0):
+    """Build the LEA of ``dst`` for ``base + index + disp``."""
+    if (base.width != dst.width
+            or (index is not None and index.width != dst.width)):
+        return None
+    # The address is computed with 64-bit registers, LEA truncates it
+    memory = mem64 if dst.width == 64 else mem32
+    base = GPR[64][base.number]
+    if index is not None:
+        index = GPR[64][index.number]
+        if index is RSP:
+            # RSP cannot be an index
+            base, index = index, base
+    try:
+        return (LEA, dst, memory(base, index, 1, disp))
+    except ValueError:
+        return None
+
+
+def _sum(line):
+    """
+    Describe an addition of a register and a register or an immediate.
+
+    :returns:
+        Tuple ``(dst, index, disp)`` or None.
+    """
+    instruction, operands = line[0], line[1:]
+    if (instruction not in (ADD, SUB) or len(operands) != 2
+            or not _is_gpr(operands[0])):
+        return None
+    dst, src = operands
+    if isinstance(src, imm):
+        disp = _displacement(src, instruction is SUB)
+        if disp is None:
+            return None
+        return dst, None, disp
+    if instruction is ADD and _is_gpr(src) and src.width == dst.width:
+        return dst, src, 0
+    return None
+
+
+def _size(line):
+    form = line[0].find_form(line[1:])
+    return form.layout(line[1:])[0]
+
+
+def prefer_lea(lines, live_out=FlagSet()):
+    """
+    Replace additions by LEA where the flags they set are not used.
+
+    :param lines:
+        Sequence of lines, see
+        :meth:`~schnibble.arch.x86.assembler.Assembler.extend()`.
+    :param live_out:
+        Flags used after the last line and after returns.
+    :returns:
+        New list of lines.
+
+    ``MOV d, a`` followed by ``ADD d, b`` (or ``ADD``/``SUB`` of an
+    immediate) becomes ``LEA d, [a + b]``. A lone ``ADD d, b`` becomes
+    ``LEA d, [d + b]`` when the encoding is shorter, for example for small
+    immediates. Only 32-bit and 64-bit registers are rewritten, the
+    addition is computed in 64 bits and truncated like ADD does.
+    """
+    lines = list(lines)
+    live = flag_liveness(lines, live_out)
+    result = []
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        if isinstance(line, Label):
+            result.append(line)
+            index += 1
+            continue
+        if index + 1 < len(lines) and not live[index + 1] & STATUS_FLAGS:
+            # MOV d, a; ADD d, b
+            following = lines[index + 1]
+            total = (not isinstance(following, Label)
+                     and _sum(following))
+            if (total and line[0] is MOV and len(line) == 3
+                    and line[1] is total[0] and _is_gpr(line[2])):
+                dst, index_reg, disp = total
+                if index_reg is dst:
+                    # d is still a when it is added to itself
+                    index_reg = line[2]
+                fused = _address(dst, line[2], index_reg, disp)
+                if fused is not None:
+                    result.append(fused)
+                    index += 2
+                    continue
+        total = _sum(line)
+        if total and not live[index] & STATUS_FLAGS:
+            dst, index_reg, disp = total
+            replacement = _address(dst, dst, index_reg, disp)
+            if replacement is not None and _size(replacement) < _size(line):
+                result.append(replacement)
+                index += 1
+                continue
+        result.append(line)
+        index += 1
+    return result
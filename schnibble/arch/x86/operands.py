@@ -3,13 +3,38 @@
 
 from __future__ import absolute_import, print_function
 
-__all__ = ('imm8', 'imm16', 'imm32', 'reg', 'reg8', 'reg16', 'reg32', 'reg64')
+import struct
 
+from .special import encode_address
 
-class imm8(object):
+__all__ = ('imm', 'imm8', 'imm16', 'imm32', 'imm64', 'simm8', 'rel8', 'rel32',
+           'reg', 'reg8', 'reg16', 'reg32', 'reg64', 'reg128', 'reg256', 'mem',
+           'mem8', 'mem16', 'mem32', 'mem64', 'mem128', 'mem256')
+
+_INT8 = struct.Struct('<b')
+_UINT8 = struct.Struct('<B')
+_UINT16 = struct.Struct('<H')
+_UINT32 = struct.Struct('<I')
+_UINT64 = struct.Struct('<Q')
+
+
+class imm(object):
+
+    """Base class for immediate values."""
+
+    # Immediate values don't use registers, see reg
+    mask = write_mask = address_mask = 0
+
+    def __repr__(self):
+        return "{}({:#x})".format(self.__class__.__name__, self.value)
+
+
+class imm8(imm):
 
     """Immediate 8-bit value."""
 
+    kind = 'imm8'
+
     def __init__(self, value):
         if 0 > value > 0xFF:
             raise ValueError("value too large for 8-bit immediate")
@@ -17,10 +42,14 @@ class imm8(object):
 
     @property
     def bytes(self):
-        return bytearray([self.value])
+        return bytearray(_UINT8.pack(self.value & 0xFF))
+
+
+class imm16(imm):
 
+    """Immediate 16-bit value."""
 
-class imm16(object):
+    kind = 'imm16'
 
     def __init__(self, value):
         if 0 > value > 0xFFFF:
@@ -29,13 +58,14 @@ class imm16(object):
 
     @property
     def bytes(self):
-        return bytearray([
-            self.value & 0xFF,
-            (self.value >> 8) & 0xFF,
-        ])
+        return bytearray(_UINT16.pack(self.value & 0xFFFF))
 
 
-class imm32(object):
+class imm32(imm):
+
+    """Immediate 32-bit value."""
+
+    kind = 'imm32'
 
     def __init__(self, value):
         if 0 > value > 0xFFFFFFFFL:
@@ -44,15 +74,14 @@ class imm32(object):
 
     @property
     def bytes(self):
-        return bytearray([
-            self.value & 0xFF,
-            (self.value >> 8) & 0xFF,
-            (self.value >> 16) & 0xFF,
-            (self.value >> 24) & 0xFF,
-        ])
+        return bytearray(_UINT32.pack(self.value & 0xFFFFFFFF))
+
 
+class imm64(imm):
 
-class imm64(object):
+    """Immediate 64-bit value."""
+
+    kind = 'imm64'
 
     def __init__(self, value):
         if 0 > value > 0xFFFFFFFFFFFFFFFFL:
@@ -61,38 +90,132 @@ class imm64(object):
 
     @property
     def bytes(self):
-        return bytearray([
-            self.value & 0xFF,
-            (self.value >> 8) & 0xFF,
-            (self.value >> 16) & 0xFF,
-            (self.value >> 24) & 0xFF,
-            (self.value >> 32) & 0xFF,
-            (self.value >> 40) & 0xFF,
-            (self.value >> 48) & 0xFF,
-            (self.value >> 56) & 0xFF,
-        ])
+        return bytearray(_UINT64.pack(self.value & 0xFFFFFFFFFFFFFFFF))
+
+
+class simm8(imm):
+
+    """Signed 8-bit value, sign-extended to the size of the other operand."""
+
+    kind = 'simm8'
+
+    def __init__(self, value):
+        if not -0x80 <= value <= 0x7F:
+            raise ValueError("value out of range for signed 8-bit immediate")
+        self.value = value
+
+    @property
+    def bytes(self):
+        return bytearray(_INT8.pack(self.value))
+
+    def __repr__(self):
+        return "simm8({})".format(self.value)
+
+
+class rel8(imm8):
+
+    """Signed 8-bit displacement, relative to the next instruction."""
+
+    kind = 'rel8'
+
+    def __repr__(self):
+        return "rel8({})".format(self.value)
+
+
+class rel32(imm32):
+
+    """Signed 32-bit displacement, relative to the next instruction."""
+
+    kind = 'rel32'
+
+    def __repr__(self):
+        return "rel32({})".format(self.value)
+
+
+#: Kinds of register number 0 of each width, used by short encodings
+_ACCUMULATORS = {8: 'AL', 16: 'AX', 32: 'EAX', 64: 'RAX'}
+#: Kinds of the vector registers of each width
+_VECTOR_KINDS = {128: 'xmm', 256: 'ymm'}
+
+# Each general purpose register has four bits in register masks, for bits
+# 0-7, 8-15, 16-31 and 32-63 of its value.
+_LANES = {8: 0x1, 16: 0x3, 32: 0x7, 64: 0xF}
+_HIGH_BYTE = 0x2
 
 
 class reg(object):
 
-    """Operand is a register."""
+    """
+    Operand is a register.
+
+    :attribute number:
+        Number of the register in instruction encodings (0 - 15).
+    :attribute kind:
+        Kind of the operand in encoding tables, ``'r8'``, ``'r16'``,
+        ``'r32'`` or ``'r64'`` except for the accumulator (register number
+        0) which has its own kind. Vector registers are ``'xmm'`` and
+        ``'ymm'``.
+    :attribute rex_required:
+        True for SPL, BPL, SIL and DIL which share numbers with AH, CH, DH
+        and BH and are selected by the presence of a REX prefix.
+    :attribute mask:
+        Bits of the register file occupied by the register. Registers
+        overlap when their masks have common bits, AL and AH don't overlap
+        but both overlap AX, EAX and RAX. Vector registers are not part
+        of register masks, their mask is zero.
+    :attribute write_mask:
+        Bits of the register file modified by writing the register. This is
+        the whole 64-bit register for 32-bit registers, which are
+        zero-extended.
+    :attribute address_mask:
+        Registers used to compute the address of an operand, always zero
+        for registers.
+    """
+
+    address_mask = 0
 
     def __init__(self, name, width, plus_rb=None, plus_rw=None, plus_rd=None,
-                 plus_rq=None):
+                 plus_rq=None, rex_required=False, number=None):
         self.name = name
+        self.rex_required = rex_required
         self.width = width
         self.plus_rb = plus_rb
         self.plug_rw = plus_rw
         self.plus_rd = plus_rd
         self.plus_rq = plus_rq
+        if number is None:
+            number = [n for n in (plus_rb, plus_rw, plus_rd, plus_rq)
+                      if n is not None][0]
+        self.number = number
+        if width in _VECTOR_KINDS:
+            self.kind = _VECTOR_KINDS[width]
+        elif self.number == 0:
+            self.kind = _ACCUMULATORS[width]
+        else:
+            self.kind = 'r{}'.format(width)
+        if width in _VECTOR_KINDS:
+            self.mask = 0
+        elif width == 8 and 4 <= self.number < 8 and not rex_required:
+            # AH, CH, DH and BH
+            self.mask = _HIGH_BYTE << (4 * (self.number - 4))
+        else:
+            self.mask = _LANES[width] << (4 * self.number)
+        if width == 32:
+            self.write_mask = _LANES[64] << (4 * self.number)
+        else:
+            self.write_mask = self.mask
+
+    def __repr__(self):
+        return self.name
 
 
 class reg8(reg):
 
     """Operand is an 8 bit register."""
 
-    def __init__(self, name, plus_rb):
-        super(reg8, self).__init__(name, 8, plus_rb=plus_rb)
+    def __init__(self, name, plus_rb, rex_required=False):
+        super(reg8, self).__init__(
+            name, 8, plus_rb=plus_rb, rex_required=rex_required)
 
 
 class reg16(reg):
@@ -116,3 +239,156 @@ class reg64(reg):
 
     def __init__(self, name, plus_rq):
         super(reg64, self).__init__(name, 64, plus_rq=plus_rq)
+
+
+class reg128(reg):
+
+    """Operand is a 128-bit vector register (XMM)."""
+
+    def __init__(self, name, number):
+        super(reg128, self).__init__(name, 128, number=number)
+
+
+class reg256(reg):
+
+    """Operand is a 256-bit vector register (YMM)."""
+
+    def __init__(self, name, number):
+        super(reg256, self).__init__(name, 256, number=number)
+
+
+_PTR = {8: 'BYTE', 16: 'WORD', 32: 'DWORD', 64: 'QWORD', 128: 'XMMWORD',
+        256: 'YMMWORD'}
+
+
+class mem(object):
+
+    """
+    Operand is a memory location, ``[base + index * scale + disp]``.
+
+    The ModRM, SIB and displacement bytes are computed once, when the
+    operand is created, using the shortest encoding of the address.
+
+    :attribute rex:
+        REX.X and REX.B bits needed by the address.
+    :attribute modrm:
+        ModRM byte with a zero reg field.
+    :attribute tail:
+        SIB byte, if any, and displacement.
+    :attribute address_mask:
+        Register mask of the base and index registers.
+    """
+
+    # Memory is not part of the register file, see reg
+    mask = write_mask = 0
+
+    def __init__(self, width, base=None, index=None, scale=1, disp=0,
+                 rip_relative=False):
+        """
+        Initialize a memory operand.
+
+        :param width:
+            Size of the accessed value, in bits.
+        :param base:
+            Base register (a :class:`reg64`) or None.
+        :param index:
+            Index register (a :class:`reg64`) or None.
+        :param scale:
+            Multiplier of the index, 1, 2, 4 or 8.
+        :param disp:
+            Signed 32-bit displacement.
+        :param rip_relative:
+            Address relative to the next instruction, ``[RIP + disp]``. The
+            base and the index must be None.
+        :raises ValueError:
+            If the address cannot be encoded.
+        """
+        for register in (base, index):
+            if register is not None and not isinstance(register, reg64):
+                raise ValueError(
+                    "address registers must be 64-bit: {!r}".format(register))
+        self.width = width
+        self.kind = 'm{}'.format(width)
+        self.base = base
+        self.index = index
+        self.scale = scale
+        self.disp = disp
+        self.rip_relative = rip_relative
+        self.address_mask = 0
+        for register in (base, index):
+            if register is not None:
+                self.address_mask |= register.mask
+        self.rex, self.modrm, self.tail = encode_address(
+            None if base is None else base.number,
+            None if index is None else index.number, scale, disp,
+            rip_relative)
+
+    def __repr__(self):
+        parts = ['RIP'] if self.rip_relative else []
+        if self.base is not None:
+            parts.append(self.base.name)
+        if self.index is not None:
+            parts.append('{}*{}'.format(self.index.name, self.scale))
+        if self.disp or not parts:
+            parts.append(str(self.disp))
+        return "{} [{}]".format(_PTR[self.width], '+'.join(parts))
+
+
+class mem8(mem):
+
+    """Operand is an 8-bit memory location."""
+
+    def __init__(self, base=None, index=None, scale=1, disp=0,
+                 rip_relative=False):
+        super(mem8, self).__init__(
+            8, base, index, scale, disp, rip_relative)
+
+
+class mem16(mem):
+
+    """Operand is a 16-bit memory location."""
+
+    def __init__(self, base=None, index=None, scale=1, disp=0,
+                 rip_relative=False):
+        super(mem16, self).__init__(
+            16, base, index, scale, disp, rip_relative)
+
+
+class mem32(mem):
+
+    """Operand is a 32-bit memory location."""
+
+    def __init__(self, base=None, index=None, scale=1, disp=0,
+                 rip_relative=False):
+        super(mem32, self).__init__(
+            32, base, index, scale, disp, rip_relative)
+
+
+class mem64(mem):
+
+    """Operand is a 64-bit memory location."""
+
+    def __init__(self, base=None, index=None, scale=1, disp=0,
+                 rip_relative=False):
+        super(mem64, self).__init__(
+            64, base, index, scale, disp, rip_relative)
+
+
+class mem128(mem):
+
+    """Operand is a 128-bit memory location."""
+
+    def __init__(self, base=None, index=None, scale=1, disp=0,
+                 rip_relative=False):
+        super(mem128, self).__init__(
+            128, base, index, scale, disp, rip_relative)
+
+
+class mem256(mem):
+
+    """Operand is a 256-bit memory location."""
+
+    def __init__(self, base=None, index=None, scale=1, disp=0,
+                 rip_relative=False):
+        super(mem256, self).__init__(
+            256, base, index, scale, disp, rip_relative)
@@ -0,0 +1,224 @@
+# coding: utf-8
+"""
+Peephole optimizer.
+
+:func:`optimize` rewrites the lines accepted by
+:class:`~schnibble.arch.x86.assembler.Assembler` into equivalent, shorter
+code. It relies on :mod:`~schnibble.arch.x86.liveness` to know which flags
+and registers are used later, so that it doesn't need to preserve anything
+else:
+
+``'dead-move'``
+    ``MOV r, x`` is dropped when ``r`` is not used afterwards.
+``'redundant-move'``
+    ``MOV r, r`` and ``MOV a, b`` right after ``MOV b, a`` are dropped,
+    except for 32-bit registers which are zero-extended by MOV.
+``'zero'``
+    ``MOV r, 0`` becomes ``XOR r, r`` when the flags are not used.
+``'fold'``
+    Consecutive additions and subtractions of immediate values to the same
+    register are combined when the flags are not used.
+``'shorter'``
+    Immediate values use the shortest encoding, see :func:`shortest()`.
+
+Every rewrite is reported with a :class:`Rewrite`.
+"""
+
+from __future__ import absolute_import, print_function
+
+import collections
+
+from .assembler import Label
+from .flags import FlagSet, STATUS_FLAGS
+from .instructions import ADD, SUB, XOR, MOV
+from .liveness import flag_liveness, register_liveness
+from .operands import imm8, imm16, imm32, simm8, reg
+from .registers import ALL_REGISTERS, GPR
+
+__all__ = ('Rewrite', 'shortest', 'optimize')
+
+#: One change made by :func:`optimize()`.
+#:
+#: ``rule`` names the rewrite, ``index`` is the index of the first line it
+#: replaces in the input, ``before`` and ``after`` are tuples of the
+#: original and new lines.
+Rewrite = collections.namedtuple('Rewrite', 'rule index before after')
+
+_IMM_BITS = {'imm8': 8, 'imm16': 16, 'imm32': 32, 'imm64': 64, 'simm8': 8}
+# Immediate operand of additions to registers of each width
+_ADDEND = {8: (imm8, 8), 16: (imm16, 16), 32: (imm32, 32), 64: (imm32, 32)}
+# Instructions with a sign-extended 8-bit immediate form
+_IMM8_FORMS = (ADD, SUB, XOR)
+
+
+def _signed(value, bits):
+    value &= (1 << bits) - 1
+    if value >> (bits - 1):
+        value -= 1 << bits
+    return value
+
+
+def _size(line):
+    return line[0].find_form(line[1:]).layout(line[1:])[0]
+
+
+def _immediate(line):
+    """Get the signed value of an immediate second operand, or None."""
+    if len(line) != 3 or line[2].kind not in _IMM_BITS:
+        return None
+    return _signed(line[2].value, _IMM_BITS[line[2].kind])
+
+
+def shortest(line):
+    """
+    Find the shortest encoding of an instruction.
+
+    :param line:
+        Tuple of an instruction class and its operands.
+    :returns:
+        An equivalent line, ``line`` itself if there is nothing shorter.
+
+    Immediate values that fit in a signed byte use the sign-extended
+    ``simm8`` forms of ADD, SUB and XOR. ``MOV r64, imm64`` uses a 32-bit
+    immediate if it fits, either zero-extended by a move to the 32-bit
+    register or sign-extended by the ``r/m64, imm32`` form.
+    """
+    value = _immediate(line)
+    if value is None:
+        return line
+    instruction, dst = line[0], line[1]
+    candidate = None
+    if instruction in _IMM8_FORMS:
+        if (line[2].kind != 'simm8' and dst.width != 8
+                and -0x80 <= value <= 0x7F):
+            candidate = (instruction, dst, simm8(value))
+    elif instruction is MOV and isinstance(dst, reg) and dst.width == 64:
+        if 0 <= value <= 0xFFFFFFFF:
+            candidate = (MOV, GPR[32][dst.number], imm32(value))
+        elif -0x80000000 <= value <= 0x7FFFFFFF:
+            candidate = (MOV, dst, imm32(value & 0xFFFFFFFF))
+    if candidate is not None and _size(candidate) < _size(line):
+        return candidate
+    return line
+
+
+def _dead_move(lines, index, flags, registers, result):
+    line = lines[index]
+    if (line[0] is MOV and isinstance(line[1], reg)
+            and not line[1].write_mask & registers[index]):
+        return 1, ()
+    return None
+
+
+def _redundant_move(lines, index, flags, registers, result):
+    line = lines[index]
+    if (line[0] is not MOV or not isinstance(line[1], reg)
+            or not isinstance(line[2], reg) or line[1].width == 32):
+        return None
+    dst, src = line[1:]
+    if dst is src or (result and result[-1] == (MOV, src, dst)):
+        return 1, ()
+    return None
+
+
+def _zero(lines, index, flags, registers, result):
+    line = lines[index]
+    if (line[0] is MOV and isinstance(line[1], reg)
+            and line[1].width in (16, 32, 64) and _immediate(line) == 0
+            and not flags[index] & STATUS_FLAGS):
+        dst = line[1]
+        if dst.width == 64:
+            # Writing the 32-bit register clears the upper half
+            dst = GPR[32][dst.number]
+        return 1, ((XOR, dst, dst),)
+    return None
+
+
+def _addend(line):
+    """Get the register and the value added by a line, or None."""
+    if isinstance(line, Label) or line[0] not in (ADD, SUB):
+        return None
+    value = _immediate(line)
+    if value is None or not isinstance(line[1], reg):
+        return None
+    return line[1], -value if line[0] is SUB else value
+
+
+def _fold(lines, index, flags, registers, result):
+    addend = _addend(lines[index])
+    if addend is None:
+        return None
+    dst, total = addend
+    end = index + 1
+    while end < len(lines):
+        addend = _addend(lines[end])
+        if addend is None or addend[0] is not dst:
+            break
+        total += addend[1]
+        end += 1
+    # The carry and the overflow differ from the ones of the last addition
+    if end == index + 1 or flags[end - 1] & STATUS_FLAGS:
+        return None
+    total = _signed(total, dst.width)
+    if total == 0 and dst.width != 32:
+        return end - index, ()
+    operand, bits = _ADDEND[dst.width]
+    if _signed(total, bits) != total:
+        return None
+    return end - index, ((ADD, dst, operand(total & ((1 << bits) - 1))),)
+
+
+_RULES = (
+    ('dead-move', _dead_move),
+    ('redundant-move', _redundant_move),
+    ('zero', _zero),
+    ('fold', _fold),
+)
+
+
+def optimize(lines, live_flags=FlagSet(), live_registers=ALL_REGISTERS):
+    """
+    Optimize a sequence of instructions.
+
+    :param lines:
+        Sequence of lines, see
+        :meth:`~schnibble.arch.x86.assembler.Assembler.extend()`.
+    :param live_flags:
+        Flags used after the last line and after returns.
+    :param live_registers:
+        Mask of registers used after the last line and after returns, for
+        example the registers holding return values.
+    :returns:
+        Tuple ``(lines, rewrites)`` of the new list of lines and the list
+        of :class:`Rewrite` applied, in order.
+    """
+    lines = list(lines)
+    flags = flag_liveness(lines, live_flags)
+    registers = register_liveness(lines, live_registers)
+    result = []
+    rewrites = []
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        if isinstance(line, Label) or (
+                len(line) == 2 and isinstance(line[1], Label)):
+            result.append(line)
+            index += 1
+            continue
+        for rule, function in _RULES:
+            change = function(lines, index, flags, registers, result)
+            if change is not None:
+                count, replacement = change
+                rewrites.append(Rewrite(
+                    rule, index, tuple(lines[index:index + count]),
+                    replacement))
+                break
+        else:
+            count, replacement = 1, (line,)
+        for new in replacement:
+            short = shortest(new)
+            if short is not new:
+                rewrites.append(Rewrite('shorter', index, (new,), (short,)))
+            result.append(short)
+        index += count
+    return result, rewrites
@@ -0,0 +1,408 @@
+# coding: utf-8
+"""
+Register allocation.
+
+Code may use virtual registers, :class:`vreg` operands, wherever an
+instruction takes a register operand. :func:`allocate()` replaces them with
+general purpose registers using the linear scan algorithm of Poletto and
+Sarkar:
+
+* The live interval of each virtual register goes from its first to its
+  last use, extended over the loops it is live in. It is computed with the
+  backward :func:`~schnibble.arch.x86.liveness.dataflow` analysis.
+* Physical registers used by the code itself, including the ones clobbered
+  by calls, are unavailable while they are live.
+* Intervals are visited by increasing start. Each one takes a free register
+  or, when none is left, the interval ending last is spilled to a stack
+  slot.
+* Spilled registers are used straight from memory when the instruction has
+  such an encoding. Otherwise a scratch register is loaded before the
+  instruction and stored after it.
+
+Apart from the dataflow, allocation takes time linear in the number of
+lines. Virtual registers cannot be used in memory addresses.
+"""
+
+from __future__ import absolute_import, print_function
+
+import bisect
+import collections
+import heapq
+
+from .assembler import Label
+from .instructions import MOV
+from .liveness import dataflow
+from .operands import mem8, mem16, mem32, mem64, reg
+from .registers import (
+    RAX, RCX, RDX, RSI, RDI, R8, R9, R10, R11, RSP, ALL_REGISTERS, GPR,
+    GPR8_REX)
+
+__all__ = ('vreg', 'Allocation', 'CALLER_SAVED', 'allocate')
+
+#: Registers that calls may modify, the default registers for allocation
+CALLER_SAVED = (RAX, RCX, RDX, RSI, RDI, R8, R9, R10, R11)
+
+#: Result of :func:`allocate()`.
+#:
+#: ``lines`` has the code with physical registers, ``registers`` maps
+#: virtual registers to physical registers, ``slots`` maps spilled virtual
+#: registers to their memory operands and ``frame_size`` is the number of
+#: bytes of stack slots.
+Allocation = collections.namedtuple(
+    'Allocation', 'lines registers slots frame_size')
+
+# Registers holding arguments of calls
+_ARGUMENTS = RDI.mask | RSI.mask | RDX.mask | RCX.mask | R8.mask | R9.mask
+_CLOBBERED = sum(register.mask for register in CALLER_SAVED)
+_REGISTERS = {8: GPR8_REX, 16: GPR[16], 32: GPR[32], 64: GPR[64]}
+_MEMORY = {8: mem8, 16: mem16, 32: mem32, 64: mem64}
+_SLOT_SIZE = 8
+
+
+class vreg(object):
+
+    """Operand is a virtual register."""
+
+    # Virtual registers are not part of the register file, see reg
+    mask = write_mask = address_mask = 0
+
+    def __init__(self, width=64, name=None):
+        """
+        Initialize a virtual register.
+
+        :param width:
+            Width of the register, 8, 16, 32 or 64 bits.
+        :param name:
+            Name of the register, only used in representations.
+        """
+        if width not in _REGISTERS:
+            raise ValueError("unsupported width: {}".format(width))
+        self.width = width
+        self.name = name
+
+    def __repr__(self):
+        if self.name is None:
+            return "vreg({})".format(self.width)
+        return "vreg({}, {!r})".format(self.width, self.name)
+
+
+class _Interval(object):
+    """Range of gaps between lines where a virtual register is live."""
+
+    __slots__ = ('vreg', 'index', 'start', 'end', 'hint', 'register')
+
+    def __init__(self, vreg, index, start):
+        self.vreg = vreg
+        # Order of the first use, to break ties
+        self.index = index
+        self.start = self.end = start
+        # Number of a register the value is moved from or to
+        self.hint = None
+        self.register = None
+
+
+def _physical_use_def(line):
+    instruction = line[0]
+    reads, writes = instruction.access(*line[1:])
+    if instruction.control_flow == 'call':
+        reads |= _ARGUMENTS
+        writes |= _CLOBBERED
+    return reads, writes
+
+
+def _intervals(lines):
+    """Compute the live interval of each virtual register."""
+    intervals = collections.OrderedDict()
+    bits = {}
+    for index, line in enumerate(lines):
+        if isinstance(line, Label):
+            continue
+        for op in line[1:]:
+            if isinstance(op, vreg):
+                interval = intervals.get(op)
+                if interval is None:
+                    interval = intervals[op] = _Interval(
+                        op, len(intervals), index)
+                    bits[op] = 1 << len(bits)
+                interval.end = index
+        if line[0] is MOV and len(line) == 3:
+            dst, src = line[1:]
+            if isinstance(dst, vreg) and isinstance(src, reg):
+                interval = intervals[dst]
+            elif isinstance(src, vreg) and isinstance(dst, reg):
+                interval, src = intervals[src], dst
+            else:
+                interval = None
+            if interval is not None and interval.hint is None:
+                interval.hint = src.number
+
+    def use_def(line):
+        reads = writes = 0
+        for op, mode in zip(line[1:], line[0].operand_access):
+            bit = bits.get(op, 0) if isinstance(op, vreg) else 0
+            if mode != 'w':
+                reads |= bit
+            if mode != 'r':
+                writes |= bit
+        return reads, writes
+
+    # Values live at a label are live at the branches to it as well
+    _, live_in = dataflow(lines, use_def, 0, 0)
+    if any(live_in.itervalues()):
+        spans = {}
+        for index, line in enumerate(lines):
+            if isinstance(line, Label):
+                target = line
+            elif len(line) == 2 and isinstance(line[1], Label):
+                target = line[1]
+            else:
+                continue
+            low, high = spans.get(target, (index, index))
+            spans[target] = min(low, index), max(high, index)
+        by_bit = dict((bit, intervals[op]) for op, bit in bits.iteritems())
+        for label, live in live_in.iteritems():
+            low, high = spans[label]
+            while live:
+                bit = live & -live
+                live ^= bit
+                interval = by_bit[bit]
+                interval.start = min(interval.start, low)
+                interval.end = max(interval.end, high)
+    # A value is stored in the gaps after its definition and before its last
+    # use, each gap is numbered after the line before it.
+    for interval in intervals.itervalues():
+        interval.end = max(interval.end - 1, interval.start)
+    return intervals
+
+
+def _busy(lines, registers, live_out):
+    """Find the gaps where physical registers are used by the code."""
+    after, _ = dataflow(lines, _physical_use_def, live_out, ALL_REGISTERS)
+    segments = dict((register, []) for register in registers)
+    for index, line in enumerate(lines):
+        busy = after[index]
+        if not isinstance(line, Label):
+            busy |= _physical_use_def(line)[1]
+        if not busy:
+            continue
+        for register in registers:
+            if busy & register.mask:
+                spans = segments[register]
+                if spans and spans[-1][1] == index - 1:
+                    spans[-1][1] = index
+                else:
+                    spans.append([index, index])
+    return segments
+
+
+def _scan(intervals, registers, segments, size):
+    """Assign registers to intervals, returning the spilled ones."""
+    by_start = [[] for _ in xrange(size)]
+    for interval in intervals.itervalues():
+        by_start[interval.start].append(interval)
+    # Position of the first segment that may still overlap an interval
+    cursors = dict((register, 0) for register in registers)
+    numbers = dict((register.number, register) for register in registers)
+    free = list(registers)
+    active = []
+    spilled = []
+
+    def fits(register, interval):
+        spans = segments[register]
+        i = cursors[register]
+        while i < len(spans) and spans[i][1] < interval.start:
+            i += 1
+        cursors[register] = i
+        return i == len(spans) or spans[i][0] > interval.end
+
+    for bucket in by_start:
+        for interval in bucket:
+            while active and active[0][0] < interval.start:
+                free.append(heapq.heappop(active)[-1].register)
+            hint = numbers.get(interval.hint)
+            if hint in free and fits(hint, interval):
+                choice = hint
+            else:
+                choice = None
+                for register in registers:
+                    if register in free and fits(register, interval):
+                        choice = register
+                        break
+            if choice is not None:
+                free.remove(choice)
+                interval.register = choice
+                heapq.heappush(
+                    active, (interval.end, interval.index, interval))
+                continue
+            # Spill the interval that ends last
+            victims = [
+                other for end, _, other in active
+                if end > interval.end and fits(other.register, interval)]
+            if not victims:
+                spilled.append(interval)
+                continue
+            victim = max(victims, key=lambda other: (other.end, other.index))
+            active.remove((victim.end, victim.index, victim))
+            heapq.heapify(active)
+            interval.register, victim.register = victim.register, None
+            spilled.append(victim)
+            heapq.heappush(active, (interval.end, interval.index, interval))
+    return spilled
+
+
+def _assign_slots(spilled):
+    """Give stack slots to spilled intervals, reusing expired ones."""
+    spilled.sort(key=lambda interval: interval.start)
+    slots = {}
+    free = []
+    active = []
+    count = 0
+    for interval in spilled:
+        while active and active[0][0] < interval.start:
+            heapq.heappush(free, heapq.heappop(active)[1])
+        if free:
+            slot = heapq.heappop(free)
+        else:
+            slot, count = count, count + 1
+        heapq.heappush(active, (interval.end, slot))
+        slots[interval.vreg] = _MEMORY[interval.vreg.width](
+            RSP, disp=slot * _SLOT_SIZE)
+    return slots, count * _SLOT_SIZE
+
+
+def _encodable(line):
+    try:
+        line[0].find_form(line[1:])
+    except ValueError:
+        return False
+    return True
+
+
+def _needs_scratch(line, spilled):
+    """Check whether spilled values of a line cannot stay in memory."""
+    if not any(op in spilled for op in line[1:]):
+        return False
+    operands = []
+    for op in line[1:]:
+        if op in spilled:
+            operands.append(_MEMORY[op.width](RSP))
+        elif isinstance(op, vreg):
+            operands.append(_REGISTERS[op.width][1])
+        else:
+            operands.append(op)
+    return not _encodable((line[0],) + tuple(operands))
+
+
+def _available(spans, positions):
+    """Check whether a register is free around the given lines."""
+    starts = [span[0] for span in spans]
+    for index in positions:
+        i = bisect.bisect_right(starts, index) - 1
+        if i >= 0 and spans[i][1] >= index - 1:
+            return False
+    return True
+
+
+def _rewrite(line, registers, slots, scratch):
+    """Replace virtual registers, adding spill code around the line."""
+    operands = list(line[1:])
+    spilled = []
+    for i, op in enumerate(operands):
+        if isinstance(op, vreg):
+            if op in registers:
+                operands[i] = registers[op]
+            else:
+                operands[i] = slots[op]
+                spilled.append(i)
+    new = (line[0],) + tuple(operands)
+    if not spilled or _encodable(new):
+        return [new]
+    if scratch is None:
+        raise ValueError("no scratch register for {!r}".format(line))
+    for i in spilled:
+        op = line[1 + i]
+        register = _REGISTERS[op.width][scratch.number]
+        candidate = list(operands)
+        candidate[i] = register
+        candidate = (line[0],) + tuple(candidate)
+        if _encodable(candidate):
+            mode = line[0].operand_access[i]
+            result = []
+            if mode != 'w':
+                result.append((MOV, register, slots[op]))
+            result.append(candidate)
+            if mode != 'r':
+                result.append((MOV, slots[op], register))
+            return result
+    raise ValueError("don't know how to encode: {!r}".format(line))
+
+
+def allocate(lines, registers=CALLER_SAVED, live_out=RAX.mask):
+    """
+    Allocate registers to virtual registers.
+
+    :param lines:
+        Sequence of lines, see
+        :meth:`~schnibble.arch.x86.assembler.Assembler.extend()`, with
+        :class:`vreg` operands.
+    :param registers:
+        64-bit registers available for allocation, in order of preference.
+        Callee-saved registers must be saved by the caller if they are used.
+    :param live_out:
+        Mask of physical registers used after the last line and after
+        returns, see :attr:`~schnibble.arch.x86.operands.reg.mask`.
+    :returns:
+        An :class:`Allocation`. Spilled registers are stored at
+        ``[RSP + offset]``, the caller must reserve ``frame_size`` bytes of
+        stack and not move RSP while they are live.
+    :raises ValueError:
+        If the code cannot be encoded with the available registers.
+    """
+    lines = list(lines)
+    registers = [register for register in registers if register is not RSP]
+    segments = _busy(lines, registers, live_out)
+    intervals = _intervals(lines)
+    scratch = None
+    while True:
+        for interval in intervals.itervalues():
+            interval.register = None
+        spilled = _scan(intervals, registers, segments, len(lines))
+        values = set(interval.vreg for interval in spilled)
+        needed = [index for index, line in enumerate(lines)
+                  if not isinstance(line, Label)
+                  and _needs_scratch(line, values)]
+        if not needed:
+            break
+        if scratch is not None:
+            if not _available(segments[scratch], needed):
+                raise ValueError("no scratch register for spill code")
+            break
+        # Keep a register for spill code and start over
+        for register in reversed(registers):
+            if _available(segments[register], needed):
+                scratch = register
+                break
+        else:
+            raise ValueError("no scratch register for spill code")
+        registers = [register for register in registers
+                     if register is not scratch]
+    assigned = {}
+    for interval in intervals.itervalues():
+        if interval.register is not None:
+            assigned[interval.vreg] = _REGISTERS[interval.vreg.width][
+                interval.register.number]
+    slots, frame_size = _assign_slots(spilled)
+    result = []
+    for line in lines:
+        if isinstance(line, Label):
+            result.append(line)
+            continue
+        if not any(isinstance(op, vreg) for op in line[1:]):
+            result.append(line)
+            continue
+        for new in _rewrite(line, assigned, slots, scratch):
+            # The move from a value to its own register
+            if new[0] is MOV and new[1] is new[2]:
+                continue
+            result.append(new)
+    return Allocation(result, assigned, slots, frame_size)
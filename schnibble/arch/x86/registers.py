@@ -1,16 +1,38 @@
 # coding: utf-8
-"""x86 registers."""
+"""
+x86 registers.
 
-from __future__ import absolute_import, print_function
-from .operands import reg8, reg16, reg32, reg64
+Registers that share storage, like AL, AH, AX, EAX and RAX, are related
+through their ``mask`` attribute: each general purpose register has four
+bits in a mask, one for each of bits 0-7, 8-15, 16-31 and 32-63 of its
+value. Two registers overlap when ``a.mask & b.mask`` is not zero, an
+instruction depends on another when its read mask intersects the write mask
+of the other one.
+
+The XMM and YMM vector registers are not tracked in masks.
+"""
 
-# TODO: model register co-existence (ah in ax, al in ax, ax in eax, eax in rax)
+from __future__ import absolute_import, print_function
+from .operands import reg8, reg16, reg32, reg64, reg128, reg256
 
-__all__ = ('AL', 'AH', 'AX', 'EAX', 'RAX')
+__all__ = (
+    'AL', 'CL', 'DL', 'BL', 'AH', 'CH', 'DH', 'BH', 'SPL', 'BPL', 'SIL', 'DIL',
+    'R8B', 'R9B', 'R10B', 'R11B', 'R12B', 'R13B', 'R14B', 'R15B',
+    'AX', 'CX', 'DX', 'BX', 'SP', 'BP', 'SI', 'DI',
+    'R8W', 'R9W', 'R10W', 'R11W', 'R12W', 'R13W', 'R14W', 'R15W',
+    'EAX', 'ECX', 'EDX', 'EBX', 'ESP', 'EBP', 'ESI', 'EDI',
+    'R8D', 'R9D', 'R10D', 'R11D', 'R12D', 'R13D', 'R14D', 'R15D',
+    'RAX', 'RCX', 'RDX', 'RBX', 'RSP', 'RBP', 'RSI', 'RDI',
+    'R8', 'R9', 'R10', 'R11', 'R12', 'R13', 'R14', 'R15',
+    'XMM0', 'XMM1', 'XMM2', 'XMM3', 'XMM4', 'XMM5', 'XMM6', 'XMM7',
+    'XMM8', 'XMM9', 'XMM10', 'XMM11', 'XMM12', 'XMM13', 'XMM14', 'XMM15',
+    'YMM0', 'YMM1', 'YMM2', 'YMM3', 'YMM4', 'YMM5', 'YMM6', 'YMM7',
+    'YMM8', 'YMM9', 'YMM10', 'YMM11', 'YMM12', 'YMM13', 'YMM14', 'YMM15',
+    'GPR', 'VECTOR', 'GPR8_REX', 'ALL_REGISTERS', 'registers_in')
 
 
 AL = reg8("AL", plus_rb=0)
-AX = reg16("AH", plus_rw=0)
+AX = reg16("AX", plus_rw=0)
 EAX = reg32("EAX", plus_rd=0)
 RAX = reg64("RAX", plus_rq=0)
 
@@ -21,3 +43,140 @@ AH = reg8("AH", plus_rb=4)
 CH = reg8("CH", plus_rb=5)
 DH = reg8("DH", plus_rb=6)
 BH = reg8("BH", plus_rb=7)
+
+# 64-bit general purpose registers, numbers 8 and above need REX.B or REX.R
+RCX = reg64("RCX", plus_rq=1)
+RDX = reg64("RDX", plus_rq=2)
+RBX = reg64("RBX", plus_rq=3)
+RSP = reg64("RSP", plus_rq=4)
+RBP = reg64("RBP", plus_rq=5)
+RSI = reg64("RSI", plus_rq=6)
+RDI = reg64("RDI", plus_rq=7)
+R8 = reg64("R8", plus_rq=8)
+R9 = reg64("R9", plus_rq=9)
+R10 = reg64("R10", plus_rq=10)
+R11 = reg64("R11", plus_rq=11)
+R12 = reg64("R12", plus_rq=12)
+R13 = reg64("R13", plus_rq=13)
+R14 = reg64("R14", plus_rq=14)
+R15 = reg64("R15", plus_rq=15)
+
+# Registers that can only be encoded with a REX prefix
+SPL = reg8("SPL", plus_rb=4, rex_required=True)
+BPL = reg8("BPL", plus_rb=5, rex_required=True)
+SIL = reg8("SIL", plus_rb=6, rex_required=True)
+DIL = reg8("DIL", plus_rb=7, rex_required=True)
+R8B = reg8("R8B", plus_rb=8)
+R9B = reg8("R9B", plus_rb=9)
+R10B = reg8("R10B", plus_rb=10)
+R11B = reg8("R11B", plus_rb=11)
+R12B = reg8("R12B", plus_rb=12)
+R13B = reg8("R13B", plus_rb=13)
+R14B = reg8("R14B", plus_rb=14)
+R15B = reg8("R15B", plus_rb=15)
+
+CX = reg16("CX", plus_rw=1)
+DX = reg16("DX", plus_rw=2)
+BX = reg16("BX", plus_rw=3)
+SP = reg16("SP", plus_rw=4)
+BP = reg16("BP", plus_rw=5)
+SI = reg16("SI", plus_rw=6)
+DI = reg16("DI", plus_rw=7)
+R8W = reg16("R8W", plus_rw=8)
+R9W = reg16("R9W", plus_rw=9)
+R10W = reg16("R10W", plus_rw=10)
+R11W = reg16("R11W", plus_rw=11)
+R12W = reg16("R12W", plus_rw=12)
+R13W = reg16("R13W", plus_rw=13)
+R14W = reg16("R14W", plus_rw=14)
+R15W = reg16("R15W", plus_rw=15)
+
+ECX = reg32("ECX", plus_rd=1)
+EDX = reg32("EDX", plus_rd=2)
+EBX = reg32("EBX", plus_rd=3)
+ESP = reg32("ESP", plus_rd=4)
+EBP = reg32("EBP", plus_rd=5)
+ESI = reg32("ESI", plus_rd=6)
+EDI = reg32("EDI", plus_rd=7)
+R8D = reg32("R8D", plus_rd=8)
+R9D = reg32("R9D", plus_rd=9)
+R10D = reg32("R10D", plus_rd=10)
+R11D = reg32("R11D", plus_rd=11)
+R12D = reg32("R12D", plus_rd=12)
+R13D = reg32("R13D", plus_rd=13)
+R14D = reg32("R14D", plus_rd=14)
+R15D = reg32("R15D", plus_rd=15)
+
+# Vector registers, the XMM registers are the low halves of the YMM registers
+XMM0 = reg128("XMM0", 0)
+XMM1 = reg128("XMM1", 1)
+XMM2 = reg128("XMM2", 2)
+XMM3 = reg128("XMM3", 3)
+XMM4 = reg128("XMM4", 4)
+XMM5 = reg128("XMM5", 5)
+XMM6 = reg128("XMM6", 6)
+XMM7 = reg128("XMM7", 7)
+XMM8 = reg128("XMM8", 8)
+XMM9 = reg128("XMM9", 9)
+XMM10 = reg128("XMM10", 10)
+XMM11 = reg128("XMM11", 11)
+XMM12 = reg128("XMM12", 12)
+XMM13 = reg128("XMM13", 13)
+XMM14 = reg128("XMM14", 14)
+XMM15 = reg128("XMM15", 15)
+
+YMM0 = reg256("YMM0", 0)
+YMM1 = reg256("YMM1", 1)
+YMM2 = reg256("YMM2", 2)
+YMM3 = reg256("YMM3", 3)
+YMM4 = reg256("YMM4", 4)
+YMM5 = reg256("YMM5", 5)
+YMM6 = reg256("YMM6", 6)
+YMM7 = reg256("YMM7", 7)
+YMM8 = reg256("YMM8", 8)
+YMM9 = reg256("YMM9", 9)
+YMM10 = reg256("YMM10", 10)
+YMM11 = reg256("YMM11", 11)
+YMM12 = reg256("YMM12", 12)
+YMM13 = reg256("YMM13", 13)
+YMM14 = reg256("YMM14", 14)
+YMM15 = reg256("YMM15", 15)
+
+#: General purpose registers indexed by width and number. Only the first
+#: eight 8-bit registers are listed, see :data:`GPR8_REX`.
+GPR = {
+    8: (AL, CL, DL, BL, AH, CH, DH, BH),
+    16: (AX, CX, DX, BX, SP, BP, SI, DI, R8W, R9W, R10W, R11W, R12W, R13W,
+         R14W, R15W),
+    32: (EAX, ECX, EDX, EBX, ESP, EBP, ESI, EDI, R8D, R9D, R10D, R11D, R12D,
+         R13D, R14D, R15D),
+    64: (RAX, RCX, RDX, RBX, RSP, RBP, RSI, RDI, R8, R9, R10, R11, R12, R13,
+         R14, R15),
+}
+
+#: Vector registers indexed by width and number
+VECTOR = {
+    128: (XMM0, XMM1, XMM2, XMM3, XMM4, XMM5, XMM6, XMM7, XMM8, XMM9, XMM10,
+          XMM11, XMM12, XMM13, XMM14, XMM15),
+    256: (YMM0, YMM1, YMM2, YMM3, YMM4, YMM5, YMM6, YMM7, YMM8, YMM9, YMM10,
+          YMM11, YMM12, YMM13, YMM14, YMM15),
+}
+
+#: 8-bit registers indexed by number, when a REX prefix is present
+GPR8_REX = (AL, CL, DL, BL, SPL, BPL, SIL, DIL, R8B, R9B, R10B, R11B, R12B,
+            R13B, R14B, R15B)
+
+#: Mask of all the general purpose registers
+ALL_REGISTERS = (1 << (4 * 16)) - 1
+
+
+def registers_in(mask):
+    """
+    Find the 64-bit registers overlapping a register mask.
+
+    :param mask:
+        A register mask, see :attr:`~schnibble.arch.x86.operands.reg.mask`.
+    :returns:
+        List of :class:`~schnibble.arch.x86.operands.reg64`, by number.
+    """
+    return [register for register in GPR[64] if register.mask & mask]
@@ -3,7 +3,154 @@
 
 from __future__ import absolute_import, print_function
 
-__all__ = ('ModRM',)
+import collections
+import struct
+
+__all__ = ('ModRM', 'MODRM', 'SIB', 'ModRMEntry', 'SIBEntry',
+           'encode_address')
+
+#: Decoded ModRM byte.
+#:
+#: ``sib`` is True when a SIB byte follows. ``disp_size`` is the size of the
+#: displacement in bytes, not counting the case where the SIB byte selects
+#: a displacement without a base register. ``rip_relative`` is True for
+#: RIP-relative addressing (64-bit mode).
+ModRMEntry = collections.namedtuple(
+    "ModRMEntry", "mod reg r_m sib disp_size rip_relative")
+
+#: Decoded SIB byte. ``scale`` is the multiplier (1, 2, 4 or 8), ``index``
+#: and ``base`` are the three low bits of the register numbers.
+#: ``index`` 4 means no index unless REX.X is set. ``base`` 5 with ModRM.mod
+#: 00 means no base and a 32-bit displacement.
+SIBEntry = collections.namedtuple("SIBEntry", "scale index base")
+
+
+def _decode_modrm(byte):
+    mod, reg, r_m = byte >> 6, (byte >> 3) & 7, byte & 7
+    sib = mod != 0b11 and r_m == 0b100
+    rip_relative = mod == 0b00 and r_m == 0b101
+    disp_size = {0b00: 4 if rip_relative else 0, 0b01: 1, 0b10: 4,
+                 0b11: 0}[mod]
+    return ModRMEntry(mod, reg, r_m, sib, disp_size, rip_relative)
+
+
+#: Decoding table for all ModRM bytes
+MODRM = tuple(_decode_modrm(byte) for byte in range(256))
+
+#: Decoding table for all SIB bytes
+SIB = tuple(SIBEntry(1 << (byte >> 6), (byte >> 3) & 7, byte & 7)
+            for byte in range(256))
+
+_SCALES = {1: 0, 2: 1, 4: 2, 8: 3}
+_DISP8 = struct.Struct('<b')
+_DISP32 = struct.Struct('<i')
+
+
+def encode_address(base=None, index=None, scale=1, disp=0,
+                   rip_relative=False):
+    """
+    Encode a memory address using the shortest ModRM/SIB/displacement form.
+
+    :param base:
+        Number of the base register (0 - 15) or None.
+    :param index:
+        Number of the index register (0 - 15) or None.
+    :param scale:
+        Multiplier of the index register, 1, 2, 4 or 8.
+    :param disp:
+        Signed 32-bit displacement.
+    :param rip_relative:
+        Address relative to the next instruction, without base and index.
+    :returns:
+        Tuple ``(rex, modrm, tail)``. ``rex`` has the REX.X and REX.B bits,
+        ``modrm`` is the ModRM byte with a zero reg field and ``tail`` is
+        a bytearray with the SIB byte, if any, and the displacement.
+    :raises ValueError:
+        If the address cannot be encoded.
+    """
+    if scale not in _SCALES:
+        raise ValueError("invalid scale: {!r}".format(scale))
+    if index is None and scale != 1:
+        raise ValueError("scale without an index register")
+    if index == 0b100:
+        raise ValueError("RSP cannot be used as an index register")
+    if not -0x80000000 <= disp <= 0x7FFFFFFF:
+        raise ValueError("displacement too large: {!r}".format(disp))
+    rex = 0
+    tail = bytearray()
+    if rip_relative:
+        if base is not None or index is not None:
+            raise ValueError("RIP-relative address with base or index")
+        tail.extend(_DISP32.pack(disp))
+        return rex, 0b00000101, tail
+    if index is not None:
+        rex |= (index >> 3) << 1
+    if base is None:
+        # mod 00 r/m 101 is RIP-relative in 64-bit mode, absolute addresses
+        # need a SIB byte without a base.
+        sib_index = 0b100 if index is None else index & 7
+        tail.append((_SCALES[scale] << 6) | (sib_index << 3) | 0b101)
+        tail.extend(_DISP32.pack(disp))
+        return rex, 0b00000100, tail
+    rex |= base >> 3
+    # [rBP] and [r13] can only be encoded with a displacement
+    if disp == 0 and base & 7 != 0b101:
+        mod = 0b00
+    elif -0x80 <= disp <= 0x7F:
+        mod = 0b01
+    else:
+        mod = 0b10
+    if index is None and base & 7 != 0b100:
+        modrm = (mod << 6) | (base & 7)
+    else:
+        # [rSP] and [r12] can only be encoded with a SIB byte
+        sib_index = 0b100 if index is None else index & 7
+        modrm = (mod << 6) | 0b100
+        tail.append((_SCALES[scale] << 6) | (sib_index << 3) | (base & 7))
+    if mod == 0b01:
+        tail.extend(_DISP8.pack(disp))
+    elif mod == 0b10:
+        tail.extend(_DISP32.pack(disp))
+    return rex, modrm, tail
+
+
+_REG_NAMES = ('rAX', 'rCX', 'rDX', 'rBX', 'rSP', 'rBP', 'rSI', 'rDI')
+
+_OPERAND1 = (
+    'rAX,MMX0,XMM0,YMM0',
+    'rCX,MMX1,XMM1,YMM1',
+    'rDX,MMX2,XMM2,YMM2',
+    'rBX,MMX3,XMM3,YMM3',
+    'AH,rSP,MMX4,XMM4,YMM4',
+    'CH,rBP,MMX5,XMM5,YMM5',
+    'DH,rSI,MMX6,XMM6,YMM6',
+    'BH,rDI,MMX7,XMM7,YMM7',
+)
+
+_REGISTER_DIRECT = (
+    'AL/rAX/MMX0/XMM0/YMM0',
+    'CL/rCX/MMX1/XMM1/YMM1',
+    'DL/rDX/MMX2/XMM2/YMM2',
+    'BL/rBX/MMX3/XMM3/YMM3',
+    'AH/SPL/rSP/MMX4/XMM4/YMM4',
+    'CH/BPL/rBP/MMX5/XMM5/YMM5',
+    'DH/SIL/rSI/MMX6/XMM6/YMM6',
+    'BH/DIL/rDI/MMX7/XMM7/YMM7',
+)
+
+
+def _describe_operand2(entry):
+    if entry.mod == 0b11:
+        return _REGISTER_DIRECT[entry.r_m]
+    if entry.rip_relative:
+        return 'disp32'
+    text = 'SIB' if entry.sib else '[{}]'.format(_REG_NAMES[entry.r_m])
+    if entry.disp_size:
+        text += '+disp{}'.format(entry.disp_size * 8)
+    return text
+
+
+_OPERAND2 = tuple(_describe_operand2(MODRM[byte]) for byte in range(256))
 
 
 class ModRM(object):
@@ -70,6 +217,12 @@ class ModRM(object):
         self.reg = reg
         self.r_m = r_m
 
+    @classmethod
+    def from_byte(cls, byte):
+        """Decode a ModRM byte."""
+        entry = MODRM[byte]
+        return cls(entry.mod, entry.reg, entry.r_m)
+
     @property
     def byte(self):
         return self.r_m | (self.reg << 3) | (self.mod << 6)
@@ -80,90 +233,10 @@ class ModRM(object):
 
     @property
     def operand1(self):
-        if self.reg == 0b000:
-            return 'rAX,MMX0,XMM0,YMM0'
-        elif self.reg == 0b001:
-            return 'rCX,MMX1,XMM1,YMM1'
-        elif self.reg == 0b010:
-            return 'rDX,MMX2,XMM2,YMM2'
-        elif self.reg == 0b011:
-            return 'rBX,MMX3,XMM3,YMM3'
-        elif self.reg == 0b100:
-            return 'AH,rSP,MMX4,XMM4,YMM4'
-        elif self.reg == 0b101:
-            return 'CH,rBP,MMX5,XMM5,YMM5'
-        elif self.reg == 0b110:
-            return 'DH,rSI,MMX6,XMM6,YMM6'
-        elif self.reg == 0b111:
-            return 'BH,rDI,MMX7,XMM7,YMM7'
+        """Description of the operand selected by the reg field."""
+        return _OPERAND1[self.reg]
 
     @property
     def operand2(self):
-        if self.mod == 0b00:
-            if self.r_m == 0b000:
-                return '[rAX]'
-            elif self.r_m == 0b001:
-                return '[rCX]'
-            elif self.r_m == 0b010:
-                return '[rDX]'
-            elif self.r_m == 0b011:
-                return '[rBX]'
-            elif self.r_m == 0b100:
-                raise 'SIB'
-            elif self.r_m == 0b101:
-                return 'disp32'
-            elif self.r_m == 0b110:
-                return '[rSI]'
-            elif self.r_m == 0b111:
-                return '[rDI]'
-        elif self.mod == 0b01:
-            if self.r_m == 0b000:
-                return '[rAX]+disp8'
-            elif self.r_m == 0b001:
-                return '[rCX]+disp8'
-            elif self.r_m == 0b010:
-                return '[rDX]+disp8'
-            elif self.r_m == 0b011:
-                return '[rBX]+disp8'
-            elif self.r_m == 0b100:
-                raise 'SIB+disp8'
-            elif self.r_m == 0b101:
-                return '[rBP]+disp8'
-            elif self.r_m == 0b110:
-                return '[rSI]+disp8'
-            elif self.r_m == 0b111:
-                return '[rDI]+disp8'
-        elif self.mod == 0b10:
-            if self.r_m == 0b000:
-                return '[rAX]+disp32'
-            elif self.r_m == 0b001:
-                return '[rCX]+disp32'
-            elif self.r_m == 0b010:
-                return '[rDX]+disp32'
-            elif self.r_m == 0b011:
-                return '[rBX]+disp32'
-            elif self.r_m == 0b100:
-                raise 'SIB+disp32'
-            elif self.r_m == 0b101:
-                return '[rBP]+disp32'
-            elif self.r_m == 0b110:
-                return '[rSI]+disp32'
-            elif self.r_m == 0b111:
-                return '[rDI]+disp32'
-        elif self.mod == 0b11:
-            if self.r_m == 0b000:
-                return 'AL/rAX/MMX0/XMM0/YMM0'
-            elif self.r_m == 0b001:
-                return 'CL/rCX/MMX1/XMM1/YMM1'
-            elif self.r_m == 0b010:
-                return 'DL/rDX/MMX2/XMM2/YMM2'
-            elif self.r_m == 0b011:
-                return 'BL/rBX/MMX3/XMM3/YMM3'
-            elif self.r_m == 0b100:
-                return 'AH/SPL/rSP/MMX4/XMM4/YMM4'
-            elif self.r_m == 0b101:
-                return 'CH/BPL/rBP/MMX5/XMM5/YMM5'
-            elif self.r_m == 0b110:
-                return 'DH/SIL/rSI/MMX6/XMM6/YMM6'
-            elif self.r_m == 0b111:
-                return 'BH/DIL/rDI/MMX7/XMM7/YMM7'
+        """Description of the operand selected by the mod and r/m fields."""
+        return _OPERAND2[self.byte]
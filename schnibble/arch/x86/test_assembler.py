@@ -0,0 +1,189 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import random
+import unittest
+
+from .assembler import Assembler, Label, assemble
+from .disasm import disassemble
+from .instructions import ADD, SUB, MOV, PUSH, POP, NEG, JMP, CALL, JO, JNE
+from .instructions import JZ, RET
+from .operands import imm8, imm16, imm32, imm64, rel8, rel32, mem32, mem64
+from .registers import AL, AX, EAX, RAX, RSP, RBP, SPL, R9, R12, R13
+
+
+LINES = [
+    (PUSH, RBP),
+    (MOV, RBP, RSP),
+    (MOV, RAX, imm64(0x1122334455667788)),
+    (MOV, AX, imm16(0xABCD)),
+    (ADD, AL, imm8(0x7F)),
+    (MOV, SPL, imm8(1)),
+    (ADD, mem64(RSP, R12, 4, 0x10), R9),
+    (MOV, mem32(R13, disp=-8), imm32(1)),
+    (SUB, EAX, imm32(-1)),
+    (NEG, RAX),
+    (JO, rel32(-6)),
+    (POP, RBP),
+    (RET,),
+]
+
+
+class AssemblerTests(unittest.TestCase):
+
+    def test_same_as_emit(self):
+        expected = bytearray()
+        for line in LINES:
+            line[0].emit(expected, *line[1:])
+        asm = Assembler(LINES)
+        self.assertEqual(len(asm), len(LINES))
+        self.assertEqual(asm.size, len(expected))
+        self.assertEqual(asm.assemble(), expected)
+        self.assertEqual(assemble(LINES), expected)
+
+    def test_offsets(self):
+        asm = Assembler()
+        self.assertEqual(asm.append(PUSH, RBP), 0)
+        self.assertEqual(asm.append(MOV, RBP, RSP), 1)
+        self.assertEqual(asm.append(RET), 2)
+        self.assertEqual(asm.size, 5)
+        self.assertEqual(asm.relax().offsets, [0, 1, 4])
+
+    def test_assemble_into(self):
+        asm = Assembler([(PUSH, RBP), (POP, RBP), (RET,)])
+        buf = bytearray(b'\xCC' * 6)
+        self.assertEqual(asm.assemble_into(buf, 2), 5)
+        self.assertEqual(buf, bytearray(b'\xCC\xCC\x55\x5D\xC3\xCC'))
+        with self.assertRaises(ValueError):
+            asm.assemble_into(buf, 4)
+
+    def test_unknown_form(self):
+        asm = Assembler([(RET,)])
+        with self.assertRaises(ValueError):
+            asm.append(PUSH, EAX)
+        self.assertEqual(asm.size, 1)
+
+
+def nops(count):
+    # Instructions of 3 bytes each
+    return [(MOV, RBP, RSP)] * count
+
+
+def branch_targets(code):
+    """Map offsets of branches to their targets, using the disassembler."""
+    targets = {}
+    for offset, length, mnemonic, operands in disassemble(code):
+        if operands and isinstance(operands[0], (rel8, rel32)):
+            targets[offset] = offset + length + operands[0].value
+    return targets
+
+
+class RelaxationTests(unittest.TestCase):
+
+    def test_forward_short(self):
+        end = Label('end')
+        asm = Assembler([(JMP, end)] + nops(2) + [end, (RET,)])
+        layout = asm.relax()
+        self.assertEqual((layout.short, layout.long), (1, 0))
+        self.assertEqual(layout.labels, {end: 8})
+        self.assertEqual(list(asm.assemble()[:2]), [0xEB, 6])
+
+    def test_forward_long(self):
+        end = Label('end')
+        code = assemble([(JNE, end)] + nops(43) + [end, (RET,)])
+        # 129 bytes don't fit in a signed byte
+        self.assertEqual(list(code[:6]), [0x0F, 0x85, 129, 0, 0, 0])
+        self.assertEqual(len(code), 6 + 129 + 1)
+
+    def test_limits(self):
+        # 127 bytes forward, 128 bytes backward still fit
+        end = Label()
+        code = assemble([(JZ, end)] + nops(42) + [(PUSH, RBP), end])
+        self.assertEqual(list(code[:2]), [0x74, 127])
+        top = Label()
+        code = assemble([top] + nops(42) + [(JZ, top)])
+        self.assertEqual(list(code[-2:]), [0x74, 0x80])
+        code = assemble([top, (PUSH, RBP)] + nops(42) + [(JZ, top)])
+        self.assertEqual(list(code[-6:-4]), [0x0F, 0x84])
+
+    def test_cascade(self):
+        # The inner branch doesn't fit, widening it pushes the outer label
+        # out of reach as well.
+        inner, outer = Label('inner'), Label('outer')
+        asm = Assembler(
+            [(JO, outer), (JMP, inner)] + nops(41) + [outer] + nops(3)
+            + [inner, (RET,)])
+        self.assertEqual(asm.size, 2 + 2 + 132 + 1)
+        layout = asm.relax()
+        self.assertEqual((layout.short, layout.long), (0, 2))
+        self.assertEqual(layout.size, 6 + 5 + 132 + 1)
+        code = asm.assemble()
+        self.assertEqual(len(code), layout.size)
+        self.assertEqual(branch_targets(code), {
+            0: layout.labels[outer], 6: layout.labels[inner]})
+
+    def test_call(self):
+        helper = Label()
+        layout = Assembler([(CALL, helper), (RET,), helper, (RET,)]).relax()
+        self.assertEqual((layout.short, layout.long), (0, 1))
+        self.assertEqual(layout.labels[helper], 6)
+
+    def test_labels(self):
+        label = Label('x')
+        self.assertEqual(repr(label), "Label('x')")
+        asm = Assembler([(JMP, label)])
+        with self.assertRaises(ValueError):
+            asm.relax()
+        self.assertEqual(asm.bind(label), 1)
+        with self.assertRaises(ValueError):
+            asm.bind(label)
+        self.assertEqual(list(asm.assemble()), [0xEB, 0])
+
+    def test_random(self):
+        # The result is the least fixed point, compare with a naive
+        # relaxation that recomputes every branch until nothing changes.
+        rnd = random.Random(42)
+        labels = [Label(i) for i in range(60)]
+        lines = []
+        for label in labels:
+            lines.extend(nops(rnd.randint(0, 20)))
+            for _ in range(rnd.randint(0, 3)):
+                lines.append((rnd.choice((JMP, JNE, CALL)),
+                              rnd.choice(labels)))
+            lines.append(label)
+        asm = Assembler(lines)
+        layout = asm.relax()
+        code = asm.assemble()
+        wide = set()
+        while True:
+            offsets, offset = [], 0
+            for i, line in enumerate(lines):
+                offsets.append(offset)
+                if isinstance(line, Label):
+                    continue
+                if isinstance(line[-1], Label):
+                    offset += 5 if line[0] is CALL or i in wide else 2
+                    if line[0] is JNE and i in wide:
+                        offset += 1
+                else:
+                    offset += 3
+            changed = False
+            for i, line in enumerate(lines):
+                if (not isinstance(line, Label) and isinstance(
+                        line[-1], Label) and i not in wide):
+                    target = offsets[lines.index(line[-1])]
+                    if not -128 <= target - (offsets[i] + 2) <= 127:
+                        wide.add(i)
+                        changed = True
+            if not changed:
+                break
+        self.assertEqual(layout.offsets, offsets)
+        self.assertEqual(layout.size, offset)
+        self.assertEqual(sorted(branch_targets(code).items()), sorted(
+            (offsets[i], offsets[lines.index(line[-1])])
+            for i, line in enumerate(lines)
+            if not isinstance(line, Label) and isinstance(line[-1], Label)))
+
+
+if __name__ == '__main__':
+    unittest.main()
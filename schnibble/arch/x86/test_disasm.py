@@ -0,0 +1,205 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import binascii
+import unittest
+
+from .disasm import (
+    DecodeError, disassemble, format_instruction, iter_lengths)
+from .instructions import ADD, SUB, IMUL, NEG, MOV, PUSH, POP, JO, RET
+from .instructions import (
+    ADDPS, PADDQ, MOVDQU, VADDPS, VADDPD, VPMULLD, VMOVUPS, VBROADCASTSS,
+    VPBROADCASTQ)
+from .operands import imm8, imm16, imm32, imm64, simm8, rel32, mem8, mem32
+from .operands import mem64, mem128, mem256
+from .registers import (
+    AL, AX, EAX, ECX, RAX, RSP, RBP, RSI, SPL, DIL, R8B, R9, R12, R13, R15,
+    R10D, XMM0, XMM1, XMM2, XMM8, XMM9, XMM10, XMM15, YMM0, YMM1, YMM2, YMM9,
+    YMM12)
+
+
+def _code(text):
+    return binascii.unhexlify(text.replace(' ', ''))
+
+
+class LengthTests(unittest.TestCase):
+
+    def lengths(self, text):
+        return [length for offset, length in iter_lengths(_code(text))]
+
+    def test_simple(self):
+        # push rbp; mov rbp, rsp; pop rbp; ret
+        self.assertEqual(self.lengths('55 4889e5 5d c3'), [1, 3, 1, 1])
+
+    def test_immediates(self):
+        # mov eax, 1; mov rax, imm64; mov ax, 1; enter 8, 0; ret 8
+        self.assertEqual(
+            self.lengths('b801000000 48b80100000000000000 66b80100'
+                         ' c8080000 c20800'),
+            [5, 10, 4, 4, 3])
+
+    def test_group3(self):
+        # test byte [rax], 5; not byte [rax]; test eax, 5 (F7 /0)
+        self.assertEqual(
+            self.lengths('f60005 f610 f7c005000000'), [3, 2, 6])
+
+    def test_addressing(self):
+        # mov eax, [rsp + 8]; mov eax, [rbp + 0]; mov eax, [rip + 0];
+        # mov eax, [rax * 4 + 0]
+        self.assertEqual(
+            self.lengths('8b442408 8b4500 8b0500000000 8b048500000000'),
+            [4, 3, 6, 7])
+
+    def test_moffs(self):
+        # mov eax, [imm64]; mov eax, [imm32] (address size prefix)
+        self.assertEqual(
+            self.lengths('a10000000000000000 67a100000000'), [9, 6])
+
+    def test_escape_maps(self):
+        # nop word [rax + rax + 0]; pshufb xmm0, xmm1; palignr xmm0, xmm1, 1
+        self.assertEqual(
+            self.lengths('660f1f440000 660f3800c1 660f3a0fc101'),
+            [6, 5, 6])
+
+    def test_vex(self):
+        # vzeroupper; vpbroadcastd xmm0, [rsp + 4]; vpermq ymm0, ymm1, 0
+        self.assertEqual(
+            self.lengths('c5f877 c4e2795844 2404 c4e3fd00c100'), [3, 7, 6])
+
+    def test_evex(self):
+        # vmovdqu64 zmm1, [rcx]
+        self.assertEqual(self.lengths('62f1fe486f09'), [6])
+
+    def test_truncated(self):
+        with self.assertRaises(DecodeError):
+            list(iter_lengths(_code('48b801000000')))
+        with self.assertRaises(DecodeError):
+            list(iter_lengths(_code('66' * 16)))
+
+    def test_invalid(self):
+        with self.assertRaises(DecodeError):
+            list(iter_lengths(_code('c3 06')))
+        self.assertEqual(
+            list(iter_lengths(_code('c3 06 c3'), strict=False)),
+            [(0, 1), (1, 1), (2, 1)])
+
+    def test_range(self):
+        code = _code('55 4889e5 5d c3')
+        self.assertEqual(list(iter_lengths(code, 1, 5)), [(1, 3), (4, 1)])
+        with self.assertRaises(DecodeError):
+            list(iter_lengths(code, 0, 3))
+
+    def test_buffers(self):
+        code = _code('55 4889e5 5d c3')
+        expected = [(0, 1), (1, 3), (4, 1), (5, 1)]
+        for buf in (code, bytearray(code), buffer(code), memoryview(code)):
+            self.assertEqual(list(iter_lengths(buf)), expected)
+
+    def test_large_buffer(self):
+        # Instructions measured from tables and by scanning, across windows
+        text = ('55 4889e5 48b80100000000000000 66b80100 f7c005000000'
+                ' 8b048500000000 4f8b4c2408 0f1f440000 0f8400000000'
+                ' 660f3800c1 c5f877 c3')
+        lengths = [1, 3, 10, 4, 6, 7, 5, 5, 6, 5, 3, 1]
+        count = 3000
+        self.assertEqual(
+            [length for offset, length in iter_lengths(_code(text) * count)],
+            lengths * count)
+
+
+class DisassembleTests(unittest.TestCase):
+
+    def roundtrip(self, instruction, *operands):
+        buf = bytearray()
+        instruction.emit(buf, *operands)
+        decoded, = disassemble(buf)
+        self.assertEqual(decoded.length, len(buf))
+        self.assertEqual(decoded.mnemonic, instruction.mnemonic_id)
+        buf2 = bytearray()
+        instruction.emit(buf2, *decoded.operands)
+        self.assertEqual(buf2, buf)
+        return decoded
+
+    def test_roundtrip(self):
+        self.roundtrip(RET)
+        self.roundtrip(PUSH, R15)
+        self.roundtrip(POP, RBP)
+        self.roundtrip(MOV, RAX, imm64(0x1122334455667788))
+        self.roundtrip(MOV, R10D, imm32(7))
+        self.roundtrip(MOV, AX, imm16(0xFFFF))
+        self.roundtrip(MOV, DIL, imm8(1))
+        self.roundtrip(MOV, R9, RSP)
+        self.roundtrip(MOV, SPL, AL)
+        self.roundtrip(ADD, EAX, imm32(5))
+        self.roundtrip(ADD, R8B, imm8(0x80))
+        decoded = self.roundtrip(ADD, ECX, simm8(-56))
+        self.assertEqual(repr(decoded.operands[1]), 'simm8(-56)')
+        self.roundtrip(SUB, R12, imm32(0x10))
+        self.roundtrip(IMUL, R13, RSI)
+        self.roundtrip(NEG, RAX)
+        self.roundtrip(JO, rel32(-6))
+
+    def test_roundtrip_memory(self):
+        self.roundtrip(ADD, mem64(RSP, R12, 4, 0x10), R9)
+        self.roundtrip(MOV, RAX, mem64(RBP))
+        self.roundtrip(MOV, mem32(R13, disp=-8), imm32(1))
+        self.roundtrip(MOV, mem32(disp=0x1000), EAX)
+        self.roundtrip(MOV, mem64(disp=-4, rip_relative=True), RAX)
+        self.roundtrip(NEG, mem8(RAX, RSI, 8))
+
+    def test_roundtrip_vector(self):
+        self.roundtrip(ADDPS, XMM1, XMM2)
+        self.roundtrip(PADDQ, XMM9, mem128(RAX, RSI, 8))
+        self.roundtrip(MOVDQU, mem128(RSP, disp=8), XMM15)
+        self.roundtrip(VADDPS, YMM0, YMM1, YMM2)
+        self.roundtrip(VADDPS, XMM8, XMM9, XMM10)
+        self.roundtrip(VPMULLD, YMM12, YMM2, mem256(R13))
+        self.roundtrip(VMOVUPS, mem256(RSI, disp=32), YMM9)
+        self.roundtrip(VBROADCASTSS, YMM0, mem32(RBP))
+        self.roundtrip(VPBROADCASTQ, XMM2, XMM1)
+
+    def test_vector_length(self):
+        buf = bytearray()
+        VADDPD.emit(buf, XMM0, XMM1, XMM2)
+        VADDPD.emit(buf, YMM0, YMM1, YMM2)
+        self.assertEqual(
+            [format_instruction(d) for d in disassemble(buf)],
+            ['VADDPD XMM0, XMM1, XMM2', 'VADDPD YMM0, YMM1, YMM2'])
+
+    def test_operands(self):
+        decoded = self.roundtrip(ADD, mem64(RSP, R12, 4, -16), R9)
+        address, register = decoded.operands
+        self.assertIs(address.base, RSP)
+        self.assertIs(address.index, R12)
+        self.assertEqual((address.scale, address.disp), (4, -16))
+        self.assertIs(register, R9)
+        self.assertEqual(self.roundtrip(JO, rel32(-6)).operands[0].value, -6)
+
+    def test_format(self):
+        buf = bytearray()
+        MOV.emit(buf, RAX, mem64(RBP, disp=8))
+        SUB.emit(buf, EAX, imm32(5))
+        RET.emit(buf)
+        buf.extend(_code('0f0b'))
+        self.assertEqual(
+            [format_instruction(d) for d in disassemble(buf)],
+            ['MOV RAX, QWORD [RBP+8]', 'SUB EAX, 5', 'RET', '(unknown)'])
+
+    def test_unknown(self):
+        # ud2
+        decoded, = disassemble(_code('0f0b'))
+        self.assertEqual(decoded, (0, 2, 0, None))
+
+    def test_rex_byte_registers(self):
+        # Without REX, 4 to 7 are AH, CH, DH and BH
+        buf = bytearray()
+        MOV.emit(buf, SPL, imm8(1))
+        self.assertEqual(buf, bytearray(_code('40b401')))
+        (_, _, _, (register, _)), = disassemble(buf)
+        self.assertIs(register, SPL)
+        (_, _, _, (register, _)), = disassemble(_code('b401'))
+        self.assertEqual(register.name, 'AH')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,274 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import ctypes
+import platform
+import unittest
+
+from schnibble.native import NativeFunction
+
+from .instructions import ADD, SUB, IMUL, NEG, XOR, MOV, PUSH, POP, JO, RET
+from .instructions import AAA, INT
+from .instructions import ADDPS, MULPD, PADDD, PMULLD, MOVUPS, MOVUPD
+from .instructions import MOVDQU, VADDPS, VADDPD, VPADDD, VPMULLD, VMOVUPS
+from .instructions import VMOVDQU, VBROADCASTSS, VBROADCASTSD, VPBROADCASTQ
+from .instructions import ENCODINGS, Form
+from .operands import imm8, imm16, imm32, imm64, simm8, rel32
+from .operands import mem8, mem32, mem64, mem128, mem256
+from .registers import AL, AX, CL, EAX, ECX, EDX, RAX, RBX, RCX, RDX, RBP
+from .registers import RSP, RSI, RDI, AH, SPL, R8B, R8, R9, R11, R12, R13
+from .registers import R15
+from .registers import ALL_REGISTERS, XMM0, XMM1, XMM2, XMM8, XMM9, XMM10
+from .registers import XMM15, YMM0, YMM1, YMM2, YMM9, YMM14
+
+
+def enc(inst, *operands):
+    buf = bytearray()
+    inst.emit(buf, *operands)
+    return list(buf)
+
+
+class EncodingTests(unittest.TestCase):
+
+    def test_MOV_reg32_imm32(self):
+        self.assertEqual(enc(MOV, EAX, imm32(42)), [0xB8, 42, 0, 0, 0])
+
+    def test_MOV_reg64_imm64(self):
+        self.assertEqual(
+            enc(MOV, R8, imm64(1 << 40)),
+            [0x49, 0xB8, 0, 0, 0, 0, 0, 1, 0, 0])
+
+    def test_MOV_reg64_imm32(self):
+        self.assertEqual(
+            enc(MOV, RCX, imm32(-1)),
+            [0x48, 0xC7, 0xC1, 0xFF, 0xFF, 0xFF, 0xFF])
+
+    def test_MOV_reg64_reg64(self):
+        self.assertEqual(enc(MOV, RBP, RSP), [0x48, 0x89, 0xE5])
+        self.assertEqual(enc(MOV, R11, RDI), [0x49, 0x89, 0xFB])
+
+    def test_ADD_RAX_imm32(self):
+        self.assertEqual(enc(ADD, RAX, imm32(1)), [0x48, 0x05, 1, 0, 0, 0])
+
+    def test_arithmetic_reg64_reg64(self):
+        self.assertEqual(enc(ADD, RAX, R11), [0x4C, 0x01, 0xD8])
+        self.assertEqual(enc(SUB, RAX, R11), [0x4C, 0x29, 0xD8])
+        self.assertEqual(enc(IMUL, RAX, R11), [0x49, 0x0F, 0xAF, 0xC3])
+        self.assertEqual(enc(NEG, RAX), [0x48, 0xF7, 0xD8])
+
+    def test_PUSH_POP(self):
+        self.assertEqual(enc(PUSH, RBP), [0x55])
+        self.assertEqual(enc(PUSH, R15), [0x41, 0x57])
+        self.assertEqual(enc(POP, RBP), [0x5D])
+        self.assertEqual(enc(POP, R15), [0x41, 0x5F])
+
+    def test_JO(self):
+        self.assertEqual(
+            enc(JO, rel32(-6)), [0x0F, 0x80, 0xFA, 0xFF, 0xFF, 0xFF])
+
+    def test_RET(self):
+        self.assertEqual(enc(RET), [0xC3])
+
+    def test_accumulator_forms(self):
+        self.assertEqual(enc(ADD, AL, imm8(1)), [0x04, 1])
+        self.assertEqual(enc(ADD, AX, imm16(1)), [0x66, 0x05, 1, 0])
+        self.assertEqual(enc(SUB, RAX, imm32(1)), [0x48, 0x2D, 1, 0, 0, 0])
+
+    def test_generic_forms(self):
+        self.assertEqual(enc(ADD, CL, imm8(1)), [0x80, 0xC1, 1])
+        self.assertEqual(
+            enc(SUB, R15, imm32(1)), [0x49, 0x81, 0xEF, 1, 0, 0, 0])
+        # Generic register forms also accept the accumulator
+        self.assertEqual(enc(ADD, RAX, RAX), [0x48, 0x01, 0xC0])
+        self.assertEqual(enc(MOV, AL, imm8(7)), [0xB0, 7])
+
+    def test_sign_extended_imm8(self):
+        self.assertEqual(enc(ADD, RAX, simm8(1)), [0x48, 0x83, 0xC0, 1])
+        self.assertEqual(enc(SUB, R15, simm8(-1)), [0x49, 0x83, 0xEF, 0xFF])
+        self.assertEqual(enc(ADD, EAX, simm8(8)), [0x83, 0xC0, 8])
+        self.assertEqual(enc(SUB, AX, simm8(8)), [0x66, 0x83, 0xE8, 8])
+        self.assertEqual(enc(ADD, ECX, simm8(-128)), [0x83, 0xC1, 0x80])
+        self.assertEqual(
+            enc(ADD, mem64(RSP, disp=8), simm8(1)),
+            [0x48, 0x83, 0x44, 0x24, 0x08, 1])
+        # Unsigned bytes are not sign-extended to wider operands
+        self.assertRaises(ValueError, enc, ADD, ECX, imm8(0x80))
+        self.assertRaises(ValueError, enc, SUB, RAX, imm8(1))
+        self.assertRaises(ValueError, simm8, 0x80)
+        self.assertRaises(ValueError, simm8, -0x81)
+
+    def test_XOR(self):
+        self.assertEqual(enc(XOR, EAX, EAX), [0x31, 0xC0])
+        self.assertEqual(enc(XOR, R9, R11), [0x4D, 0x31, 0xD9])
+        self.assertEqual(enc(XOR, ECX, simm8(1)), [0x83, 0xF1, 1])
+        self.assertEqual(enc(XOR, AL, imm8(1)), [0x34, 1])
+
+    def test_memory_operands(self):
+        self.assertEqual(enc(MOV, RAX, mem64(RBX)), [0x48, 0x8B, 0x03])
+        self.assertEqual(
+            enc(MOV, mem64(RBX), RAX), [0x48, 0x89, 0x03])
+        self.assertEqual(
+            enc(MOV, R9, mem64(RBX, RCX, 8, 16)),
+            [0x4C, 0x8B, 0x4C, 0xCB, 0x10])
+        self.assertEqual(
+            enc(MOV, mem32(R8, R12, 2, 0x7F), EAX),
+            [0x43, 0x89, 0x44, 0x60, 0x7F])
+        self.assertEqual(
+            enc(ADD, mem64(RSP, disp=8), imm32(1)),
+            [0x48, 0x81, 0x44, 0x24, 0x08, 1, 0, 0, 0])
+        self.assertEqual(enc(MOV, mem8(RDI), imm8(5)), [0xC6, 0x07, 5])
+
+    def test_SSE(self):
+        self.assertEqual(enc(ADDPS, XMM1, XMM2), [0x0F, 0x58, 0xCA])
+        self.assertEqual(
+            enc(MULPD, XMM9, mem128(R12, disp=16)),
+            [0x66, 0x45, 0x0F, 0x59, 0x4C, 0x24, 0x10])
+        self.assertEqual(
+            enc(PADDD, XMM8, XMM9), [0x66, 0x45, 0x0F, 0xFE, 0xC1])
+        self.assertEqual(
+            enc(PMULLD, XMM10, XMM1), [0x66, 0x44, 0x0F, 0x38, 0x40, 0xD1])
+        self.assertEqual(
+            enc(MOVUPS, mem128(RSI), XMM15), [0x44, 0x0F, 0x11, 0x3E])
+        self.assertEqual(
+            enc(MOVDQU, XMM0, mem128(RDX)), [0xF3, 0x0F, 0x6F, 0x02])
+
+    def test_VEX(self):
+        # Two-byte VEX prefix
+        self.assertEqual(
+            enc(VADDPS, YMM0, YMM1, YMM2), [0xC5, 0xF4, 0x58, 0xC2])
+        self.assertEqual(
+            enc(VMOVUPS, mem256(RSI, disp=32), YMM9),
+            [0xC5, 0x7C, 0x11, 0x4E, 0x20])
+        # REX.B and REX.X need the three-byte prefix
+        self.assertEqual(
+            enc(VADDPS, XMM8, XMM9, XMM10), [0xC4, 0x41, 0x30, 0x58, 0xC2])
+        self.assertEqual(
+            enc(VADDPD, YMM1, YMM14, mem256(R8, R9, 4)),
+            [0xC4, 0x81, 0x0D, 0x58, 0x0C, 0x88])
+        self.assertEqual(
+            enc(VMOVDQU, mem128(R13), XMM2),
+            [0xC4, 0xC1, 0x7A, 0x7F, 0x55, 0x00])
+        # So does the 0F38 opcode map
+        self.assertEqual(
+            enc(VPMULLD, YMM2, YMM0, YMM1), [0xC4, 0xE2, 0x7D, 0x40, 0xD1])
+        self.assertEqual(
+            enc(VPADDD, XMM0, XMM15, mem128(RAX)), [0xC5, 0x81, 0xFE, 0x00])
+
+    def test_broadcast(self):
+        self.assertEqual(
+            enc(VBROADCASTSS, YMM0, mem32(RDI)),
+            [0xC4, 0xE2, 0x7D, 0x18, 0x07])
+        self.assertEqual(
+            enc(VBROADCASTSS, XMM1, XMM2), [0xC4, 0xE2, 0x79, 0x18, 0xCA])
+        self.assertEqual(
+            enc(VBROADCASTSD, YMM9, XMM1), [0xC4, 0x62, 0x7D, 0x19, 0xC9])
+        self.assertEqual(
+            enc(VPBROADCASTQ, XMM2, mem64(RAX)),
+            [0xC4, 0xE2, 0x79, 0x59, 0x10])
+        # The source is always an XMM register
+        self.assertRaises(ValueError, enc, VBROADCASTSS, YMM0, YMM1)
+        self.assertRaises(ValueError, enc, VBROADCASTSS, YMM0, mem64(RDI))
+
+    def test_memory_operand_validation(self):
+        self.assertRaises(ValueError, mem64, EAX)
+        self.assertRaises(ValueError, mem64, RAX, RSP)
+
+    def test_high_byte_registers(self):
+        self.assertEqual(enc(MOV, AH, CL), [0x88, 0xCC])
+        self.assertEqual(enc(MOV, mem8(RAX), AH), [0x88, 0x20])
+        # With a REX prefix, AH would be SPL
+        self.assertRaises(ValueError, enc, MOV, AH, R8B)
+        self.assertRaises(ValueError, enc, MOV, AH, SPL)
+        self.assertRaises(ValueError, enc, MOV, mem8(R12), AH)
+        self.assertRaises(ValueError, enc, MOV, mem8(RAX, R9), AH)
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, enc, IMUL, RAX, imm32(1))
+        self.assertRaises(ValueError, enc, ADD, EAX, 1)
+        self.assertRaises(ValueError, enc, ADDPS, XMM0, YMM1)
+        self.assertRaises(ValueError, enc, VADDPS, XMM0, XMM1, mem256(RAX))
+
+
+class AccessTests(unittest.TestCase):
+
+    def test_operands(self):
+        self.assertEqual(
+            ADD.access(RAX, RBX), (RAX.mask | RBX.mask, RAX.mask))
+        self.assertEqual(MOV.access(RAX, RBX), (RBX.mask, RAX.mask))
+        self.assertEqual(MOV.access(EAX, imm32(1)), (0, RAX.mask))
+        self.assertEqual(NEG.access(RCX), (RCX.mask, RCX.mask))
+        self.assertEqual(IMUL.access(R8, R9), (R8.mask | R9.mask, R8.mask))
+        self.assertEqual(
+            XOR.access(RAX, RBX), (RAX.mask | RBX.mask, RAX.mask))
+
+    def test_vector(self):
+        # Vector registers are not part of register masks
+        self.assertEqual(VADDPS.access(YMM0, YMM1, YMM2), (0, 0))
+        self.assertEqual(
+            MOVUPS.access(XMM0, mem128(RSI, RDI)),
+            (RSI.mask | RDI.mask, 0))
+
+    def test_zeroing_idiom(self):
+        self.assertEqual(XOR.access(EAX, EAX), (0, RAX.mask))
+
+    def test_partial(self):
+        # Writing AH leaves the rest of RAX live
+        reads, writes = MOV.access(AH, CL)
+        self.assertEqual(writes, AH.mask)
+        self.assertTrue(RAX.mask & ~writes)
+
+    def test_memory(self):
+        reads, writes = MOV.access(mem64(RBX, R12), RAX)
+        self.assertEqual(reads, RAX.mask | RBX.mask | R12.mask)
+        self.assertEqual(writes, 0)
+        reads, writes = ADD.access(RAX, mem64(RBP))
+        self.assertEqual(reads, RAX.mask | RBP.mask)
+
+    def test_implicit(self):
+        self.assertEqual(PUSH.access(RBP), (RBP.mask | RSP.mask, RSP.mask))
+        self.assertEqual(POP.access(RBP), (RSP.mask, RBP.mask | RSP.mask))
+        self.assertEqual(RET.access(), (RSP.mask, RSP.mask))
+        self.assertEqual(AAA.access(), (AX.mask, AX.mask))
+        self.assertEqual(JO.access(rel32(0)), (0, 0))
+        self.assertEqual(INT.access(imm8(3)), (ALL_REGISTERS, ALL_REGISTERS))
+
+
+class FormTests(unittest.TestCase):
+
+    def test_compile(self):
+        form = Form('ADD', 'r/m64, imm32', 'REX.W 81 /0 id')
+        self.assertEqual(form.kinds, ('r64', 'imm32'))
+        self.assertEqual(form.signatures, [
+            ('r64', 'imm32'), ('RAX', 'imm32'), ('m64', 'imm32')])
+        self.assertEqual((form.r_m, form.digit, form.imm), (0, 0, 1))
+        self.assertEqual(list(form.opcode), [0x81])
+
+    def test_prefix(self):
+        form = Form('MOV', 'r16, imm16', '66 B8+r iw')
+        self.assertEqual(list(form.prefix), [0x66])
+        self.assertEqual(form.plus_r, 0)
+
+    def test_vex(self):
+        form = Form('VPBROADCASTD', 'ymm, xmm/m32', 'VEX.256.66.0F38.W0 58 /r')
+        self.assertEqual(form.kinds, ('ymm', 'xmm'))
+        self.assertEqual(form.signatures, [('ymm', 'xmm'), ('ymm', 'm32')])
+        self.assertEqual((form.vex, form.reg, form.r_m), (1, 0, 1))
+        self.assertEqual(list(form.prefix), [0x66])
+        self.assertEqual(list(form.opcode), [0x0F, 0x38, 0x58])
+        form = Form('VADDPS', 'xmm, xmm, xmm/m128', 'VEX.128.0F.WIG 58 /r')
+        self.assertEqual((form.vex, form.reg, form.vvvv), (0, 0, 1))
+        self.assertEqual(list(form.prefix), [])
+        self.assertFalse(form.rex_w)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, Form, 'X', 'r64', 'REX.W 8F')
+        self.assertRaises(ValueError, Form, 'X', 'xmm', 'VEX.512.0F.W0 58 /r')
+        self.assertRaises(ValueError, Form, 'X', 'xmm', 'VEX.128.0F 58 /r')
+        self.assertRaises(ValueError, Form, 'X', 'r64', '8F /q')
+        self.assertRaises(ValueError, Form, 'X', 'xmm1', '8F /r')
+
+    def test_table(self):
+        self.assertEqual(
+            ENCODINGS['ADD', ('EAX', 'imm32')].encoding, '05 id')
+        self.assertEqual(
+            ENCODINGS['ADD', ('r32', 'imm32')].encoding, '81 /0 id')
@@ -0,0 +1,181 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import unittest
+
+from .assembler import Label, assemble
+from .flags import FlagSet, STATUS_FLAGS, OF, SF, ZF, CF, PF
+from .instructions import ADD, SUB, MOV, LEA, NEG, CALL, RET, JMP, JO, JE
+from .liveness import flag_liveness, register_liveness, prefer_lea
+from .operands import imm8, imm32, simm8, mem32, mem64, rel32
+from .registers import (
+    AL, RAX, RBX, RCX, RDX, RSP, RSI, RDI, R8, EAX, ECX, EDX)
+
+
+class FlagSetTests(unittest.TestCase):
+
+    def test_operators(self):
+        flags = OF | CF
+        self.assertIsInstance(flags, FlagSet)
+        self.assertEqual(flags, (1 << 11) | 1)
+        self.assertIn(OF, flags)
+        self.assertNotIn(ZF, flags)
+        self.assertEqual(list(flags), [OF, CF])
+        self.assertEqual(len(flags), 2)
+        self.assertEqual(flags - CF, OF)
+        self.assertEqual(STATUS_FLAGS & flags, flags)
+        self.assertEqual(repr(flags), 'FlagSet(OF|CF)')
+        self.assertEqual(FlagSet([SF, ZF]), SF | ZF)
+
+    def test_immutable(self):
+        written = ADD.flags_written
+        written |= FlagSet([PF])
+        written = written - STATUS_FLAGS
+        self.assertEqual(ADD.flags_written, STATUS_FLAGS)
+        self.assertEqual(SUB.flags_written, STATUS_FLAGS)
+        self.assertEqual(MOV.flags_written, 0)
+
+
+class FlagLivenessTests(unittest.TestCase):
+
+    def test_straight(self):
+        live = flag_liveness([
+            (ADD, RAX, RBX),
+            (MOV, RCX, RAX),
+            (SUB, RAX, imm32(1)),
+            (JO, rel32(0)),
+            (RET,),
+        ])
+        # JO may go anywhere, where all flags may be used
+        self.assertEqual(live, [0, 0, STATUS_FLAGS, STATUS_FLAGS, 0])
+
+    def test_live_out(self):
+        live = flag_liveness([(NEG, RAX), (MOV, RCX, RAX)], live_out=CF)
+        self.assertEqual(live, [CF, CF])
+
+    def test_branch(self):
+        target, overflow = Label(), Label()
+        live = flag_liveness([
+            (ADD, RAX, RBX),
+            (JE, target),
+            (SUB, RAX, RBX),
+            (RET,),
+            target,
+            (JO, overflow),
+            (RET,),
+            overflow,
+            (NEG, RAX),
+            (RET,),
+        ])
+        # The result of ADD is tested by JE and, at the target, by JO
+        self.assertEqual(live[0], ZF | OF)
+        self.assertEqual(live[1], OF)
+        self.assertEqual(live[2], 0)
+
+    def test_loop(self):
+        top = Label()
+        live = flag_liveness([
+            (SUB, RCX, imm32(1)),
+            top,
+            (ADD, RAX, RBX),
+            (JO, rel32(0)),
+            (SUB, RCX, imm32(1)),
+            (JE, top),
+            (JMP, top),
+        ])
+        # Flags live at the top of the loop are all overwritten by ADD
+        self.assertEqual(live[0], 0)
+        self.assertEqual(live[4], ZF)
+        self.assertEqual(live[5], 0)
+
+    def test_call(self):
+        live = flag_liveness([(ADD, RAX, RBX), (CALL, rel32(0)), (RET,)])
+        self.assertEqual(live[0], 0)
+
+
+class RegisterLivenessTests(unittest.TestCase):
+
+    def test_straight(self):
+        live = register_liveness([
+            (MOV, RAX, RDI),
+            (ADD, RAX, RBX),
+            (MOV, RCX, RAX),
+            (RET,),
+        ], live_out=RAX.mask)
+        # RET reads RSP
+        self.assertEqual(live, [
+            RAX.mask | RBX.mask | RSP.mask, RAX.mask | RSP.mask,
+            RAX.mask | RSP.mask, RAX.mask])
+
+    def test_partial(self):
+        # Writing EAX clears the upper half of RAX, writing AL keeps it
+        live = register_liveness(
+            [(MOV, EAX, EDX), (MOV, AL, imm8(1))], live_out=RAX.mask)
+        self.assertEqual(live, [RAX.mask & ~AL.mask, RAX.mask])
+        live = register_liveness([(MOV, EAX, EDX)], live_out=RAX.mask)
+        self.assertEqual(live, [RAX.mask])
+
+
+class PreferLeaTests(unittest.TestCase):
+
+    def test_fuse(self):
+        lines = prefer_lea([(MOV, RAX, RBX), (ADD, RAX, RCX), (RET,)])
+        self.assertEqual(len(lines), 2)
+        instruction, dst, address = lines[0]
+        self.assertIs(instruction, LEA)
+        self.assertIs(dst, RAX)
+        self.assertIsInstance(address, mem64)
+        self.assertEqual((address.base, address.index), (RBX, RCX))
+        self.assertEqual(assemble(lines), assemble([
+            (LEA, RAX, mem64(RBX, RCX)), (RET,)]))
+
+    def test_fuse_immediate(self):
+        lines = prefer_lea([(MOV, ECX, EDX), (SUB, ECX, imm32(8))])
+        (instruction, dst, address), = lines
+        self.assertIs(instruction, LEA)
+        self.assertIsInstance(address, mem32)
+        self.assertEqual(address.disp, -8)
+
+    def test_sign_extended_imm8(self):
+        # 83 /0 ib adds -16, not 240
+        (_, _, address), = prefer_lea(
+            [(MOV, R8, RSI), (ADD, R8, simm8(-16))])
+        self.assertEqual((address.base, address.disp), (RSI, -16))
+        (_, _, address), = prefer_lea(
+            [(MOV, RAX, RSI), (SUB, RAX, simm8(-16))])
+        self.assertEqual(address.disp, 16)
+        (_, _, address), = prefer_lea(
+            [(MOV, ECX, EDX), (ADD, ECX, simm8(-128))])
+        self.assertEqual((address.base, address.disp), (RDX, -128))
+
+    def test_fuse_self(self):
+        (_, _, address), = prefer_lea([(MOV, RAX, RBX), (ADD, RAX, RAX)])
+        self.assertEqual((address.base, address.index), (RBX, RBX))
+
+    def test_stack_pointer(self):
+        (_, _, address), = prefer_lea([(MOV, RAX, RBX), (ADD, RAX, RSP)])
+        self.assertEqual((address.base, address.index), (RSP, RBX))
+
+    def test_shorter(self):
+        # ADD RCX, imm32 is 7 bytes, LEA RCX, [RCX+8] is 4
+        lines = prefer_lea([(ADD, RCX, imm32(8))])
+        self.assertIs(lines[0][0], LEA)
+        self.assertEqual(len(assemble(lines)), 4)
+        # ADD RCX, RAX is 3 bytes, LEA RCX, [RCX+RAX] is 4
+        lines = [(ADD, RCX, RAX)]
+        self.assertEqual(prefer_lea(lines), lines)
+
+    def test_live_flags(self):
+        lines = [(MOV, RAX, RBX), (ADD, RAX, RCX), (JO, rel32(0)), (RET,)]
+        self.assertEqual(prefer_lea(lines), lines)
+        lines = [(ADD, RCX, imm32(8))]
+        self.assertEqual(prefer_lea(lines, live_out=CF), lines)
+
+    def test_labels(self):
+        target = Label()
+        lines = [(MOV, RAX, RBX), target, (ADD, RAX, RCX), (RET,)]
+        self.assertEqual(prefer_lea(lines), lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
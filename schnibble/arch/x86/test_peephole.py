@@ -0,0 +1,151 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import unittest
+
+from .assembler import Label, assemble
+from .flags import CF
+from .instructions import ADD, SUB, XOR, MOV, NEG, JO, JE, RET
+from .operands import imm8, imm16, imm32, imm64, simm8, mem64, rel32
+from .peephole import Rewrite, shortest, optimize
+from .registers import (
+    AL, AX, CX, EAX, ECX, RAX, RBX, RCX, RDX, EDX, RSP, RBP, R8, R8D)
+
+
+class ShortestTests(unittest.TestCase):
+
+    def check(self, line, expected, size):
+        short = shortest(line)
+        self.assertEqual(short[:2], expected[:2])
+        self.assertEqual(short[2].kind, expected[2].kind)
+        self.assertEqual(short[2].value, expected[2].value)
+        self.assertEqual(len(assemble([short])), size)
+        self.assertLess(size, len(assemble([line])))
+
+    def test_imm8(self):
+        self.check((ADD, RAX, imm32(1)), (ADD, RAX, simm8(1)), 4)
+        self.check((SUB, R8, imm32(-128)), (SUB, R8, simm8(-128)), 4)
+        self.check(
+            (SUB, ECX, imm32(0xFFFFFFFF)), (SUB, ECX, simm8(-1)), 3)
+        self.check((ADD, CX, imm16(0xFFF0)), (ADD, CX, simm8(-16)), 4)
+        self.check((XOR, EDX, imm32(3)), (XOR, EDX, simm8(3)), 3)
+        address = mem64(RSP)
+        self.check((ADD, address, imm32(8)), (ADD, address, simm8(8)), 5)
+
+    def test_imm8_limits(self):
+        for line in [(ADD, RAX, imm32(128)), (ADD, AL, imm8(1)),
+                     (SUB, ECX, imm32(-129)), (ADD, RAX, RBX),
+                     (ADD, AX, imm16(1))]:
+            self.assertIs(shortest(line), line)
+
+    def test_mov(self):
+        self.check((MOV, RAX, imm64(1)), (MOV, EAX, imm32(1)), 5)
+        self.check(
+            (MOV, R8, imm64(0xFFFFFFFF)), (MOV, R8D, imm32(0xFFFFFFFF)), 6)
+        self.check(
+            (MOV, RCX, imm64(-2)), (MOV, RCX, imm32(0xFFFFFFFE)), 7)
+        self.check((MOV, RCX, imm32(5)), (MOV, ECX, imm32(5)), 5)
+        line = (MOV, RCX, imm64(1 << 32))
+        self.assertIs(shortest(line), line)
+        line = (MOV, RCX, imm32(-1))
+        self.assertIs(shortest(line), line)
+
+
+class OptimizeTests(unittest.TestCase):
+
+    def rules(self, rewrites):
+        return [rewrite.rule for rewrite in rewrites]
+
+    def test_dead_move(self):
+        lines, rewrites = optimize(
+            [(MOV, RAX, RBX), (MOV, RAX, RCX), (RET,)],
+            live_registers=RAX.mask)
+        self.assertEqual(lines, [(MOV, RAX, RCX), (RET,)])
+        self.assertEqual(
+            rewrites, [Rewrite('dead-move', 0, ((MOV, RAX, RBX),), ())])
+
+    def test_partial_move(self):
+        # The upper bytes of RAX are still needed
+        lines = [(MOV, RAX, RBX), (MOV, AL, imm8(1)), (RET,)]
+        self.assertEqual(optimize(lines, live_registers=RAX.mask)[0], lines)
+
+    def test_redundant_move(self):
+        lines, rewrites = optimize(
+            [(MOV, RAX, RBX), (MOV, RBX, RAX), (MOV, RCX, RCX), (RET,)])
+        self.assertEqual(lines, [(MOV, RAX, RBX), (RET,)])
+        self.assertEqual(
+            self.rules(rewrites), ['redundant-move', 'redundant-move'])
+
+    def test_zero_extension(self):
+        # MOV EAX, EAX clears the upper half of RAX
+        lines = [(MOV, EAX, EAX), (RET,)]
+        self.assertEqual(optimize(lines)[0], lines)
+
+    def test_zero(self):
+        lines, rewrites = optimize([(MOV, RDX, imm32(0)), (RET,)])
+        self.assertEqual(lines, [(XOR, EDX, EDX), (RET,)])
+        self.assertEqual(assemble(lines), bytearray(b'\x31\xd2\xc3'))
+        self.assertEqual(self.rules(rewrites), ['zero'])
+
+    def test_zero_live_flags(self):
+        lines, rewrites = optimize(
+            [(ADD, RAX, RBX), (MOV, RDX, imm32(0)), (JO, rel32(0))])
+        self.assertEqual(lines[1], (MOV, EDX, lines[1][2]))
+        self.assertEqual(self.rules(rewrites), ['shorter'])
+
+    def test_fold(self):
+        lines, rewrites = optimize(
+            [(ADD, RAX, imm32(100)), (SUB, RAX, simm8(-1)),
+             (ADD, RAX, imm32(-80)), (RET,)])
+        (instruction, dst, value), ret = lines
+        self.assertEqual((instruction, dst), (ADD, RAX))
+        self.assertEqual((value.kind, value.value), ('simm8', 21))
+        self.assertEqual(self.rules(rewrites), ['fold', 'shorter'])
+        self.assertEqual(len(rewrites[0].before), 3)
+
+    def test_fold_to_nothing(self):
+        lines, rewrites = optimize(
+            [(ADD, RCX, imm32(8)), (SUB, RCX, imm32(8)), (RET,)])
+        self.assertEqual(lines, [(RET,)])
+        # ADD ECX, 0 clears the upper half of RCX
+        lines, rewrites = optimize(
+            [(ADD, ECX, imm32(8)), (SUB, ECX, imm32(8)), (RET,)])
+        self.assertEqual(len(lines), 2)
+
+    def test_fold_live_flags(self):
+        lines = [(ADD, RAX, simm8(1)), (ADD, RAX, simm8(1)), (JO, rel32(0))]
+        self.assertEqual(optimize(lines)[0], lines)
+        lines = [(ADD, RAX, simm8(1)), (ADD, RAX, simm8(1))]
+        self.assertEqual(optimize(lines, live_flags=CF)[0], lines)
+        lines = [(ADD, RAX, simm8(1)), (ADD, RBX, simm8(1))]
+        self.assertEqual(optimize(lines)[0], lines)
+
+    def test_labels(self):
+        loop, done = Label(), Label()
+        lines = [
+            (MOV, RCX, imm64(10)),
+            loop,
+            (SUB, RCX, imm32(1)),
+            (JE, done),
+            (ADD, RAX, imm32(2)),
+            (ADD, RAX, imm32(3)),
+            (JE, loop),
+            done,
+            (RET,),
+        ]
+        optimized, rewrites = optimize(lines, live_registers=RAX.mask)
+        self.assertEqual(
+            self.rules(rewrites), ['shorter'] * 4)
+        self.assertEqual(optimized[1], loop)
+        self.assertEqual(optimized[7], done)
+        self.assertLess(len(assemble(optimized)), len(assemble(lines)))
+
+    def test_zero_read(self):
+        # NEG reads RBP, the move is not dead
+        lines = [(MOV, RBP, imm64(0)), (NEG, RBP), (RET,)]
+        optimized, rewrites = optimize(lines)
+        self.assertEqual(optimized[0][0], XOR)
+
+
+if __name__ == '__main__':
+    unittest.main()
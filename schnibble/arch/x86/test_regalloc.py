@@ -0,0 +1,200 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import platform
+import unittest
+
+from schnibble.native import NativeFunction
+
+from .assembler import Label, assemble
+from .instructions import ADD, SUB, IMUL, MOV, CALL, JNE, RET
+from .operands import imm32, rel32
+from .regalloc import vreg, allocate, CALLER_SAVED
+from .registers import (
+    EAX, RAX, RBX, RCX, RDX, RSI, RDI, RSP, R8, R11)
+
+forX86_64 = unittest.skipIf(
+    platform.machine().lower() not in ('x86_64', 'amd64'),
+    "native code requires x86-64")
+
+
+def _fallback(*args):
+    raise AssertionError("native code failed")
+
+
+def run(lines, *args, **kwargs):
+    """Allocate registers and call the code with integer arguments."""
+    allocation = allocate(lines, **kwargs)
+    code = list(allocation.lines)
+    ret = code.pop()
+    assert ret == (RET,)
+    if allocation.frame_size:
+        code.insert(0, (SUB, RSP, imm32(allocation.frame_size)))
+        code.append((ADD, RSP, imm32(allocation.frame_size)))
+    # The native calling convention returns an overflow indicator in RDX
+    code.extend([(MOV, RDX, imm32(0)), ret])
+    function = NativeFunction(assemble(code), len(args), _fallback)
+    return function(*args), allocation
+
+
+class AllocateTests(unittest.TestCase):
+
+    def test_hints(self):
+        a, b = vreg(name='a'), vreg(name='b')
+        allocation = allocate([
+            (MOV, a, RDI),
+            (MOV, b, RSI),
+            (ADD, a, b),
+            (MOV, RAX, a),
+            (RET,),
+        ])
+        self.assertEqual(allocation.registers, {a: RDI, b: RSI})
+        # The moves between a value and its register are gone
+        self.assertEqual(
+            allocation.lines, [(ADD, RDI, RSI), (MOV, RAX, RDI), (RET,)])
+        self.assertEqual(allocation.frame_size, 0)
+
+    def test_widths(self):
+        v = vreg(32)
+        allocation = allocate(
+            [(MOV, v, imm32(1)), (ADD, v, imm32(2)), (MOV, EAX, v), (RET,)])
+        self.assertIs(allocation.registers[v], EAX)
+        self.assertEqual(len(allocation.lines), 3)
+
+    def test_fixed_registers(self):
+        # RCX holds a value while v is live, RAX is clobbered by the call
+        v = vreg()
+        allocation = allocate([
+            (MOV, RCX, imm32(1)),
+            (MOV, v, imm32(2)),
+            (ADD, v, RCX),
+            (MOV, RDX, v),
+            (MOV, RAX, RDX),
+            (RET,),
+        ], registers=(RCX, RDX, RAX))
+        self.assertIs(allocation.registers[v], RDX)
+
+    def test_call(self):
+        v = vreg()
+        allocation = allocate([
+            (MOV, v, imm32(2)),
+            (CALL, rel32(0)),
+            (MOV, RAX, v),
+            (RET,),
+        ])
+        # Every caller-saved register is clobbered by the call
+        self.assertNotIn(v, allocation.registers)
+        self.assertEqual(allocation.slots[v].disp, 0)
+        self.assertEqual(allocation.frame_size, 8)
+        allocation = allocate([
+            (MOV, v, imm32(2)),
+            (CALL, rel32(0)),
+            (MOV, RAX, v),
+            (RET,),
+        ], registers=CALLER_SAVED + (RBX,))
+        self.assertIs(allocation.registers[v], RBX)
+
+    def test_no_registers(self):
+        v = vreg()
+        # Spilled values are used from memory when possible
+        allocation = allocate(
+            [(MOV, v, imm32(1)), (ADD, v, RSI), (MOV, RAX, v), (RET,)],
+            registers=())
+        self.assertEqual(allocation.lines, [
+            (MOV, allocation.slots[v], allocation.lines[0][2]),
+            (ADD, allocation.slots[v], RSI),
+            (MOV, RAX, allocation.slots[v]),
+            (RET,)])
+        # IMUL needs a register
+        lines = [(MOV, v, imm32(1)), (IMUL, v, RSI), (MOV, RAX, v), (RET,)]
+        with self.assertRaises(ValueError):
+            allocate(lines, registers=())
+        # Once something is spilled, RCX is kept for spill code
+        w = vreg()
+        allocation = allocate(
+            [(MOV, w, RDI), (MOV, v, imm32(1)), (IMUL, v, RSI),
+             (ADD, v, w), (MOV, RAX, v), (RET,)],
+            registers=(RCX,))
+        self.assertEqual(allocation.registers, {})
+        self.assertEqual(allocation.frame_size, 16)
+        self.assertEqual(allocation.lines[2:5], [
+            (MOV, RCX, allocation.slots[v]),
+            (IMUL, RCX, RSI),
+            (MOV, allocation.slots[v], RCX)])
+
+    def test_vreg(self):
+        self.assertEqual(repr(vreg(32, 'x')), "vreg(32, 'x')")
+        self.assertRaises(ValueError, vreg, 128)
+
+
+@forX86_64
+class ExecutionTests(unittest.TestCase):
+
+    def test_arguments(self):
+        a, b, c = vreg(), vreg(), vreg()
+        result, allocation = run([
+            (MOV, a, RDI),
+            (MOV, b, RSI),
+            (MOV, c, a),
+            (IMUL, c, b),
+            (SUB, c, a),
+            (ADD, c, b),
+            (MOV, RAX, c),
+            (RET,),
+        ], 6, 7)
+        self.assertEqual(result, 6 * 7 - 6 + 7)
+        self.assertEqual(allocation.frame_size, 0)
+
+    def sum_of_products(self, count, registers):
+        # Keep count values live at the same time
+        values = [vreg(name=str(i)) for i in range(count)]
+        lines = [(MOV, RAX, RDI)]
+        for i, value in enumerate(values):
+            lines.append((MOV, value, RAX))
+            lines.append((IMUL, value, RSI))
+            lines.append((ADD, RAX, imm32(i)))
+        total = vreg(name='total')
+        lines.append((MOV, total, imm32(0)))
+        for value in reversed(values):
+            lines.append((IMUL, value, RDI))
+            lines.append((ADD, total, value))
+        lines.extend([(MOV, RAX, total), (RET,)])
+        x, y = 3, 5
+        expected = sum((x + i * (i - 1) // 2) * y * x for i in range(count))
+        result, allocation = run(lines, x, y, registers=registers)
+        self.assertEqual(result, expected)
+        return allocation
+
+    def test_spill(self):
+        # Three values and the total
+        allocation = self.sum_of_products(3, (RCX, RDX, R8, R11))
+        self.assertEqual(allocation.frame_size, 0)
+        allocation = self.sum_of_products(12, (RCX, RDX, R8, R11))
+        self.assertTrue(allocation.slots)
+        self.assertEqual(allocation.frame_size, 8 * len(allocation.slots))
+        allocation = self.sum_of_products(20, CALLER_SAVED)
+        self.assertTrue(allocation.slots)
+
+    def test_loop(self):
+        # Sum of 1..n, the values are live around the loop
+        n, total, one = vreg(name='n'), vreg(name='total'), vreg(name='one')
+        loop = Label('loop')
+        lines = [
+            (MOV, n, RDI),
+            (MOV, total, imm32(0)),
+            loop,
+            (MOV, one, imm32(1)),
+            (ADD, total, n),
+            (SUB, n, one),
+            (JNE, loop),
+            (MOV, RAX, total),
+            (RET,),
+        ]
+        self.assertEqual(run(lines, 10)[0], 55)
+        result, allocation = run(lines, 100, registers=(RCX, RDX))
+        self.assertEqual(result, 5050)
+        self.assertTrue(allocation.slots)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import unittest
+
+from .operands import mem64
+from .registers import (
+    AL, AH, AX, EAX, RAX, BH, BL, CL, SPL, SP, ESP, RSP, R8B, R8W, R8D, R8,
+    R9, GPR, GPR8_REX, ALL_REGISTERS, registers_in)
+
+
+class RegisterMaskTests(unittest.TestCase):
+
+    def test_names(self):
+        self.assertEqual(repr(AX), 'AX')
+
+    def test_accumulator(self):
+        self.assertFalse(AL.mask & AH.mask)
+        for wide in (AX, EAX, RAX):
+            self.assertTrue(AL.mask & wide.mask)
+            self.assertTrue(AH.mask & wide.mask)
+        self.assertEqual(AL.mask | AH.mask, AX.mask)
+        self.assertEqual(EAX.mask & RAX.mask, EAX.mask)
+        self.assertNotEqual(EAX.mask, RAX.mask)
+
+    def test_high_byte_registers(self):
+        # BH is bits 8-15 of RBX, SPL bits 0-7 of RSP
+        self.assertEqual(BH.mask | BL.mask, GPR[16][3].mask)
+        self.assertFalse(SPL.mask & AH.mask)
+        self.assertTrue(SPL.mask & SP.mask & ESP.mask & RSP.mask)
+
+    def test_disjoint(self):
+        registers = GPR[64]
+        for i, a in enumerate(registers):
+            for b in registers[i + 1:]:
+                self.assertFalse(a.mask & b.mask, (a, b))
+        self.assertFalse(CL.mask & AL.mask)
+        self.assertFalse(R8.mask & R9.mask)
+        self.assertEqual(
+            sum(register.mask for register in registers), ALL_REGISTERS)
+
+    def test_extended(self):
+        for register in (R8B, R8W, R8D):
+            self.assertEqual(register.mask & R8.mask, register.mask)
+        self.assertEqual(GPR8_REX[8], R8B)
+
+    def test_write_mask(self):
+        # 32-bit writes clear the upper half, narrower writes merge
+        self.assertEqual(EAX.write_mask, RAX.mask)
+        self.assertEqual(AX.write_mask, AX.mask)
+        self.assertEqual(AH.write_mask, AH.mask)
+        self.assertEqual(R8D.write_mask, R8.mask)
+
+    def test_registers_in(self):
+        self.assertEqual(registers_in(AH.mask | R8D.mask), [RAX, R8])
+        self.assertEqual(registers_in(0), [])
+        self.assertEqual(registers_in(mem64(RSP, R9).address_mask), [RSP, R9])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# coding: utf-8
+from __future__ import absolute_import
+
+import unittest
+
+from .special import ModRM, MODRM, SIB, encode_address
+
+
+class EncodeAddressTests(unittest.TestCase):
+
+    def enc(self, *args, **kwargs):
+        rex, modrm, tail = encode_address(*args, **kwargs)
+        return rex, modrm, list(tail)
+
+    def test_base(self):
+        # [rbx]
+        self.assertEqual(self.enc(3), (0, 0x03, []))
+
+    def test_shortest_displacement(self):
+        self.assertEqual(self.enc(3, disp=8), (0, 0x43, [8]))
+        self.assertEqual(self.enc(3, disp=-128), (0, 0x43, [0x80]))
+        self.assertEqual(
+            self.enc(3, disp=128), (0, 0x83, [0x80, 0, 0, 0]))
+
+    def test_rbp_needs_displacement(self):
+        self.assertEqual(self.enc(5), (0, 0x45, [0]))
+        # r13 has the same low bits
+        self.assertEqual(self.enc(13), (1, 0x45, [0]))
+
+    def test_rsp_needs_sib(self):
+        self.assertEqual(self.enc(4), (0, 0x04, [0x24]))
+        self.assertEqual(self.enc(12, disp=8), (1, 0x44, [0x24, 8]))
+
+    def test_index(self):
+        # [rbx + rcx * 8 + 16]
+        self.assertEqual(self.enc(3, 1, 8, 16), (0, 0x44, [0xCB, 16]))
+        # [r8 + r12 * 2]
+        self.assertEqual(self.enc(8, 12, 2), (3, 0x04, [0x60]))
+
+    def test_no_base(self):
+        self.assertEqual(
+            self.enc(None, 1, 4, 0x100), (0, 0x04, [0x8D, 0, 1, 0, 0]))
+        self.assertEqual(
+            self.enc(disp=0x1000), (0, 0x04, [0x25, 0, 0x10, 0, 0]))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, encode_address, 0, 4)
+        self.assertRaises(ValueError, encode_address, 0, 1, 3)
+        self.assertRaises(ValueError, encode_address, 0, None, 2)
+        self.assertRaises(ValueError, encode_address, 0, disp=1 << 31)
+
+
+class DecodeTableTests(unittest.TestCase):
+
+    def test_size(self):
+        self.assertEqual(len(MODRM), 256)
+        self.assertEqual(len(SIB), 256)
+
+    def test_modrm(self):
+        self.assertEqual(MODRM[0x44], (1, 0, 4, True, 1, False))
+        self.assertEqual(MODRM[0x05], (0, 0, 5, False, 4, True))
+        self.assertEqual(MODRM[0xD8], (3, 3, 0, False, 0, False))
+        self.assertEqual(MODRM[0x94].disp_size, 4)
+
+    def test_sib(self):
+        self.assertEqual(SIB[0xCB], (8, 1, 3))
+        self.assertEqual(SIB[0x24], (1, 4, 4))
+
+    def test_round_trip(self):
+        for byte in range(256):
+            self.assertEqual(ModRM.from_byte(byte).byte, byte)
+
+    def test_operand2(self):
+        self.assertEqual(ModRM(0b00, 0, 0b100).operand2, 'SIB')
+        self.assertEqual(ModRM(0b01, 0, 0b100).operand2, 'SIB+disp8')
+        self.assertEqual(ModRM(0b10, 0, 0b101).operand2, '[rBP]+disp32')
+        self.assertEqual(ModRM(0b00, 0, 0b101).operand2, 'disp32')
+        self.assertEqual(
+            ModRM(0b11, 0, 0b011).operand2, 'BL/rBX/MMX3/XMM3/YMM3')
+        self.assertEqual(
+            ModRM(0b11, 0b100, 0).operand1, 'AH,rSP,MMX4,XMM4,YMM4')
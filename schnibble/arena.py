@@ -0,0 +1,260 @@
+"""
+Executable memory for generated machine code.
+
+A :class:`CodeArena` maps anonymous memory in chunks and packs many pieces
+of code into each chunk with a bump allocator. Pages are never writable and
+executable at the same time: code is copied into read-write pages which are
+then switched to read-execute with ``mprotect()``. Each piece of code starts
+on a page of its own, so pages holding code are never made writable again
+and code can be added while other threads run code from the arena.
+
+The arena is also a cache keyed on the code bytes, or on an explicit key:
+adding the same code again returns the existing :class:`CodeBlock`. The
+memory mapped by the arena is bounded by a budget. When a new chunk would
+exceed it, the least recently used chunk is evicted as a whole, its blocks
+are marked as evicted and its memory is reused.
+
+Evicted code must not be called anymore. Holders of a :class:`CodeBlock`
+check :attr:`CodeBlock.evicted` and call the code while holding
+:attr:`CodeArena.lock`, which keeps other threads from evicting it in the
+meantime, then add their code again when needed, like
+:class:`schnibble.native.NativeFunction` does.
+"""
+from __future__ import absolute_import
+
+import ctypes
+import itertools
+import mmap
+import threading
+
+__all__ = ('CodeArena', 'CodeBlock', 'default_arena')
+
+#: Granularity of memory protection
+PAGE_SIZE = mmap.PAGESIZE
+
+_libc = None
+_default = None
+
+
+def _mprotect(address, size, prot):
+    """Change the protection of whole pages, see ``mprotect(2)``."""
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.mprotect.argtypes = (
+            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int)
+        _libc = libc
+    if _libc.mprotect(address, size, prot):
+        raise OSError(ctypes.get_errno(), "mprotect failed")
+
+
+def _round_up(size, alignment):
+    """Round a size up to a multiple of a power of two."""
+    return (size + alignment - 1) & ~(alignment - 1)
+
+
+class CodeBlock(object):
+    """
+    Code placed in a :class:`CodeArena`.
+
+    :attribute key:
+        Cache key of the code.
+    :attribute address:
+        Address of the first byte of the code.
+    :attribute size:
+        Length of the code, in bytes.
+    :attribute evicted:
+        True once the memory of the block has been reused. The code must
+        not be called anymore, see :attr:`CodeArena.lock`.
+    """
+
+    __slots__ = ('key', 'address', 'size', 'evicted', '_chunk')
+
+    def __init__(self, key, address, size, chunk):
+        """Initialize a block placed in a chunk."""
+        self.key = key
+        self.address = address
+        self.size = size
+        self.evicted = False
+        self._chunk = chunk
+
+    def function(self, prototype):
+        """
+        Create a function pointer to the code.
+
+        :param prototype:
+            A function type created by :func:`ctypes.CFUNCTYPE`.
+        :returns:
+            An instance of ``prototype``.
+        :raises ValueError:
+            If the block was evicted.
+        """
+        if self.evicted:
+            raise ValueError("code was evicted from its arena")
+        return prototype(self.address)
+
+    def __repr__(self):
+        """Describe the block."""
+        return "<CodeBlock {:#x} size={}{}>".format(
+            self.address, self.size, " evicted" if self.evicted else "")
+
+
+class _Chunk(object):
+    """One memory mapping of an arena."""
+
+    __slots__ = ('mapping', 'address', 'size', 'used', 'blocks', 'tick')
+
+    def __init__(self, size):
+        """Map ``size`` bytes of read-write memory."""
+        # Python only writes to mappings it opened for writing, the pages
+        # become executable once code is copied into them.
+        self.mapping = mmap.mmap(
+            -1, size, mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS,
+            mmap.PROT_READ | mmap.PROT_WRITE)
+        self.address = ctypes.addressof(
+            ctypes.c_char.from_buffer(self.mapping))
+        self.size = size
+        self.used = 0
+        self.blocks = []
+        # Last use, see CodeArena.touch()
+        self.tick = 0
+
+
+class CodeArena(object):
+    """Bounded cache of machine code in executable memory."""
+
+    def __init__(self, budget=1 << 24, chunk_size=1 << 16):
+        """
+        Initialize an empty arena.
+
+        :param budget:
+            Maximum number of bytes mapped by the arena.
+        :param chunk_size:
+            Size of each mapping, rounded up to whole pages. Code larger
+            than a chunk gets a mapping of its own.
+        :raises EnvironmentError:
+            If the platform cannot map executable memory.
+        """
+        if not hasattr(mmap, 'PROT_EXEC'):
+            raise EnvironmentError("executable memory requires POSIX mmap")
+        self.budget = budget
+        self.chunk_size = _round_up(chunk_size, PAGE_SIZE)
+        #: Number of bytes currently mapped
+        self.mapped_size = 0
+        #: Held while code is added or evicted. Hold it to check that a
+        #: block is not evicted and call its code without another thread
+        #: evicting it in between. Not reentrant, release it before adding.
+        self.lock = threading.Lock()
+        self._chunks = []
+        self._current = None
+        self._blocks = {}
+        self._ticks = itertools.count(1)
+
+    def __len__(self):
+        """Count the blocks that are not evicted."""
+        return len(self._blocks)
+
+    def add(self, code, key=None):
+        """
+        Copy code to executable memory.
+
+        :param code:
+            Machine code, a string or a bytearray.
+        :param key:
+            Cache key of the code, the code itself by default.
+        :returns:
+            A :class:`CodeBlock`, the existing one if the key is already in
+            the arena.
+        :raises ValueError:
+            If the code is larger than the budget.
+        """
+        code = bytes(code)
+        if key is None:
+            key = code
+        with self.lock:
+            block = self.lookup(key)
+            if block is not None:
+                return block
+            size = len(code)
+            chunk = self._allocate(size)
+            # Only pages after the code of the chunk are written, they are
+            # either fresh or hold evicted code.
+            offset = chunk.used
+            length = _round_up(size, PAGE_SIZE)
+            _mprotect(chunk.address + offset, length,
+                      mmap.PROT_READ | mmap.PROT_WRITE)
+            chunk.mapping[offset:offset + size] = code
+            _mprotect(chunk.address + offset, length,
+                      mmap.PROT_READ | mmap.PROT_EXEC)
+            chunk.used = offset + length
+            block = CodeBlock(key, chunk.address + offset, size, chunk)
+            chunk.blocks.append(block)
+            self._blocks[key] = block
+            self.touch(block)
+            return block
+
+    def lookup(self, key):
+        """
+        Find code in the arena.
+
+        :returns:
+            The :class:`CodeBlock` added with ``key`` or None.
+        """
+        block = self._blocks.get(key)
+        if block is not None:
+            self.touch(block)
+        return block
+
+    def touch(self, block):
+        """Mark a block, and the chunk holding it, as recently used."""
+        block._chunk.tick = next(self._ticks)
+
+    def close(self):
+        """Evict all the blocks and unmap the memory."""
+        with self.lock:
+            for chunk in self._chunks:
+                self._evict(chunk)
+                chunk.mapping.close()
+            self._chunks = []
+            self._current = None
+            self.mapped_size = 0
+
+    def _allocate(self, size):
+        """Find a chunk with room for ``size`` bytes after its blocks."""
+        chunk = self._current
+        if (chunk is not None and
+                chunk.used + _round_up(size, PAGE_SIZE) <= chunk.size):
+            return chunk
+        chunk_size = max(self.chunk_size, _round_up(size, PAGE_SIZE))
+        if chunk_size > self.budget:
+            raise ValueError(
+                "code larger than the arena budget: {} bytes".format(size))
+        while self.mapped_size + chunk_size > self.budget:
+            victim = min(self._chunks, key=lambda chunk: chunk.tick)
+            self._evict(victim)
+            if victim.size >= size:
+                self._current = victim
+                return victim
+            self._chunks.remove(victim)
+            victim.mapping.close()
+            self.mapped_size -= victim.size
+        chunk = self._current = _Chunk(chunk_size)
+        self._chunks.append(chunk)
+        self.mapped_size += chunk_size
+        return chunk
+
+    def _evict(self, chunk):
+        """Mark the blocks of a chunk as evicted and empty the chunk."""
+        for block in chunk.blocks:
+            block.evicted = True
+            del self._blocks[block.key]
+        chunk.blocks = []
+        chunk.used = 0
+
+
+def default_arena():
+    """Get the arena shared by native functions."""
+    global _default
+    if _default is None:
+        _default = CodeArena()
+    return _default
@@ -0,0 +1,4 @@
+"""Binary file formats."""
+from schnibble import _lazy
+
+_lazy.install(__name__, ('elf', 'pe'))
@@ -6,6 +6,8 @@ from __future__ import absolute_import, print_function
 import copy
 import ctypes
 
+from schnibble import trace
+
 # Indexes into the Elf32_Ehdr.e_ident array
 EI_MAG0 = 0x00
 EI_MAG1 = 0x01
@@ -246,6 +248,17 @@ class Builder(object):
         self._data_fns = []
 
     def build(self):
+        if trace.enabled:
+            token = trace.begin('elf.build')
+            off = 0
+            try:
+                off = self._build()
+            finally:
+                trace.end('elf.build', token, size=off)
+            return off
+        return self._build()
+
+    def _build(self):
         header = copy.deepcopy(self._template.header)
         # NOTE: header.e_ident is setup by the template
         # NOTE: header.e_type is setup by the template
@@ -263,20 +276,22 @@ class Builder(object):
         header.e_shentsize = ctypes.sizeof(self._template.shdr_cls)
         header.e_shnum = len(self._section_headers)
         # TODO: header.e_shstrndx = ...
-        off = self._stream.write(header)
+        # NOTE: file.write() returns None, measure the size with tell()
+        start = self._stream.tell()
+        self._stream.write(header)
         # TODO: see to beyond program headers and process data
         # allow each data callback/object to influence program
         # and section headers.
         for phdr in self._program_headers:
             # phdr.p_offset = ...
-            off += self._stream.write(phdr)
+            self._stream.write(phdr)
         for data_fn in self._data_fns:
             data = data_fn()
-            off += self._stream.write(data)
+            self._stream.write(data)
         for shdr in self._section_headers:
             # TODO: tie section header with written data
-            off += self._stream.write(shdr)
-        return off
+            self._stream.write(shdr)
+        return self._stream.tell() - start
 
     def add_program_header(self):
         phdr = self._template.phdr_cls()
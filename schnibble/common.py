@@ -1,8 +1,12 @@
 """Common code, independent of target Python version."""
 import array
 import abc
+import marshal
 import types
 import collections
+import weakref
+
+from schnibble import trace
 
 
 #: Decrement-increment pair
@@ -12,13 +16,26 @@ stack_usage = collections.namedtuple(
 
 
 class BaseOp(object):
-    """Base class for all Python bytecode operations."""
+    """
+    Base class for all Python bytecode operations.
 
-    __metaclass__ = abc.ABCMeta
+    Operations are never instantiated, they are used as classes only. The
+    abstract methods below document the interface of each instruction set
+    but are not enforced with :class:`abc.ABCMeta`, as that would make
+    defining every operation class slower without any benefit.
+    """
 
     _by_op = [None] * 255
     has_arg = False
     stack = dec_inc(0, 0)
+    #: The argument is an absolute jump target
+    has_jabs = False
+    #: The argument is a jump target relative to the next instruction
+    has_jrel = False
+    #: Execution can continue with the next instruction
+    falls_through = True
+    #: Stack change along the jump edge (``None`` means same as ``stack``)
+    jump_stack = None
 
     @classmethod
     @abc.abstractmethod
@@ -45,6 +62,19 @@ class BaseOp(object):
         raise NotImplementedError(
             "simlulation of {!r} is not implemented".format(cls.__name__))
 
+    @classmethod
+    def stack_effect(cls, op_arg):
+        """
+        Compute the stack change caused by the operation.
+
+        :param op_arg:
+            Argument of the operation or None.
+        :returns:
+            A :class:`dec_inc` tuple. By default this is :attr:`stack`,
+            operations with argument-dependent effect override this method.
+        """
+        return cls.stack
+
     @classmethod
     def register(cls, op_code):
         """Decorator for registering instruction classes."""
@@ -97,6 +127,11 @@ class FunctionBuilder(object):
         assert docstring is None or isinstance(docstring, str)
         self.buf = array.array('B')
         self.stack_changes = []
+        # List of (offset, op) pairs, one for each emitted instruction
+        self.instructions = []
+        self.labels = {}
+        self._fixups = {}
+        self._stack_usage = None
         # NOTE: vars is a subset of args
         self.vars = list(args)
         self.args = args
@@ -104,6 +139,87 @@ class FunctionBuilder(object):
         self.flags = 0
         self.level = level  # nesting level
 
+    def emit_op(self, op, arg=None, stack=None):
+        """
+        Append a single instruction to the buffer.
+
+        :param op:
+            Class of the operation to emit.
+        :param arg:
+            Integer argument of the operation, if the operation has one.
+        :param stack:
+            Optional stack change caused by the instruction. By default
+            it is computed with ``op.stack_effect(arg)``.
+        :returns:
+            Offset of the emitted instruction.
+        """
+        offset = len(self.buf)
+        self.instructions.append((offset, op))
+        self.stack_changes.append(
+            op.stack_effect(arg) if stack is None else stack)
+        self.buf.append(op.code)
+        if op.has_arg:
+            if not 0 <= arg <= 0xFFFF:
+                raise ValueError(
+                    "argument beyond 16bit range: {!r}".format(arg))
+            self.buf.append(arg & 255)
+            self.buf.append(arg >> 8)
+        return offset
+
+    def emit_jump(self, op, label):
+        """
+        Append a jump instruction targeting the given label.
+
+        :param op:
+            Class of the jump operation to emit.
+        :param label:
+            Label to jump to. The label doesn't have to be marked yet, in that
+            case the jump is resolved when :meth:`mark_label()` is called.
+        """
+        if not (op.has_jabs or op.has_jrel):
+            raise ValueError("{} is not a jump".format(op.__name__))
+        offset = self.emit_op(op, 0)
+        if label in self.labels:
+            self._patch_jump(offset, op, self.labels[label])
+        else:
+            self._fixups.setdefault(label, []).append((offset, op))
+
+    def mark_label(self, label):
+        """
+        Associate a label with the current position in the buffer.
+
+        :param label:
+            Any hashable object identifying a jump target.
+        :raises ValueError:
+            If the label was already marked.
+        """
+        if label in self.labels:
+            raise ValueError("label {!r} marked twice".format(label))
+        target = len(self.buf)
+        self.labels[label] = target
+        for offset, op in self._fixups.pop(label, ()):
+            self._patch_jump(offset, op, target)
+
+    @property
+    def unresolved_labels(self):
+        """Labels that are used by jumps but were never marked."""
+        return list(self._fixups)
+
+    def _patch_jump(self, offset, op, target):
+        """Write the argument of a jump so that it lands on ``target``."""
+        arg = target if op.has_jabs else target - (offset + 3)
+        if not 0 <= arg <= 0xFFFF:
+            raise ValueError("jump beyond 16bit range: {!r}".format(arg))
+        self.buf[offset + 1] = arg & 255
+        self.buf[offset + 2] = arg >> 8
+        # The buffer length is unchanged, forget the analysis of the old jump
+        self._stack_usage = None
+
+    def _jump_target(self, offset, op):
+        """Compute the offset the jump at ``offset`` lands on."""
+        arg = self.buf[offset + 1] | (self.buf[offset + 2] << 8)
+        return arg if op.has_jabs else offset + 3 + arg
+
     def stack_usage(self):
         """
         Analyze stack usage.
@@ -111,16 +227,127 @@ class FunctionBuilder(object):
         :returns:
             Tuple ``(min_size, final_size, max_size)`` that represents
             stack usage.
+        :raises ValueError:
+            If the stack depth is inconsistent where control flow merges,
+            jumps don't land on instruction boundaries or some jumps target
+            labels which are not marked yet.
+
+        Straight-line code is analyzed by summing stack changes in the order
+        of emission. Code with jumps is split into basic blocks and analyzed
+        with a single pass over the control flow graph so that the result is
+        exact across all execution paths.
+        """
+        if self._fixups:
+            raise ValueError(
+                "unresolved labels: {!r}".format(self.unresolved_labels))
+        key = len(self.stack_changes), len(self.buf)
+        if self._stack_usage is not None and self._stack_usage[0] == key:
+            return self._stack_usage[1]
+        if any(op.has_jabs or op.has_jrel for _, op in self.instructions):
+            usage = self._flow_stack_usage()
+        else:
+            min_size = 0
+            max_size = 0
+            size = 0
+            for mod in self.stack_changes:
+                size += mod.dec
+                min_size = min(min_size, size)
+                size += mod.inc
+                max_size = max(max_size, size)
+            usage = stack_usage(min_size, size, max_size)
+        self._stack_usage = (key, usage)
+        return usage
+
+    def _basic_blocks(self):
+        """
+        Split instructions into basic blocks.
+
+        :returns:
+            List of ``(start, end)`` index ranges into :attr:`instructions`
+            and a dictionary mapping instruction offsets to block numbers.
         """
-        min_size = 0
-        max_size = 0
-        size = 0
-        for mod in self.stack_changes:
-            size += mod.dec
-            min_size = min(min_size, size)
-            size += mod.inc
-            max_size = max(max_size, size)
-        return stack_usage(min_size, size, max_size)
+        instructions = self.instructions
+        index = {offset: i for i, (offset, op) in enumerate(instructions)}
+        index[len(self.buf)] = len(instructions)
+        leaders = {0}
+        for i, (offset, op) in enumerate(instructions):
+            if op.has_jabs or op.has_jrel:
+                target = self._jump_target(offset, op)
+                if target not in index:
+                    raise ValueError(
+                        "jump at offset {} lands inside an instruction".format(
+                            offset))
+                leaders.add(index[target])
+                leaders.add(i + 1)
+            elif not op.falls_through:
+                leaders.add(i + 1)
+        leaders = sorted(leaders)
+        blocks = list(zip(leaders, leaders[1:] + [len(instructions)]))
+        block_at = {self._block_offset(start): n
+                    for n, (start, end) in enumerate(blocks)}
+        return blocks, block_at
+
+    def _flow_stack_usage(self):
+        """Analyze stack usage along the control flow graph."""
+        blocks, block_at = self._basic_blocks()
+        # Per-block summary: (low, high, successors) where low and high are
+        # relative to the depth on entry and successors is a list of
+        # (block, delta) pairs. Each block is summarized exactly once.
+        summaries = []
+        for n, (start, end) in enumerate(blocks):
+            low = high = size = 0
+            successors = []
+            falls_through = True
+            for i in range(start, end):
+                offset, op = self.instructions[i]
+                mod = self.stack_changes[i]
+                if op.has_jabs or op.has_jrel:
+                    jump_mod = op.jump_stack or mod
+                    low = min(low, size + jump_mod.dec)
+                    high = max(high, size + jump_mod.dec + jump_mod.inc)
+                    successors.append((
+                        block_at[self._jump_target(offset, op)],
+                        size + jump_mod.dec + jump_mod.inc))
+                size += mod.dec
+                low = min(low, size)
+                size += mod.inc
+                high = max(high, size)
+                falls_through = op.falls_through
+            if falls_through and end < len(self.instructions):
+                successors.append((n + 1, size))
+            summaries.append((low, high, successors, size))
+        depths = {0: 0}
+        pending = [0]
+        min_size = max_size = 0
+        final_size = None
+        while pending:
+            n = pending.pop()
+            depth = depths[n]
+            low, high, successors, size = summaries[n]
+            min_size = min(min_size, depth + low)
+            max_size = max(max_size, depth + high)
+            if not successors:
+                if final_size is not None and final_size != depth + size:
+                    raise ValueError(
+                        "inconsistent stack depth on exit: {} != {}".format(
+                            final_size, depth + size))
+                final_size = depth + size
+            for succ, delta in successors:
+                if succ not in depths:
+                    depths[succ] = depth + delta
+                    pending.append(succ)
+                elif depths[succ] != depth + delta:
+                    raise ValueError(
+                        "inconsistent stack depth at offset {}: {} != {}"
+                        .format(self._block_offset(blocks[succ][0]),
+                                depths[succ], depth + delta))
+        return stack_usage(min_size, final_size or 0, max_size)
+
+    def _block_offset(self, start):
+        """Get the buffer offset of the instruction at index ``start``."""
+        if start < len(self.instructions):
+            return self.instructions[start][0]
+        return len(self.buf)
 
     def is_valid_stack(self):
         """Check if stack usage is correct."""
@@ -158,10 +385,17 @@ class BaseEmitterContext(object):
 
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self):
-        """Initialize context with empty code and stack changes buffers."""
+    def __init__(self, code_cache=None):
+        """
+        Initialize context with empty code and stack changes buffers.
+
+        :param code_cache:
+            Optional :class:`CodeCache` used by :meth:`make_code()` to share
+            identical code objects.
+        """
         self._incomplete = [FunctionBuilder((), None)]
         self._complete = []
+        self.code_cache = code_cache
 
     @property
     def current_builder(self):
@@ -191,12 +425,33 @@ class BaseEmitterContext(object):
 
     def emit(self, *nodes):
         """Emit instruction from a tree of Emittable objets."""
+        if trace.enabled:
+            return self._emit_traced(nodes)
         for node in nodes:
             if not isinstance(node, Emittable):
                 raise TypeError("node: {!r} is not Emittable".format(node))
             node.emit(self)
         return self
 
+    def _emit_traced(self, nodes):
+        """Emit nodes, reporting the emit event."""
+        builder = self.current_builder
+        size = len(builder.buf)
+        completed = len(self._complete)
+        token = trace.begin('emit', nodes=len(nodes))
+        try:
+            for node in nodes:
+                if not isinstance(node, Emittable):
+                    raise TypeError(
+                        "node: {!r} is not Emittable".format(node))
+                node.emit(self)
+        finally:
+            size = len(builder.buf) - size + sum(
+                len(done.buf) for done in self._complete[completed:])
+            trace.end('emit', token, nodes=len(nodes), size=size,
+                      completed=len(self._complete) - completed)
+        return self
+
     def emit_fragment(self, *nodes):
         """Emit a code fragment (without a Function() node)."""
         self.emit(*nodes)
@@ -212,6 +467,74 @@ class BaseEmitterContext(object):
         """Create a code object out of what is in the context."""
 
 
+class CodeCache(object):
+    """
+    Cache of code objects keyed on their content.
+
+    The cache keeps strong references to a bounded number of recently used
+    code objects and weak references to all the others, so a code object is
+    shared for as long as anything else keeps it alive.
+    """
+
+    def __init__(self, size=256):
+        """
+        Initialize an empty cache.
+
+        :param size:
+            Number of recently used code objects to keep alive.
+        """
+        self.size = size
+        self._recent = collections.OrderedDict()
+        self._alive = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        """Count the code objects that are alive in the cache."""
+        return len(self._alive)
+
+    @staticmethod
+    def key(fields):
+        """
+        Compute the cache key of a code object.
+
+        :param fields:
+            Tuple of all the arguments of the code object constructor.
+        :returns:
+            Digest of the fields or None if they cannot be serialized.
+
+        The fields are serialized with :mod:`marshal`, which distinguishes
+        values that compare equal but have different types, such as ``1``,
+        ``1.0`` and ``True``.
+        """
+        # hashlib is slow to import and rarely needed
+        import hashlib
+        try:
+            data = marshal.dumps(fields, 0)
+        except ValueError:
+            return None
+        return hashlib.sha1(data).digest()
+
+    def get_or_create(self, fields, factory):
+        """
+        Get a cached code object or create and cache a new one.
+
+        :param fields:
+            Tuple of all the arguments of the code object constructor.
+        :param factory:
+            Callable creating the code object out of ``fields``.
+        """
+        key = self.key(fields)
+        if key is None:
+            return factory(*fields)
+        code = self._alive.get(key)
+        if code is None:
+            code = self._alive[key] = factory(*fields)
+        self._recent.pop(key, None)
+        self._recent[key] = code
+        while len(self._recent) > self.size:
+            self._recent.popitem(last=False)
+        return code
+
+
 class Emittable(object):
     """Interface of objects that participate in code emission."""
 
@@ -258,8 +581,161 @@ class UnemitterContext(object):
         self.retval = None
         self.ops = []
 
+    def make_node(self, node_cls, *args):
+        """
+        Create a node representing the result of a simulated operation.
 
-def unemit(code, op_cls):
+        :param node_cls:
+            Class of the node to create.
+        :param args:
+            Arguments of the node, as passed to the node constructor.
+        :returns:
+            The new node.
+        """
+        return node_cls(*args)
+
+
+class ArrayUnemitterContext(UnemitterContext):
+    """
+    Context used for simulation, storing nodes in compact arrays.
+
+    Instead of creating node objects, each node is represented by an index
+    into parallel arrays. ``kinds[i]`` is an index into :attr:`node_types`,
+    ``args[i]`` is the argument (or None) and the children of the node are
+    ``children[first_child[i]:first_child[i] + child_count[i]]``. Values on
+    the simulated stack, in :attr:`ops`, :attr:`locals` and :attr:`retval`
+    are node indices. Use :meth:`view()` to inspect a node and
+    :meth:`NodeView.materialize()` to create the equivalent node objects.
+    """
+
+    def __init__(self, code):
+        """
+        Initialize the unemitter context for the given code object.
+
+        :param code:
+            Code object used as a reference for lookaside tables.
+        """
+        super(ArrayUnemitterContext, self).__init__(code)
+        self.ops = array.array('l')
+        self.node_types = []
+        self._kind_of = {}
+        self.kinds = array.array('B')
+        self.args = []
+        self.first_child = array.array('l')
+        self.child_count = array.array('H')
+        self.children = array.array('l')
+
+    def make_node(self, node_cls, *args):
+        """
+        Create a node representing the result of a simulated operation.
+
+        :param node_cls:
+            Class of the node to create.
+        :param args:
+            Arguments of the node, as passed to the node constructor.
+        :returns:
+            Index of the new node.
+        """
+        try:
+            kind = self._kind_of[node_cls]
+        except KeyError:
+            kind = self._kind_of[node_cls] = len(self.node_types)
+            self.node_types.append(node_cls)
+        if node_cls.op.has_arg:
+            self.args.append(args[0])
+            args = args[1:]
+        else:
+            self.args.append(None)
+        self.kinds.append(kind)
+        self.first_child.append(len(self.children))
+        self.child_count.append(len(args))
+        self.children.extend(args)
+        return len(self.kinds) - 1
+
+    def view(self, index):
+        """Get a :class:`NodeView` of the node with the given index."""
+        return NodeView(self, index)
+
+    @property
+    def statements(self):
+        """List of views of all the top-level statements."""
+        return [NodeView(self, index) for index in self.ops]
+
+
+class NodeView(object):
+    """Lightweight view of a node stored in an ArrayUnemitterContext."""
+
+    __slots__ = ('ctx', 'index')
+
+    def __init__(self, ctx, index):
+        """
+        Initialize the view.
+
+        :param ctx:
+            The :class:`ArrayUnemitterContext` with the node.
+        :param index:
+            Index of the node.
+        """
+        self.ctx = ctx
+        self.index = index
+
+    @property
+    def node_type(self):
+        """Class of the node."""
+        return self.ctx.node_types[self.ctx.kinds[self.index]]
+
+    @property
+    def arg(self):
+        """Argument of the node, or None."""
+        return self.ctx.args[self.index]
+
+    @property
+    def children(self):
+        """List of views of children nodes."""
+        start = self.ctx.first_child[self.index]
+        end = start + self.ctx.child_count[self.index]
+        return [NodeView(self.ctx, index)
+                for index in self.ctx.children[start:end]]
+
+    def materialize(self, memo=None):
+        """
+        Create node objects for this node and all of its descendants.
+
+        :param memo:
+            Optional dictionary mapping node indices to already created
+            nodes. Nodes used more than once are created only once.
+        """
+        if memo is None:
+            memo = {}
+        try:
+            return memo[self.index]
+        except KeyError:
+            pass
+        node_cls = self.node_type
+        children = [child.materialize(memo) for child in self.children]
+        if node_cls.op.has_arg:
+            node = node_cls(self.arg, *children)
+        else:
+            node = node_cls(*children)
+        memo[self.index] = node
+        return node
+
+    def __eq__(self, other):
+        """Compare NodeView with another object."""
+        if isinstance(other, NodeView):
+            return self.ctx is other.ctx and self.index == other.index
+        return self.materialize() == other
+
+    def __ne__(self, other):
+        """Compare NodeView with another object."""
+        return not self == other
+
+    def __repr__(self):
+        """Compute the representation of a NodeView."""
+        return "<NodeView {} {!r}>".format(self.index, self.materialize())
+
+
+def unemit(code, op_cls, context_cls=UnemitterContext):
     """
     Analyze a code object and re-create operation nodes.
 
@@ -267,10 +743,55 @@ def unemit(code, op_cls):
         A code object as stored in __code__ of functions.A
     :param op_cls:
         Base class for the instruction set.
+    :param context_cls:
+        Class of the context used for simulation. Use
+        :class:`ArrayUnemitterContext` to store nodes in compact arrays.
 
     At present please use the :class:`Py27Op` here.
     """
-    ctx = UnemitterContext(code)
+    ctx = context_cls(code)
     for op, op_arg in iter_ops(code, op_cls):
-        op.simulate(ctx, op_arg)
+        if trace.enabled:
+            _simulate_traced(ctx, op, op_arg)
+        else:
+            op.simulate(ctx, op_arg)
     return ctx
+
+
+def _simulate_traced(ctx, op, op_arg):
+    """Simulate an operation, reporting the simulate event."""
+    token = trace.begin('simulate', op=op)
+    try:
+        op.simulate(ctx, op_arg)
+    finally:
+        trace.end('simulate', token, op=op, stack=len(ctx.stack))
+
+
+def iter_unemit(code, op_cls):
+    """
+    Analyze a code object and yield operation nodes as they are recovered.
+
+    :param code:
+        A code object as stored in __code__ of functions.
+    :param op_cls:
+        Base class for the instruction set.
+    :returns:
+        A generator of top-level statements (e.g. ``Store`` or ``Return``)
+
+    This is a streaming variant of :func:`unemit()`. Each statement is yielded
+    as soon as the simulation of the instruction that completes it finishes.
+    Statements are not accumulated in the context and the stack entries they
+    consumed are released as the simulation progresses so memory usage is
+    bounded by the largest single statement, not by the size of the function.
+    """
+    ctx = UnemitterContext(code)
+    ops = ctx.ops
+    for op, op_arg in iter_ops(code, op_cls):
+        if trace.enabled:
+            _simulate_traced(ctx, op, op_arg)
+        else:
+            op.simulate(ctx, op_arg)
+        if ops:
+            for node in ops:
+                yield node
+            del ops[:]
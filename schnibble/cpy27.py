@@ -3,6 +3,7 @@
 import types
 
 from schnibble import common
+from schnibble.cpy27_opcodes import OPNAMES
 
 FLAG_OPTIMIZED = 0x000001
 FLAG_NEWLOCALS = 0x000002
@@ -27,6 +28,9 @@ class Py27EmitterContext(common.BaseEmitterContext):
         # TODO: add nodes for setting filename, function name and the like
         # so that make_code() can just work without any extra knowledge and
         # no capacity is lost.
+        if builder.unresolved_labels:
+            raise ValueError("cannot make code, labels {!r} are not marked"
+                             .format(builder.unresolved_labels))
         stack_usage = builder.stack_usage()
         if not builder.is_valid_stack():
             raise ValueError("cannot make code, stack is not balanced")
@@ -50,28 +54,36 @@ class Py27EmitterContext(common.BaseEmitterContext):
             flags |= FLAG_NOFREE
         if builder.level >= 1:
             flags |= FLAG_NESTED
-        return types.CodeType(
+        fields = (
             argcount, nlocals, stacksize, flags, codestring,
             constants, names, varnames, filename, name, firstlineno, lnotab,
             freevars, cellvars)
+        if self.code_cache is not None:
+            return self.code_cache.get_or_create(fields, types.CodeType)
+        return types.CodeType(*fields)
 
 
 class Py27Op(common.BaseOp):
     """Base class for all Python 2.7 bytecode instructions."""
 
     _by_op = [None] * 255
-    _blacklisted_ops = {
-        # Instructions that are not used by Python 2.7
-        6, 7, 8, 14, 16, 17, 18, 34, 35, 36, 37, 38, 39,
-        44, 45, 46, 47, 48, 49, 69, 117, 118, 123, 127,
-        128, 129, 138, 139, 144,
-        # NOTE: last valid instruction is 147
-    }
 
     @classmethod
     def is_valid_op_code(cls, op_code):
         """Check if given operation code is valid for CPython 2.7."""
-        return 0 <= op_code <= 147 and op_code not in cls._blacklisted_ops
+        return 0 <= op_code < len(OPNAMES) and OPNAMES[op_code] is not None
+
+
+@Py27Op.register(4)
+class DUP_TOP(Py27Op):
+    """Duplicate the topmost item on the stack."""
+
+    stack = common.dec_inc(-1, +2)
+
+    @classmethod
+    def simulate(cls, ctx, op_arg):
+        """Simulate execution of the operation."""
+        ctx.stack.append(ctx.stack[-1])
 
 
 @Py27Op.register(11)
@@ -83,7 +95,7 @@ class UNARY_NEGATIVE(Py27Op):
     @classmethod
     def simulate(cls, ctx, op_arg):
         """Simulate execution of the operation."""
-        ctx.stack.append(Neg(ctx.stack.pop()))
+        ctx.stack.append(ctx.make_node(Neg, ctx.stack.pop()))
 
 
 @Py27Op.register(20)
@@ -97,7 +109,7 @@ class BINARY_MULTIPLY(Py27Op):
         """Simulate execution of the operation."""
         b = ctx.stack.pop()
         a = ctx.stack.pop()
-        result = Multiply(a, b)
+        result = ctx.make_node(Multiply, a, b)
         ctx.stack.append(result)
 
 
@@ -112,7 +124,7 @@ class LOAD_CONST(Py27Op):
     def simulate(cls, ctx, op_arg):
         """Simulate execution of the operation."""
         value = ctx.consts[op_arg]
-        result = Const(value)
+        result = ctx.make_node(Const, value)
         ctx.stack.append(result)
 
 
@@ -127,7 +139,7 @@ class LOAD_FAST(Py27Op):
     def simulate(cls, ctx, op_arg):
         """Simulate execution of the operation."""
         varname = ctx.varnames[op_arg]
-        result = Load(varname)
+        result = ctx.make_node(Load, varname)
         ctx.stack.append(result)
 
 
@@ -143,7 +155,7 @@ class STORE_FAST(Py27Op):
         """Simulate execution of the operation."""
         varname = ctx.varnames[op_arg]
         value = ctx.stack.pop()
-        result = Store(varname, value)
+        result = ctx.make_node(Store, varname, value)
         ctx.locals[op_arg] = result
         ctx.ops.append(result)
 
@@ -159,7 +171,7 @@ class BINARY_ADD(Py27Op):
         """Simulate execution of the operation."""
         b = ctx.stack.pop()
         a = ctx.stack.pop()
-        result = Add(a, b)
+        result = ctx.make_node(Add, a, b)
         ctx.stack.append(result)
 
 
@@ -174,7 +186,7 @@ class BINARY_SUBTRACT(Py27Op):
         """Simulate execution of the operation."""
         b = ctx.stack.pop()
         a = ctx.stack.pop()
-        result = Subtract(a, b)
+        result = ctx.make_node(Subtract, a, b)
         ctx.stack.append(result)
 
 
@@ -183,15 +195,95 @@ class RETURN_VALUE(Py27Op):
     """Pop one value and return it."""
 
     stack = common.dec_inc(-1, +0)
+    falls_through = False
 
     @classmethod
     def simulate(cls, ctx, op_arg):
         """Simulate execution of the operation."""
-        result = Return(ctx.stack.pop())
+        result = ctx.make_node(Return, ctx.stack.pop())
         ctx.retval = result
         ctx.ops.append(result)
 
 
+@Py27Op.register(131)
+class CALL_FUNCTION(Py27Op):
+    """
+    Call a function.
+
+    The low byte of the argument is the number of positional arguments, the
+    high byte is the number of keyword arguments. Keyword arguments are not
+    supported yet.
+    """
+
+    has_arg = True
+
+    @classmethod
+    def stack_effect(cls, op_arg):
+        """Compute the stack change caused by the operation."""
+        return common.dec_inc(
+            -((op_arg & 255) + 2 * (op_arg >> 8) + 1), +1)
+
+    @classmethod
+    def simulate(cls, ctx, op_arg):
+        """Simulate execution of the operation."""
+        if op_arg >> 8:
+            raise NotImplementedError(
+                "simulation of keyword arguments is not implemented")
+        args = ctx.stack[len(ctx.stack) - op_arg:]
+        del ctx.stack[len(ctx.stack) - op_arg:]
+        func = ctx.stack.pop()
+        ctx.stack.append(ctx.make_node(Call, op_arg, func, *args))
+
+
+@Py27Op.register(110)
+class JUMP_FORWARD(Py27Op):
+    """Jump forward by the given number of bytes."""
+
+    has_arg = True
+    has_jrel = True
+    falls_through = False
+
+
+@Py27Op.register(113)
+class JUMP_ABSOLUTE(Py27Op):
+    """Jump to the given offset."""
+
+    has_arg = True
+    has_jabs = True
+    falls_through = False
+
+
+@Py27Op.register(114)
+class POP_JUMP_IF_FALSE(Py27Op):
+    """Pop the topmost item from the stack and jump if it is false."""
+
+    has_arg = True
+    has_jabs = True
+    stack = common.dec_inc(-1, +0)
+
+
+@Py27Op.register(115)
+class POP_JUMP_IF_TRUE(Py27Op):
+    """Pop the topmost item from the stack and jump if it is true."""
+
+    has_arg = True
+    has_jabs = True
+    stack = common.dec_inc(-1, +0)
+
+
+@Py27Op.register(120)
+class SETUP_LOOP(Py27Op):
+    """Push a loop block ending at the given relative offset."""
+
+    has_arg = True
+    has_jrel = True
+
+
+@Py27Op.register(87)
+class POP_BLOCK(Py27Op):
+    """Pop the innermost block."""
+
+
 class OperationNode(common.Emittable):
     """Base class for nodes associated with operations."""
 
@@ -236,12 +328,11 @@ class OperationNode(common.Emittable):
         """Emit instructions to the specified EmitterContext."""
         for child in self.children:
             child.emit(ctx)
-        ctx.current_builder.stack_changes.append(self.op.stack)
-        ctx.current_builder.buf.append(self.op.code)
         if self.op.has_arg:
-            arg = self.translate_arg(ctx, self.arg)
-            ctx.current_builder.buf.append(arg & 255)
-            ctx.current_builder.buf.append(arg >> 8)
+            ctx.current_builder.emit_op(
+                self.op, self.translate_arg(ctx, self.arg))
+        else:
+            ctx.current_builder.emit_op(self.op)
 
     @classmethod
     def translate_arg(cls, ctx, arg):
@@ -329,6 +420,42 @@ class Neg(OperationNode):
     op = UNARY_NEGATIVE
 
 
+class Dup(OperationNode):
+    """
+    Duplicate top of the stack node.
+
+    The node has no children, it duplicates the value computed by whatever
+    was emitted just before it. ``Multiply(Load('a'), Dup())`` computes the
+    square of ``a``.
+    """
+
+    op = DUP_TOP
+
+
+class Call(OperationNode):
+    """
+    Function call node.
+
+    The argument is the number of positional arguments. The first child is
+    the called function and the remaining children are the arguments, for
+    example ``Call(1, Load('f'), Const(2))`` computes ``f(2)``.
+    """
+
+    op = CALL_FUNCTION
+
+    def __init__(self, *args):
+        """
+        Initialize a call node.
+
+        :raises ValueError:
+            If the argument count doesn't match the number of children.
+        """
+        super(Call, self).__init__(*args)
+        if self.arg != len(self.children) - 1:
+            raise ValueError("Call({!r}) with {} argument node(s)".format(
+                self.arg, len(self.children) - 1))
+
+
 class Return(OperationNode):
     """Function return node."""
 
@@ -471,3 +598,117 @@ class Const(OperationNode):
         """
         ctx.current_builder.add_const(self.arg)
         super(Const, self).emit(ctx)
+
+
+class Label(common.Emittable):
+    """Jump target node."""
+
+    def __init__(self, name=None):
+        """
+        Initialize a label.
+
+        :param name:
+            Optional name, used only for readability.
+
+        Labels are compared by identity. The same label object must be used
+        as the argument of jump nodes and as a node in the function body, at
+        the place where the jump should land.
+        """
+        self.name = name
+
+    def __repr__(self):
+        """Compute the representation of a Label."""
+        return "Label({!r})".format(self.name)
+
+    def emit(self, ctx):
+        """Mark the label in the specified EmitterContext."""
+        ctx.current_builder.mark_label(self)
+
+
+class JumpNode(OperationNode):
+    """Base class for jump nodes, the argument is a :class:`Label`."""
+
+    def emit(self, ctx):
+        """
+        Emit instructions to the specified EmitterContext.
+
+        :param ctx:
+            The EmitterContext associated with the translation.
+        """
+        for child in self.children:
+            child.emit(ctx)
+        ctx.current_builder.emit_jump(self.op, self.arg)
+
+
+class Jump(JumpNode):
+    """Unconditional jump node."""
+
+    op = JUMP_ABSOLUTE
+
+
+class JumpForward(JumpNode):
+    """Unconditional forward (relative) jump node."""
+
+    op = JUMP_FORWARD
+
+
+class JumpIfFalse(JumpNode):
+    """Conditional jump node, taken when the condition is false."""
+
+    op = POP_JUMP_IF_FALSE
+
+
+class JumpIfTrue(JumpNode):
+    """Conditional jump node, taken when the condition is true."""
+
+    op = POP_JUMP_IF_TRUE
+
+
+class While(common.Emittable):
+    """Loop node, executes the body while the condition is true."""
+
+    def __init__(self, cond, *body):
+        """
+        Initialize a loop node.
+
+        :param cond:
+            Node computing the condition, evaluated before each iteration.
+        :param body:
+            List of statement nodes executed in each iteration.
+
+        The loop is emitted the way CPython 2.7 compiles a ``while``
+        statement, inside a ``SETUP_LOOP`` / ``POP_BLOCK`` block.
+        """
+        self.cond = cond
+        self.body = body
+
+    def __eq__(self, other):
+        """Compare While with another object."""
+        if type(other) != type(self):
+            return False
+        return self.__dict__ == other.__dict__
+
+    def __repr__(self):
+        """Compute the representation of a While."""
+        return "While({})".format(
+            ', '.join(repr(node) for node in (self.cond,) + self.body))
+
+    def emit(self, ctx):
+        """
+        Emit instructions to the specified EmitterContext.
+
+        :param ctx:
+            The EmitterContext associated with the translation.
+        """
+        top, done, end = Label('top'), Label('done'), Label('end')
+        builder = ctx.current_builder
+        builder.emit_jump(SETUP_LOOP, end)
+        builder.mark_label(top)
+        self.cond.emit(ctx)
+        builder.emit_jump(POP_JUMP_IF_FALSE, done)
+        for stmt in self.body:
+            stmt.emit(ctx)
+        builder.emit_jump(JUMP_ABSOLUTE, top)
+        builder.mark_label(done)
+        builder.emit_op(POP_BLOCK)
+        builder.mark_label(end)
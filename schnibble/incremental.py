@@ -0,0 +1,288 @@
+"""
+Incremental analysis of a tree of Python source files.
+
+The :class:`Analyzer` keeps a persistent store of analysis results keyed on
+the content hash of each function. Only files that changed since the last
+scan are recompiled and only functions with a new hash are analyzed again.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import hashlib
+import os
+import shelve
+import time
+import types
+
+from schnibble.common import unemit
+from schnibble.cpy27 import Py27Op
+
+#: Outcome of analyzing one function. When the analysis fails ``value`` is
+#: None and ``error`` describes the exception that was raised. The store
+#: holds plain tuples, pickles of this class would refer to ``__main__``
+#: when the module is run as a script.
+Result = collections.namedtuple("Result", "digest value error")
+
+#: Summary of one scan.
+#:
+#: ``changed`` and ``removed`` are lists of file paths. ``analyzed`` and
+#: ``reused`` are lists of ``(path, qualname)`` pairs of functions in changed
+#: files that were analyzed or taken from the store, respectively.
+ScanReport = collections.namedtuple(
+    "ScanReport", "changed removed analyzed reused")
+
+
+def code_digest(code):
+    """
+    Compute the content hash of a code object.
+
+    :param code:
+        A code object.
+    :returns:
+        Hexadecimal SHA-1 digest.
+
+    The hash covers the bytecode and all of the lookaside tables (constants,
+    names, local variables, free and cell variables) as well as flags and
+    sizes. Nested code objects contribute their own digest. File names and
+    line numbers are not included so that moving a function around doesn't
+    invalidate its results.
+    """
+    h = hashlib.sha1()
+    for value in (code.co_argcount, code.co_nlocals, code.co_stacksize,
+                  code.co_flags):
+        h.update('{}\0'.format(value))
+    h.update(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            h.update('code:{}\0'.format(code_digest(const)))
+        else:
+            h.update('{}:{!r}\0'.format(type(const).__name__, const))
+    for table in (code.co_names, code.co_varnames, code.co_freevars,
+                  code.co_cellvars):
+        h.update('{!r}\0'.format(table))
+    return h.hexdigest()
+
+
+def iter_functions(code, prefix=None):
+    """
+    Iterate over a code object and all code objects nested in it.
+
+    :param code:
+        A code object, typically of a whole module.
+    :param prefix:
+        Qualified name of the parent code object.
+    :returns:
+        A generator of ``(qualname, code)`` pairs. Names of nested code
+        objects are joined with dots. When several code objects of one scope
+        share a name, like lambdas do, the line number of each but the first
+        is appended, e.g. ``<module>.<lambda>@3``.
+    """
+    qualname = code.co_name if prefix is None else '{}.{}'.format(
+        prefix, code.co_name)
+    return _iter_functions(qualname, code)
+
+
+def _iter_functions(qualname, code):
+    """Implementation of :func:`iter_functions()`, with a qualified name."""
+    yield qualname, code
+    names = set()
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            name = const.co_name
+            if name in names:
+                name = '{}@{}'.format(name, const.co_firstlineno)
+                # Several lambdas can start on the same line
+                count = 1
+                while name in names:
+                    count += 1
+                    name = '{}@{}#{}'.format(
+                        const.co_name, const.co_firstlineno, count)
+            names.add(name)
+            for item in _iter_functions('{}.{}'.format(qualname, name), const):
+                yield item
+
+
+def unemit_ops(code):
+    """Default analysis, list of statements recovered by unemit()."""
+    return unemit(code, Py27Op).ops
+
+
+class Analyzer(object):
+    """Incremental analyzer of all Python files in a directory tree."""
+
+    def __init__(self, root, store_path, analyze=unemit_ops):
+        """
+        Initialize the analyzer.
+
+        :param root:
+            Directory with Python source files.
+        :param store_path:
+            Path of the persistent store (a :mod:`shelve` database).
+        :param analyze:
+            Callable invoked with each new code object. The returned value is
+            kept in the store and must be picklable.
+        """
+        self.root = root
+        self.analyze = analyze
+        self._store = shelve.open(store_path, protocol=2)
+        # path -> {qualname: digest}, for files seen in this tree
+        self.functions = {}
+        # Paths of the tree start with the root and a separator, sibling
+        # directories sharing a prefix with the root are not part of it
+        prefix = 'file:' + os.path.join(root, '')
+        for key in self._store.keys():
+            if key.startswith(prefix):
+                self.functions[key[len('file:'):]] = self._store[key][1]
+
+    def close(self):
+        """Close the persistent store."""
+        self._store.close()
+
+    def __enter__(self):
+        """Use the analyzer as a context manager."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the persistent store on exit from the context."""
+        self.close()
+
+    def result(self, path, qualname):
+        """
+        Get the analysis result of a function.
+
+        :param path:
+            Path of the source file.
+        :param qualname:
+            Qualified name of the function, see :func:`iter_functions()`.
+        :returns:
+            A :class:`Result`.
+        :raises KeyError:
+            If there is no such function.
+        """
+        return Result(*self._store['code:' + self.functions[path][qualname]])
+
+    def _iter_sources(self):
+        """Iterate over the paths of the Python files in the tree."""
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith('.py'):
+                    yield os.path.join(dirpath, filename)
+
+    def scan(self):
+        """
+        Analyze all the files that changed since the last scan.
+
+        :returns:
+            A :class:`ScanReport`.
+        """
+        report = ScanReport([], [], [], [])
+        seen = set()
+        for path in self._iter_sources():
+            seen.add(path)
+            st = os.stat(path)
+            stamp = (st.st_mtime, st.st_size)
+            key = 'file:' + path
+            entry = self._store.get(key)
+            if entry is not None and entry[0] == stamp:
+                self.functions[path] = entry[1]
+                continue
+            report.changed.append(path)
+            functions = self._scan_file(path, report)
+            self._store[key] = (stamp, functions)
+            self.functions[path] = functions
+        for path in list(self.functions):
+            if path not in seen:
+                report.removed.append(path)
+                del self.functions[path]
+                del self._store['file:' + path]
+        if report.changed or report.removed:
+            self._prune()
+        self._store.sync()
+        return report
+
+    def _prune(self):
+        """Remove the results of functions that no file contains anymore."""
+        # The store may be shared with analyzers of other trees
+        used = set()
+        for key in self._store.keys():
+            if key.startswith('file:'):
+                used.update(self._store[key][1].values())
+        for key in self._store.keys():
+            if key.startswith('code:') and key[len('code:'):] not in used:
+                del self._store[key]
+
+    def _scan_file(self, path, report):
+        """Analyze the new functions of a file, returns their digests."""
+        with open(path, 'rU') as stream:
+            source = stream.read()
+        try:
+            module = compile(source, path, 'exec', dont_inherit=True)
+        except SyntaxError:
+            return {}
+        functions = {}
+        for qualname, code in iter_functions(module):
+            digest = code_digest(code)
+            functions[qualname] = digest
+            key = 'code:' + digest
+            if key in self._store:
+                report.reused.append((path, qualname))
+                continue
+            try:
+                result = (digest, self.analyze(code), None)
+            except Exception as exc:
+                result = (
+                    digest, None, '{}: {}'.format(type(exc).__name__, exc))
+            self._store[key] = result
+            report.analyzed.append((path, qualname))
+        return functions
+
+    def watch(self, interval=1.0, callback=None):
+        """
+        Keep scanning the tree until interrupted.
+
+        :param interval:
+            Delay, in seconds, between subsequent scans.
+        :param callback:
+            Callable invoked with the :class:`ScanReport` of each scan that
+            found changes.
+        """
+        while True:
+            report = self.scan()
+            if callback is not None and (report.changed or report.removed):
+                callback(report)
+            time.sleep(interval)
+
+
+def main(argv=None):
+    """Command line interface, watch and analyze a tree."""
+    parser = argparse.ArgumentParser(
+        description="Incrementally analyze Python code in a directory")
+    parser.add_argument('root', metavar='DIR')
+    parser.add_argument(
+        '-s', '--store', metavar='FILE', required=True,
+        help="persistent store of analysis results")
+    parser.add_argument(
+        '-i', '--interval', metavar='SECONDS', type=float, default=1.0)
+    parser.add_argument(
+        '--once', action='store_true', help="scan once and exit")
+    ns = parser.parse_args(argv)
+
+    def show(report):
+        print("changed: {}, removed: {}, analyzed: {}, reused: {}".format(
+            len(report.changed), len(report.removed), len(report.analyzed),
+            len(report.reused)))
+
+    with Analyzer(ns.root, ns.store) as analyzer:
+        if ns.once:
+            show(analyzer.scan())
+        else:
+            try:
+                analyzer.watch(ns.interval, show)
+            except KeyboardInterrupt:
+                pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+Persistent inverted index over a corpus of code objects.
+
+The index maps terms (operation codes, constants, local variable names and
+sequences of consecutive operation codes) to the functions that contain
+them. It is stored in a SQLite database and can be updated incrementally,
+one file at a time.
+"""
+import imp
+import marshal
+import os
+import sqlite3
+import types
+
+from schnibble.common import BaseOp
+from schnibble.cpy27_opcodes import HAVE_ARGUMENT
+from schnibble.incremental import iter_functions
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS functions (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    qualname TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS functions_path ON functions (path);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    function INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS postings_term ON postings (term);
+CREATE INDEX IF NOT EXISTS postings_function ON postings (function);
+"""
+
+
+def _op_code(op):
+    """Get the op code of an operation class or an integer."""
+    if isinstance(op, type) and issubclass(op, BaseOp):
+        return op.code
+    return int(op)
+
+
+def op(op_code):
+    """
+    Term matching functions that use an operation.
+
+    :param op_code:
+        Operation code or an operation class, e.g. ``LOAD_FAST``.
+    """
+    return 'op:{}'.format(_op_code(op_code))
+
+
+def sequence(*op_codes):
+    """
+    Term matching functions with a sequence of consecutive operations.
+
+    :param op_codes:
+        Operation codes or operation classes.
+    """
+    if len(op_codes) == 1:
+        return op(op_codes[0])
+    return 'seq:{}'.format(','.join(str(_op_code(c)) for c in op_codes))
+
+
+def const(value):
+    """Term matching functions with a constant in their constant pool."""
+    return 'const:{}:{!r}'.format(type(value).__name__, value)
+
+
+def local(name):
+    """Term matching functions with a local variable of the given name."""
+    return 'local:{}'.format(name)
+
+
+def iter_op_codes(code):
+    """
+    Iterate over operation codes of a CPython 2.7 code object.
+
+    Unlike :func:`schnibble.common.iter_ops()` this works for all operations,
+    including ones without a corresponding operation class.
+    """
+    co_code = code.co_code
+    i = 0
+    while i < len(co_code):
+        op_code = ord(co_code[i])
+        yield op_code
+        i += 3 if op_code >= HAVE_ARGUMENT else 1
+
+
+def code_terms(code, max_sequence=3):
+    """
+    Compute the set of terms describing a code object.
+
+    :param code:
+        A code object. Nested code objects are not included.
+    :param max_sequence:
+        Length of the longest sequence of consecutive operations to index.
+    """
+    op_codes = list(iter_op_codes(code))
+    terms = set()
+    for n in range(1, max_sequence + 1):
+        for i in range(len(op_codes) - n + 1):
+            terms.add(sequence(*op_codes[i:i + n]))
+    for value in code.co_consts:
+        if not isinstance(value, types.CodeType):
+            terms.add(const(value))
+    for name in code.co_varnames:
+        terms.add(local(name))
+    return terms
+
+
+def load_pyc(path):
+    """
+    Load the module code object from a .pyc file.
+
+    :raises ValueError:
+        If the file was not created by the running version of Python.
+    """
+    with open(path, 'rb') as stream:
+        if stream.read(4) != imp.get_magic():
+            raise ValueError("{} has unsupported magic number".format(path))
+        stream.read(4)  # mtime of the source file
+        return marshal.load(stream)
+
+
+class Index(object):
+    """Inverted index stored in a SQLite database."""
+
+    def __init__(self, path, max_sequence=3):
+        """
+        Open or create an index.
+
+        :param path:
+            Path of the database file, ``':memory:'`` for a transient index.
+        :param max_sequence:
+            Length of the longest sequence of operations to index. Queries
+            for longer sequences are not possible.
+        """
+        self.max_sequence = max_sequence
+        self._db = sqlite3.connect(path)
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        """Close the database."""
+        self._db.close()
+
+    def __enter__(self):
+        """Use the index as a context manager."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the database on exit from the context."""
+        self.close()
+
+    def add_code(self, path, code, mtime=0.0):
+        """
+        Index a module code object and all the functions defined in it.
+
+        :param path:
+            Path identifying the module, typically of a .pyc file.
+        :param code:
+            The module code object.
+        :param mtime:
+            Modification time of the file.
+
+        Entries that were previously indexed for ``path`` are replaced.
+        """
+        with self._db:
+            self._remove(path)
+            self._db.execute(
+                "INSERT INTO files (path, mtime) VALUES (?, ?)", (path, mtime))
+            for qualname, func_code in iter_functions(code):
+                cursor = self._db.execute(
+                    "INSERT INTO functions (path, qualname) VALUES (?, ?)",
+                    (path, qualname))
+                function = cursor.lastrowid
+                self._db.executemany(
+                    "INSERT INTO postings (term, function) VALUES (?, ?)",
+                    ((term.decode('utf-8', 'replace'), function)
+                     for term in code_terms(func_code, self.max_sequence)))
+
+    def add_pyc(self, path):
+        """
+        Index a .pyc file unless it is already indexed and up to date.
+
+        :returns:
+            True if the file was (re-)indexed.
+        """
+        mtime = os.stat(path).st_mtime
+        row = self._db.execute(
+            "SELECT mtime FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == mtime:
+            return False
+        self.add_code(path, load_pyc(path), mtime)
+        return True
+
+    def remove(self, path):
+        """Remove all entries of a file from the index."""
+        with self._db:
+            self._remove(path)
+
+    def _remove(self, path):
+        """Remove a file and its functions from the index."""
+        self._db.execute(
+            "DELETE FROM postings WHERE function IN"
+            " (SELECT id FROM functions WHERE path = ?)", (path,))
+        self._db.execute("DELETE FROM functions WHERE path = ?", (path,))
+        self._db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def query(self, *terms):
+        """
+        Find functions matching all of the given terms.
+
+        :param terms:
+            Terms created with :func:`op()`, :func:`sequence()`,
+            :func:`const()` or :func:`local()`.
+        :returns:
+            Sorted list of ``(path, qualname)`` pairs.
+        :raises ValueError:
+            If a sequence is longer than what the index stores.
+        """
+        if not terms:
+            raise ValueError("at least one term is required")
+        for term in terms:
+            if (term.startswith('seq:')
+                    and term.count(',') + 1 > self.max_sequence):
+                raise ValueError("sequence is too long: {}".format(term))
+        intersection = " INTERSECT ".join(
+            ["SELECT function FROM postings WHERE term = ?"] * len(terms))
+        rows = self._db.execute(
+            "SELECT path, qualname FROM functions WHERE id IN ({})"
+            " ORDER BY path, qualname".format(intersection),
+            [term.decode('utf-8', 'replace') for term in terms])
+        return rows.fetchall()
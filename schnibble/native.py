@@ -0,0 +1,299 @@
+"""
+Native x86-64 code for integer arithmetic functions.
+
+Function trees built out of :class:`~schnibble.cpy27.Add`,
+:class:`~schnibble.cpy27.Subtract`, :class:`~schnibble.cpy27.Multiply`,
+:class:`~schnibble.cpy27.Neg`, :class:`~schnibble.cpy27.Const`,
+:class:`~schnibble.cpy27.Load`, :class:`~schnibble.cpy27.Store` and
+:class:`~schnibble.cpy27.Return` nodes are translated to machine code that
+follows the System V AMD64 calling convention. The code is placed in
+a :class:`~schnibble.arena.CodeArena` and called through :mod:`ctypes`.
+
+Python 2 integers silently grow into longs while machine registers don't.
+Each arithmetic instruction is therefore followed by a jump to an overflow
+handler. The native code returns the result and an overflow indicator, when
+the indicator is set (or when any argument is not a plain ``int``) the call
+is transparently repeated with the bytecode version of the function.
+"""
+from __future__ import absolute_import
+
+import ctypes
+import mmap
+import platform
+import types
+
+from schnibble.arena import default_arena
+from schnibble.arch.x86.assembler import Label, assemble
+from schnibble.arch.x86.instructions import (
+    ADD, SUB, IMUL, NEG, MOV, PUSH, POP, JO, RET)
+from schnibble.arch.x86.operands import imm32, imm64
+from schnibble.arch.x86.peephole import optimize
+from schnibble.arch.x86.registers import (
+    RAX, RCX, RDX, RBX, RSP, RBP, RSI, RDI, R8, R9, R10, R11, R12, R13, R14,
+    R15)
+from schnibble.cpy27 import Add, Subtract, Multiply, Neg, Const, Load, Store
+from schnibble.cpy27 import Dup, Return, Py27EmitterContext
+
+__all__ = ('NativeError', 'NativeFunction', 'lower', 'compile_function',
+           'jit')
+
+#: Registers holding integer arguments, in order
+ARG_REGS = (RDI, RSI, RDX, RCX, R8, R9)
+
+#: Registers available for local variables that are not arguments
+LOCAL_REGS = (R10, RBX, R12, R13, R14, R15)
+
+#: Registers that must be preserved across calls
+CALLEE_SAVED = (RBX, R12, R13, R14, R15)
+
+_BINARY = {Add: ADD, Subtract: SUB, Multiply: IMUL}
+
+_INT64_MIN = -1 << 63
+_INT64_MAX = (1 << 63) - 1
+
+
+class NativeError(Exception):
+    """Exception raised when a function cannot be translated."""
+
+
+class Result(ctypes.Structure):
+    """Value returned by native code, in RAX and RDX."""
+
+    _fields_ = [('value', ctypes.c_int64), ('overflow', ctypes.c_int64)]
+
+
+class _Lowering(object):
+    """Translation of one function to machine code."""
+
+    def __init__(self, function):
+        """Assign registers to the arguments and local variables."""
+        if len(function.args) > len(ARG_REGS):
+            raise NativeError("too many arguments: {}".format(
+                len(function.args)))
+        self.lines = []
+        self.regs = {}
+        self.defined = set()
+        for name, reg in zip(function.args, ARG_REGS):
+            self._check_name(name)
+            self.regs[name] = reg
+            self.defined.add(name)
+        free = list(LOCAL_REGS)
+        for stmt in function.progn:
+            if isinstance(stmt, Store) and stmt.arg not in self.regs:
+                self._check_name(stmt.arg)
+                if not free:
+                    raise NativeError("too many local variables")
+                self.regs[stmt.arg] = free.pop(0)
+        self.saved = [reg for reg in CALLEE_SAVED
+                      if reg in self.regs.values()]
+        self.overflow = Label('overflow')
+
+    @staticmethod
+    def _check_name(name):
+        """Reject locals referenced by index instead of by name."""
+        if not isinstance(name, str):
+            raise NativeError("locals must be named: {!r}".format(name))
+
+    def lower(self, function):
+        """Translate the function, returns the assembled code."""
+        for reg in self.saved:
+            self.append(PUSH, reg)
+        self.append(PUSH, RBP)
+        self.append(MOV, RBP, RSP)
+        for stmt in function.progn:
+            if isinstance(stmt, Store):
+                self.expr(stmt.children[0])
+                self.append(MOV, self.regs[stmt.arg], RAX)
+                self.defined.add(stmt.arg)
+            elif isinstance(stmt, Return):
+                self.expr(stmt.children[0])
+                self.epilogue(0)
+                break
+            else:
+                raise NativeError("unsupported statement: {!r}".format(stmt))
+        else:
+            raise NativeError("function doesn't return a value")
+        self.lines.append(self.overflow)
+        # Temporaries may still be on the stack
+        self.append(MOV, RSP, RBP)
+        self.epilogue(1)
+        lines, _ = optimize(self.lines, live_registers=RAX.mask | RDX.mask)
+        return assemble(lines)
+
+    def append(self, instruction, *operands):
+        """Append an instruction to the lines."""
+        self.lines.append((instruction,) + operands)
+
+    def epilogue(self, overflow):
+        """Return with the given overflow indicator."""
+        self.append(MOV, RDX, imm32(overflow))
+        self.append(POP, RBP)
+        for reg in reversed(self.saved):
+            self.append(POP, reg)
+        self.append(RET)
+
+    def check_overflow(self):
+        """Jump to the overflow handler if the last instruction overflowed."""
+        self.append(JO, self.overflow)
+
+    def load(self, reg, node):
+        """Load a constant or a local variable into a register."""
+        if isinstance(node, Const):
+            value = node.arg
+            if (not isinstance(value, (int, long))
+                    or not _INT64_MIN <= value <= _INT64_MAX):
+                raise NativeError("unsupported constant: {!r}".format(value))
+            if -0x80000000 <= value <= 0x7FFFFFFF:
+                self.append(MOV, reg, imm32(value))
+            else:
+                self.append(MOV, reg, imm64(value))
+        else:
+            if node.arg not in self.defined:
+                raise NativeError("load of unbound local: {!r}".format(
+                    node.arg))
+            self.append(MOV, reg, self.regs[node.arg])
+
+    def expr(self, node):
+        """Compute the value of an expression in RAX."""
+        if isinstance(node, (Const, Load)):
+            self.load(RAX, node)
+        elif isinstance(node, Neg):
+            self.expr(node.children[0])
+            self.append(NEG, RAX)
+            self.check_overflow()
+        elif type(node) in _BINARY:
+            left, right = node.children
+            self.expr(left)
+            if isinstance(right, Dup):
+                # The left operand is still in RAX
+                self.append(MOV, R11, RAX)
+            elif isinstance(right, (Const, Load)):
+                self.load(R11, right)
+            else:
+                self.append(PUSH, RAX)
+                self.expr(right)
+                self.append(MOV, R11, RAX)
+                self.append(POP, RAX)
+            self.append(_BINARY[type(node)], RAX, R11)
+            self.check_overflow()
+        else:
+            raise NativeError("unsupported node: {!r}".format(node))
+
+
+def lower(function):
+    """
+    Translate a function to x86-64 machine code.
+
+    :param function:
+        A :class:`~schnibble.cpy27.Function` node.
+    :returns:
+        A bytearray with the code.
+    :raises NativeError:
+        If the function uses anything but integer arithmetic on up to six
+        arguments and a handful of local variables.
+
+    The code takes the arguments as 64-bit integers and returns
+    a :class:`Result` structure. Local variables live in registers,
+    temporaries are kept in RAX and R11 and spilled to the machine stack.
+    """
+    return _Lowering(function).lower(function)
+
+
+class NativeFunction(object):
+    """Callable running native code, with a fallback to bytecode."""
+
+    def __init__(self, code, argcount, fallback, arena=None):
+        """
+        Load native code.
+
+        :param code:
+            Machine code produced by :func:`lower()`.
+        :param argcount:
+            Number of arguments of the function.
+        :param fallback:
+            Python function called instead of the native code when the
+            arguments are not plain integers or when the computation
+            overflows.
+        :param arena:
+            :class:`~schnibble.arena.CodeArena` holding the code, the
+            shared :func:`~schnibble.arena.default_arena()` by default.
+        :raises NativeError:
+            If native code is not supported on this machine.
+        """
+        if (platform.machine().lower() not in ('x86_64', 'amd64')
+                or not hasattr(mmap, 'PROT_EXEC')):
+            raise NativeError("native code requires x86-64 and POSIX mmap")
+        self.code = bytes(code)
+        self.argcount = argcount
+        self.fallback = fallback
+        self.arena = default_arena() if arena is None else arena
+        self._prototype = ctypes.CFUNCTYPE(
+            Result, *([ctypes.c_int64] * argcount))
+        self._load()
+
+    def _load(self):
+        """Add the code to the arena, again after an eviction."""
+        self._block = self.arena.add(self.code)
+        self._native = self._block.function(self._prototype)
+
+    def __call__(self, *args):
+        """Call the function."""
+        if len(args) != self.argcount:
+            return self.fallback(*args)
+        for arg in args:
+            if type(arg) is not int:
+                return self.fallback(*args)
+        # The lock keeps other threads from evicting the code while it runs
+        while True:
+            with self.arena.lock:
+                if not self._block.evicted:
+                    self.arena.touch(self._block)
+                    result = self._native(*args)
+                    break
+            self._load()
+        if result.overflow:
+            return self.fallback(*args)
+        return result.value
+
+
+def _bytecode_function(function, name):
+    """Compile a function to a regular Python function."""
+    ctx = Py27EmitterContext().emit(function)
+    code = ctx.make_code(ctx.last_builder, name=name)
+    return types.FunctionType(code, {})
+
+
+def compile_function(function, name="?", arena=None):
+    """
+    Compile a function to native code.
+
+    :param function:
+        A :class:`~schnibble.cpy27.Function` node.
+    :param name:
+        Name of the bytecode fallback function.
+    :param arena:
+        :class:`~schnibble.arena.CodeArena` holding the code, see
+        :class:`NativeFunction`.
+    :returns:
+        A :class:`NativeFunction`.
+    :raises NativeError:
+        If the function cannot be translated or if native code is not
+        supported on this machine.
+    """
+    code = lower(function)
+    return NativeFunction(
+        code, len(function.args), _bytecode_function(function, name), arena)
+
+
+def jit(function, name="?"):
+    """
+    Compile a function to native code if possible.
+
+    :returns:
+        A :class:`NativeFunction` or, if the function cannot be translated,
+        a regular Python function.
+    """
+    try:
+        return compile_function(function, name)
+    except NativeError:
+        return _bytecode_function(function, name)
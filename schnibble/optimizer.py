@@ -0,0 +1,454 @@
+"""Optimization passes over trees of CPython 2.7 nodes."""
+import collections
+
+from schnibble.cpy27 import Add, Subtract, Multiply, Neg, Const, Load, Store
+from schnibble.cpy27 import Dup, Call, Return, Function, OperationNode
+from schnibble.cpy27 import Label, JumpNode, JumpIfFalse, While
+
+#: Nodes that compute a value without side effects
+PURE_NODES = (Add, Subtract, Multiply, Neg, Const, Load, Dup)
+
+#: Pure nodes that are worth computing only once
+COMPOUND_NODES = (Add, Subtract, Multiply, Neg)
+
+#: Pure nodes with exactly two children
+BINARY_NODES = (Add, Subtract, Multiply)
+
+
+def node_key(node):
+    """
+    Compute a hashable key describing the structure of a node tree.
+
+    :param node:
+        Root of the tree.
+    :returns:
+        A tuple that is equal for structurally identical trees.
+
+    Unlike ``==``, constants of different types (``1``, ``1.0`` and
+    ``True``) produce different keys.
+    """
+    if not isinstance(node, OperationNode):
+        return (type(node), id(node))
+    if node.op.has_arg:
+        arg = (type(node.arg), repr(node.arg))
+    else:
+        arg = None
+    return (type(node), arg, tuple(node_key(child) for child in node.children))
+
+
+def is_pure(node):
+    """Check if evaluating a node tree has no side effects."""
+    return isinstance(node, PURE_NODES) and all(
+        is_pure(child) for child in node.children)
+
+
+def rebuild(node, children):
+    """
+    Create a copy of an operation node with different children.
+
+    :param node:
+        The node to copy.
+    :param children:
+        Sequence of the new children nodes.
+    """
+    if node.op.has_arg:
+        return type(node)(node.arg, *children)
+    return type(node)(*children)
+
+
+def walk(node):
+    """Iterate over all nodes of a tree, parents before children."""
+    yield node
+    if isinstance(node, OperationNode):
+        children = node.children
+    elif isinstance(node, While):
+        children = (node.cond,) + node.body
+    else:
+        return
+    for child in children:
+        for sub in walk(child):
+            yield sub
+
+
+def local_names(nodes):
+    """Collect names of all locals loaded or stored in the given trees."""
+    names = set()
+    for node in nodes:
+        for sub in walk(node):
+            if isinstance(sub, (Load, Store)) and isinstance(sub.arg, str):
+                names.add(sub.arg)
+    return names
+
+
+class NameAllocator(object):
+    """Allocator of fresh names for synthesized local variables."""
+
+    def __init__(self, prefix, taken=()):
+        """
+        Initialize the allocator.
+
+        :param prefix:
+            Prefix of all allocated names. Prefixes starting with a dot
+            cannot collide with identifiers in Python source code.
+        :param taken:
+            Names that must not be returned.
+        """
+        self.prefix = prefix
+        self.taken = set(taken)
+        self.counter = 0
+
+    def __call__(self):
+        """Allocate a new name."""
+        while True:
+            name = "{}{}".format(self.prefix, self.counter)
+            self.counter += 1
+            if name not in self.taken:
+                self.taken.add(name)
+                return name
+
+
+class _ValueNumbers(object):
+    """
+    Numbering of node trees.
+
+    Structurally identical subtrees, the ones with equal :func:`node_key()`,
+    get the same number. Trees are numbered bottom-up, so each node is
+    visited once and keys only hold the numbers of the children.
+    """
+
+    def __init__(self):
+        """Initialize an empty numbering."""
+        self._table = {}
+        #: Number of each node, by ``id()`` of the node
+        self.numbers = {}
+        #: All numbered nodes, children before parents
+        self.nodes = []
+        #: Node count of the trees, by number
+        self.sizes = []
+        #: Whether the trees have no side effects, by number
+        self.pure = []
+
+    def number(self, node):
+        """Number a tree and all of its subtrees, returns the number."""
+        if isinstance(node, OperationNode):
+            children = [self.number(child) for child in node.children]
+            if node.op.has_arg:
+                arg = (type(node.arg), repr(node.arg))
+            else:
+                arg = None
+            key = (type(node), arg, tuple(children))
+        else:
+            children = []
+            key = (type(node), id(node))
+        number = self._table.get(key)
+        if number is None:
+            number = self._table[key] = len(self.sizes)
+            self.sizes.append(1 + sum(self.sizes[child] for child in children))
+            self.pure.append(isinstance(node, PURE_NODES) and all(
+                self.pure[child] for child in children))
+        self.numbers[id(node)] = number
+        self.nodes.append(node)
+        return number
+
+
+def _use_dup(node, values):
+    """Rewrite ``op(x, x)`` as ``op(x, Dup())`` throughout a numbered tree."""
+    if not isinstance(node, OperationNode) or not node.children:
+        return node
+    children = [_use_dup(child, values) for child in node.children]
+    if isinstance(node, BINARY_NODES):
+        left, right = [values.numbers[id(child)] for child in node.children]
+        if (left == right and values.pure[left]
+                and isinstance(node.children[0], COMPOUND_NODES)):
+            children[1] = Dup()
+    return rebuild(node, children)
+
+
+def _replace(node, number, replacement, values):
+    """Replace all subtrees with the given number."""
+    if not isinstance(node, OperationNode):
+        return node
+    if values.numbers[id(node)] == number:
+        return replacement
+    if not node.children:
+        return node
+    return rebuild(node, [_replace(child, number, replacement, values)
+                          for child in node.children])
+
+
+def _cse_statement(stmt, new_name):
+    """Eliminate common subexpressions from one statement."""
+    values = _ValueNumbers()
+    values.number(stmt)
+    group = [_use_dup(stmt, values)]
+    while True:
+        values = _ValueNumbers()
+        counts = collections.Counter()
+        found = {}
+        for stmt in group:
+            if not isinstance(stmt, OperationNode):
+                continue
+            start = len(values.nodes)
+            values.number(stmt)
+            # Skip the statement node itself, only values can be reused
+            for node in values.nodes[start:-1]:
+                number = values.numbers[id(node)]
+                if isinstance(node, COMPOUND_NODES) and values.pure[number]:
+                    counts[number] += 1
+                    found.setdefault(number, node)
+        repeated = [number for number, count in counts.items() if count > 1]
+        if not repeated:
+            return group
+        number = max(repeated, key=values.sizes.__getitem__)
+        name = new_name()
+        # The stores added so far may use the value too, so it goes first
+        group = [Store(name, found[number])] + [
+            _replace(stmt, number, Load(name), values) for stmt in group]
+
+
+def eliminate_common_subexpressions(function):
+    """
+    Compute structurally identical pure subexpressions only once.
+
+    :param function:
+        A :class:`~schnibble.cpy27.Function` node.
+    :returns:
+        A new, equivalent function node.
+
+    Each statement of the function body is analyzed separately. When both
+    operands of a binary operation are the same, the second one is replaced
+    with :class:`~schnibble.cpy27.Dup` so that the value is reused straight
+    from the stack. Any other repeated subexpression is stored in
+    a synthesized local variable (``.cse0``, ``.cse1``, ...) just before the
+    statement and loaded at each place where it was used. Only arithmetic on
+    constants and local variables is considered pure. Nested functions are
+    optimized recursively.
+    """
+    new_name = NameAllocator(
+        '.cse', local_names(function.progn) | set(function.args))
+    progn = []
+    for stmt in function.progn:
+        if isinstance(stmt, Function):
+            progn.append(eliminate_common_subexpressions(stmt))
+        else:
+            progn.extend(_cse_statement(stmt, new_name))
+    return Function(function.args, function.docstring, *progn)
+
+
+def function_size(function):
+    """Count the nodes in the body of a function."""
+    return sum(1 for stmt in function.progn for _ in walk(stmt))
+
+
+def is_leaf_function(function):
+    """
+    Check if a function is a leaf function that can be inlined.
+
+    Leaf functions consist of stores of pure values to named locals followed
+    by a single return of a pure value. They don't call anything.
+    """
+    if not function.progn or not isinstance(function.progn[-1], Return):
+        return False
+    for stmt in function.progn[:-1]:
+        if not isinstance(stmt, Store) or not is_pure(stmt.children[0]):
+            return False
+    if not is_pure(function.progn[-1].children[0]):
+        return False
+    return all(isinstance(node.arg, str)
+               for stmt in function.progn for node in walk(stmt)
+               if isinstance(node, (Load, Store)))
+
+
+def _rename(node, prefix, mapping):
+    """Rename locals of an inlined function."""
+    if isinstance(node, Load):
+        return mapping.get(node.arg) or Load('{}.{}'.format(prefix, node.arg))
+    if isinstance(node, Store):
+        return Store('{}.{}'.format(prefix, node.arg),
+                     _rename(node.children[0], prefix, mapping))
+    if not node.children:
+        return node
+    return rebuild(
+        node, [_rename(child, prefix, mapping) for child in node.children])
+
+
+def _inline(node, helpers, new_name, prelude):
+    """Inline calls to helpers in a tree, in evaluation order."""
+    if not isinstance(node, OperationNode) or not node.children:
+        return node
+    children = [_inline(child, helpers, new_name, prelude)
+                for child in node.children]
+    if any(new is not old for new, old in zip(children, node.children)):
+        node = rebuild(node, children)
+    if not (isinstance(node, Call) and isinstance(children[0], Load)
+            and children[0].arg in helpers):
+        return node
+    helper = helpers[children[0].arg]
+    args = children[1:]
+    if len(helper.args) != len(args) or not all(map(is_pure, args)):
+        return node
+    prefix = new_name()
+    stored = set(stmt.arg for stmt in helper.progn[:-1])
+    mapping = {}
+    for param, arg in zip(helper.args, args):
+        if isinstance(arg, (Load, Const)) and param not in stored:
+            # Trivial arguments are substituted directly
+            mapping[param] = arg
+        else:
+            renamed = '{}.{}'.format(prefix, param)
+            prelude.append(Store(renamed, arg))
+            mapping[param] = Load(renamed)
+    for stmt in helper.progn[:-1]:
+        prelude.append(_rename(stmt, prefix, mapping))
+    return _rename(helper.progn[-1].children[0], prefix, mapping)
+
+
+def inline_calls(function, helpers, budget=32):
+    """
+    Substitute bodies of small leaf functions into their call sites.
+
+    :param function:
+        A :class:`~schnibble.cpy27.Function` node.
+    :param helpers:
+        Dictionary mapping names of local variables of ``function`` to the
+        :class:`~schnibble.cpy27.Function` nodes of the functions they hold.
+    :param budget:
+        Maximum number of nodes in the body of an inlined function.
+    :returns:
+        A new, equivalent function node.
+
+    Calls of the form ``Call(n, Load(name), ...)`` are inlined when ``name``
+    refers to a leaf function (see :func:`is_leaf_function()`) that is not
+    larger than ``budget``, the number of arguments matches and all the
+    arguments are pure. Locals of the inlined function are renamed (to
+    ``.inl0.name``, ``.inl1.name``, ...) to avoid collisions. Arguments that
+    are constants or locals are substituted directly, others are stored in
+    renamed parameter variables before the statement with the call.
+    """
+    stored = set(node.arg for stmt in function.progn for node in walk(stmt)
+                 if isinstance(node, Store))
+    helpers = {
+        name: helper for name, helper in helpers.items()
+        if name not in stored and is_leaf_function(helper)
+        and function_size(helper) <= budget}
+    new_name = NameAllocator(
+        '.inl', local_names(function.progn) | set(function.args))
+    progn = []
+    for stmt in function.progn:
+        if isinstance(stmt, Function):
+            progn.append(inline_calls(stmt, helpers, budget))
+            continue
+        prelude = []
+        stmt = _inline(stmt, helpers, new_name, prelude)
+        progn.extend(prelude)
+        progn.append(stmt)
+    return Function(function.args, function.docstring, *progn)
+
+
+def _is_invariant(node, variant):
+    """Check if a pure expression has the same value in each iteration."""
+    for sub in walk(node):
+        if isinstance(sub, Dup) or not isinstance(sub, PURE_NODES):
+            return False
+        if isinstance(sub, Load) and (
+                not isinstance(sub.arg, str) or sub.arg in variant):
+            return False
+    return True
+
+
+def _hoist(node, variant, hoisted, new_name):
+    """Replace loop-invariant subexpressions with loads of locals."""
+    if not isinstance(node, OperationNode):
+        return node
+    if isinstance(node, COMPOUND_NODES) and _is_invariant(node, variant):
+        key = node_key(node)
+        if key not in hoisted:
+            hoisted[key] = (new_name(), node)
+        return Load(hoisted[key][0])
+    if not node.children:
+        return node
+    return rebuild(node, [_hoist(child, variant, hoisted, new_name)
+                          for child in node.children])
+
+
+def _hoist_loop(loop, variant, hoisted, new_name):
+    """Hoist invariants from the parts of a loop run in every iteration."""
+    body = []
+    guarded = False
+    for stmt in loop.body:
+        if guarded or isinstance(stmt, Label):
+            # Code after a jump or a jump target may not run
+            guarded = True
+            body.append(stmt)
+        elif isinstance(stmt, While):
+            # The body of an inner loop may not run at all
+            body.append(While(_hoist(stmt.cond, variant, hoisted, new_name),
+                              *stmt.body))
+        else:
+            body.append(_hoist(stmt, variant, hoisted, new_name))
+            guarded = isinstance(stmt, JumpNode)
+    return While(_hoist(loop.cond, variant, hoisted, new_name), *body)
+
+
+def _licm_loop(loop, new_name):
+    """Hoist invariants out of a loop and all loops nested in it."""
+    loop = While(loop.cond, *_licm_block(loop.body, new_name))
+    if not is_pure(loop.cond):
+        return [loop]
+    variant = set()
+    for node in walk(loop):
+        if isinstance(node, Store):
+            if not isinstance(node.arg, str):
+                # Stores by index may alias any named local
+                return [loop]
+            variant.add(node.arg)
+    hoisted = collections.OrderedDict()
+    new_loop = _hoist_loop(loop, variant, hoisted, new_name)
+    if not hoisted:
+        return [loop]
+    # Hoisted values are computed only if the loop runs at least once
+    skip = Label('skip')
+    return ([JumpIfFalse(skip, loop.cond)]
+            + [Store(name, node) for name, node in hoisted.values()]
+            + [new_loop, skip])
+
+
+def _licm_block(stmts, new_name):
+    """Hoist invariants out of the loops in a sequence of statements."""
+    progn = []
+    for stmt in stmts:
+        if isinstance(stmt, While):
+            progn.extend(_licm_loop(stmt, new_name))
+        elif isinstance(stmt, Function):
+            progn.append(hoist_loop_invariants(stmt))
+        else:
+            progn.append(stmt)
+    return progn
+
+
+def hoist_loop_invariants(function):
+    """
+    Compute loop-invariant subexpressions once, before the loop.
+
+    :param function:
+        A :class:`~schnibble.cpy27.Function` node.
+    :returns:
+        A new, equivalent function node.
+
+    A subexpression of a :class:`~schnibble.cpy27.While` loop is invariant
+    when it is pure and loads only locals that are not stored anywhere in
+    the loop. Each largest invariant subexpression is stored in
+    a synthesized local variable (``.licm0``, ``.licm1``, ...) and loaded
+    inside the loop. The stores are guarded by an extra evaluation of the
+    loop condition so that nothing is computed when the loop doesn't run at
+    all, only loops with a pure condition are therefore optimized.
+
+    Only the condition and the statements that run in every iteration are
+    considered: statements before the first jump or label of the body, and
+    the conditions of inner loops. Inner loops are optimized first, their
+    invariants stay behind the guard of the inner loop.
+    """
+    new_name = NameAllocator(
+        '.licm', local_names(function.progn) | set(function.args))
+    return Function(function.args, function.docstring,
+                    *_licm_block(function.progn, new_name))
@@ -0,0 +1,152 @@
+"""
+Bulk statistics of emitted code.
+
+NumPy is used when it is available, the results are the same without it
+although computing them is much slower for large builders.
+"""
+import collections
+
+from schnibble.common import stack_usage
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#: Profile of a collection of builders.
+#:
+#: ``opcode_counts`` is a sequence of 256 integers, the number of
+#: instructions with each operation code. ``const_pool_sizes``,
+#: ``final_sizes`` and ``max_sizes`` have one element for each builder.
+Profile = collections.namedtuple(
+    "Profile", "opcode_counts const_pool_sizes final_sizes max_sizes")
+
+
+def _has_jumps(builder):
+    """Check if a builder emitted any jump instructions."""
+    return any(op.has_jabs or op.has_jrel for _, op in builder.instructions)
+
+
+def stack_changes_array(builder):
+    """
+    Get the stack changes of a builder as a NumPy array.
+
+    :param builder:
+        A :class:`~schnibble.common.FunctionBuilder`.
+    :returns:
+        Array of shape ``(n, 2)`` with the ``dec`` and ``inc`` columns.
+    """
+    return numpy.array(builder.stack_changes, dtype=numpy.int64).reshape(-1, 2)
+
+
+def opcodes_array(builder):
+    """
+    Get the operation codes of all instructions of a builder.
+
+    :param builder:
+        A :class:`~schnibble.common.FunctionBuilder`.
+    :returns:
+        Array of ``uint8``, one element for each instruction.
+    """
+    buf = numpy.frombuffer(builder.buf, dtype=numpy.uint8)
+    offsets = numpy.fromiter(
+        (offset for offset, op in builder.instructions), dtype=numpy.intp,
+        count=len(builder.instructions))
+    return buf[offsets]
+
+
+def fast_stack_usage(builder):
+    """
+    Analyze stack usage, like :meth:`FunctionBuilder.stack_usage()`.
+
+    :param builder:
+        A :class:`~schnibble.common.FunctionBuilder`.
+    :returns:
+        Tuple ``(min_size, final_size, max_size)``.
+
+    Straight-line code is analyzed with a cumulative sum instead of a loop.
+    Code with jumps, or any code when NumPy is not available, is analyzed by
+    the builder itself.
+    """
+    if numpy is None or not builder.stack_changes or _has_jumps(builder):
+        return builder.stack_usage()
+    changes = stack_changes_array(builder)
+    size = numpy.cumsum(changes.sum(axis=1))
+    after_dec = size - changes[:, 1]
+    return stack_usage(
+        min(0, int(after_dec.min())), int(size[-1]), max(0, int(size.max())))
+
+
+def opcode_histogram(builder):
+    """
+    Count instructions by operation code.
+
+    :param builder:
+        A :class:`~schnibble.common.FunctionBuilder`.
+    :returns:
+        Sequence of 256 integers.
+    """
+    if numpy is None:
+        counts = [0] * 256
+        for offset, op in builder.instructions:
+            counts[builder.buf[offset]] += 1
+        return counts
+    return numpy.bincount(opcodes_array(builder), minlength=256)
+
+
+def profile(builders):
+    """
+    Compute a profile of a collection of builders.
+
+    :param builders:
+        Sequence of :class:`~schnibble.common.FunctionBuilder`.
+    :returns:
+        A :class:`Profile`.
+
+    With NumPy, stack changes and operation codes of all the builders are
+    concatenated and processed with a handful of array operations, no matter
+    how many builders there are.
+    """
+    builders = list(builders)
+    const_pool_sizes = [len(builder.consts) for builder in builders]
+    if numpy is None:
+        counts = [0] * 256
+        final_sizes = []
+        max_sizes = []
+        for builder in builders:
+            for offset, op in builder.instructions:
+                counts[builder.buf[offset]] += 1
+            usage = builder.stack_usage()
+            final_sizes.append(usage.final_size)
+            max_sizes.append(usage.max_size)
+        return Profile(counts, const_pool_sizes, final_sizes, max_sizes)
+    opcodes = [opcodes_array(builder) for builder in builders]
+    counts = numpy.bincount(
+        numpy.concatenate(opcodes) if opcodes
+        else numpy.zeros(0, numpy.uint8), minlength=256)
+    lengths = numpy.array(
+        [len(builder.stack_changes) for builder in builders], dtype=numpy.intp)
+    final_sizes = numpy.zeros(len(builders), dtype=numpy.int64)
+    max_sizes = numpy.zeros(len(builders), dtype=numpy.int64)
+    if lengths.sum():
+        changes = numpy.concatenate([
+            stack_changes_array(builder) for builder in builders])
+        total = changes.sum(axis=1)
+        size = numpy.cumsum(total)
+        ends = numpy.cumsum(lengths)
+        starts = ends - lengths
+        # Stack size before the first instruction of each builder
+        base = size[starts.clip(max=len(size) - 1)] - total[
+            starts.clip(max=len(size) - 1)]
+        size -= numpy.repeat(base, lengths)
+        used = lengths > 0
+        final_sizes[used] = size[ends[used] - 1]
+        max_sizes[used] = numpy.maximum.reduceat(size, starts[used])
+        max_sizes = numpy.maximum(max_sizes, 0)
+    for i, builder in enumerate(builders):
+        if _has_jumps(builder):
+            usage = builder.stack_usage()
+            final_sizes[i] = usage.final_size
+            max_sizes[i] = usage.max_size
+    return Profile(
+        counts, numpy.array(const_pool_sizes), final_sizes, max_sizes)
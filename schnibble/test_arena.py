@@ -0,0 +1,145 @@
+"""Unit tests for arena."""
+import ctypes
+import os
+import platform
+import threading
+from unittest import TestCase, skipIf
+
+from schnibble.arena import CodeArena, PAGE_SIZE
+from schnibble.arch.x86.assembler import assemble
+from schnibble.arch.x86.instructions import MOV, RET
+from schnibble.arch.x86.operands import imm32
+from schnibble.arch.x86.registers import EAX
+
+forX86_64 = skipIf(
+    platform.machine().lower() not in ('x86_64', 'amd64'),
+    "native code requires x86-64")
+
+_RETURN_INT = ctypes.CFUNCTYPE(ctypes.c_int32)
+
+
+def _constant(value, padding=0):
+    """Code returning a constant, with padding after the RET."""
+    code = assemble([(MOV, EAX, imm32(value)), (RET,)])
+    return bytes(code) + b'\xCC' * padding
+
+
+def _protection(address):
+    """Read the permissions of the mapping holding an address."""
+    with open('/proc/self/maps') as maps:
+        for line in maps:
+            fields = line.split()
+            start, end = [int(part, 16) for part in fields[0].split('-')]
+            if start <= address < end:
+                return fields[1]
+    return None
+
+
+@forX86_64
+class CodeArenaTests(TestCase):
+
+    def setUp(self):
+        self.arena = CodeArena(
+            budget=4 * PAGE_SIZE, chunk_size=2 * PAGE_SIZE)
+        self.addCleanup(self.arena.close)
+
+    def call(self, block):
+        return block.function(_RETURN_INT)()
+
+    def test_call(self):
+        block = self.arena.add(_constant(42))
+        self.assertEqual(self.call(block), 42)
+        self.assertEqual(block.size, 6)
+        self.assertEqual(len(self.arena), 1)
+
+    def test_bump_allocation(self):
+        blocks = [self.arena.add(_constant(i)) for i in range(2)]
+        # Each block starts a page of the same mapping
+        self.assertEqual(blocks[1].address - blocks[0].address, PAGE_SIZE)
+        self.assertEqual(blocks[0].address % PAGE_SIZE, 0)
+        self.assertEqual(self.arena.mapped_size, 2 * PAGE_SIZE)
+        self.assertEqual([self.call(block) for block in blocks], [0, 1])
+
+    def test_cache(self):
+        block = self.arena.add(_constant(1))
+        self.assertIs(self.arena.add(bytearray(_constant(1))), block)
+        self.assertIs(self.arena.lookup(_constant(1)), block)
+        other = self.arena.add(_constant(2), key='two')
+        self.assertIs(self.arena.lookup('two'), other)
+        self.assertIs(self.arena.add(_constant(3), key='two'), other)
+        self.assertIsNone(self.arena.lookup(_constant(2)))
+
+    @skipIf(not os.path.exists('/proc/self/maps'), "requires /proc")
+    def test_write_xor_execute(self):
+        block = self.arena.add(_constant(1))
+        self.assertEqual(_protection(block.address)[:3], 'r-x')
+        # The rest of the chunk was never written
+        end = block.address + PAGE_SIZE
+        self.assertEqual(_protection(end)[:3], 'rw-')
+        # More code goes to the next page
+        other = self.arena.add(_constant(2))
+        self.assertEqual(other.address, end)
+        self.assertEqual(_protection(end)[:3], 'r-x')
+
+    def test_lru_eviction(self):
+        # Two blocks fit in a chunk
+        padding = PAGE_SIZE // 2
+        a = self.arena.add(_constant(1, padding))
+        b = self.arena.add(_constant(2, padding))
+        c = self.arena.add(_constant(3, padding))
+        self.assertEqual(self.arena.mapped_size, 4 * PAGE_SIZE)
+        # a and b share the first chunk, which is used again
+        self.arena.touch(a)
+        d = self.arena.add(_constant(4, 2 * PAGE_SIZE - 100))
+        self.assertTrue(c.evicted)
+        self.assertFalse(a.evicted or b.evicted)
+        # The memory of the second chunk is reused
+        self.assertEqual(d.address, c.address)
+        self.assertEqual(self.arena.mapped_size, 4 * PAGE_SIZE)
+        self.assertIsNone(self.arena.lookup(_constant(3, padding)))
+        self.assertRaises(ValueError, c.function, _RETURN_INT)
+        self.assertEqual([self.call(a), self.call(b), self.call(d)],
+                         [1, 2, 4])
+        self.assertEqual(len(self.arena), 3)
+
+    def test_large_code(self):
+        small = self.arena.add(_constant(5))
+        # The code needs a chunk of three pages, the small one is unmapped
+        large = self.arena.add(_constant(6, 2 * PAGE_SIZE + PAGE_SIZE // 2))
+        self.assertTrue(small.evicted)
+        self.assertEqual(self.arena.mapped_size, 3 * PAGE_SIZE)
+        self.assertEqual(self.call(large), 6)
+        self.assertRaises(
+            ValueError, self.arena.add, _constant(7, 4 * PAGE_SIZE))
+
+    def test_close(self):
+        block = self.arena.add(_constant(1))
+        self.arena.close()
+        self.assertTrue(block.evicted)
+        self.assertEqual((len(self.arena), self.arena.mapped_size), (0, 0))
+        self.assertEqual(self.call(self.arena.add(_constant(1))), 1)
+
+    def test_add_while_running(self):
+        # Code keeps running while other threads add and evict code
+        block = self.arena.add(_constant(1))
+        errors = []
+
+        def add():
+            try:
+                for i in range(200):
+                    self.arena.add(_constant(i + 2, PAGE_SIZE // 2))
+            except Exception as exc:
+                errors.append(exc)
+
+        thread = threading.Thread(target=add)
+        thread.start()
+        try:
+            while thread.is_alive():
+                with self.arena.lock:
+                    if block.evicted:
+                        break
+                    self.arena.touch(block)
+                    self.assertEqual(self.call(block), 1)
+        finally:
+            thread.join()
+        self.assertEqual(errors, [])
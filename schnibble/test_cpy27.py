@@ -4,13 +4,15 @@ import types
 from unittest import TestCase, skipIf, expectedFailure
 
 from schnibble.cpy27 import Neg, Const, Load, Store, Multiply, Add, Subtract
-from schnibble.cpy27 import Return
+from schnibble.cpy27 import Return, Call
 from schnibble.cpy27 import Function
+from schnibble.cpy27 import Label, Jump, JumpForward, JumpIfFalse, While
 from schnibble.cpy27 import Flags, FLAG_NESTED
 from schnibble.cpy27 import LOAD_FAST, RETURN_VALUE
 from schnibble.cpy27 import Py27Op
 from schnibble.cpy27 import Py27EmitterContext
-from schnibble.common import unemit, iter_ops, dec_inc
+from schnibble.common import unemit, iter_unemit, iter_ops, dec_inc
+from schnibble.common import ArrayUnemitterContext, CodeCache
 
 
 def en(n):
@@ -97,6 +99,56 @@ class EmitterTests(TestCase):
         self.assertEqual(ctx.last_builder.stack_usage(), (0, 0, 2))
         self.assertTrue(ctx.last_builder.is_valid_stack(), True)
 
+    def test_jump_stack_usage(self):
+        else_, end = Label('else'), Label('end')
+        ctx = Py27EmitterContext().emit_fragment(
+            JumpIfFalse(else_, Load(0)), Const(1), JumpForward(end),
+            else_, Const(2), end, Return())
+        self.assertEqual(
+            ctx.last_builder.buf.tolist(),
+            [124, 0, 0, 114, 12, 0, 100, 1, 0, 110, 3, 0, 100, 2, 0, 83])
+        # Summing in emit order would claim a maximum depth of two
+        self.assertEqual(ctx.last_builder.stack_usage(), (0, 0, 1))
+        self.assertTrue(ctx.last_builder.is_valid_stack())
+
+    def test_jump_backward(self):
+        top = Label('top')
+        ctx = Py27EmitterContext().emit_fragment(
+            top, JumpIfFalse(top, Load(0)), Return(Const(None)))
+        self.assertEqual(
+            ctx.last_builder.buf.tolist(),
+            [124, 0, 0, 114, 0, 0, 100, 0, 0, 83])
+        self.assertEqual(ctx.last_builder.stack_usage(), (0, 0, 1))
+
+    def test_jump_inconsistent_depth(self):
+        label = Label()
+        ctx = Py27EmitterContext().emit_fragment(
+            JumpIfFalse(label, Load(0)), Const(1), label, Return(Const(None)))
+        self.assertRaises(ValueError, ctx.last_builder.stack_usage)
+
+    def test_jump_unresolved_label(self):
+        ctx = Py27EmitterContext().emit(
+            Function((), None, Jump(Label()), Return(Const(None))))
+        self.assertRaises(ValueError, ctx.make_code, ctx.last_builder)
+
+    def test_jump_marked_late(self):
+        label = Label()
+        ctx = Py27EmitterContext().emit_fragment(
+            JumpIfFalse(label, Load(0)), Const(None))
+        builder = ctx.last_builder
+        self.assertRaisesRegexp(
+            ValueError, 'unresolved labels', builder.stack_usage)
+        # The analysis sees the patched jump
+        builder.mark_label(label)
+        self.assertRaisesRegexp(
+            ValueError, 'inconsistent stack depth', builder.stack_usage)
+
+    def test_jump_infinite_loop(self):
+        top = Label('top')
+        ctx = Py27EmitterContext().emit_fragment(top, Jump(top))
+        self.assertEqual(ctx.last_builder.buf.tolist(), [113, 0, 0])
+        self.assertEqual(ctx.last_builder.stack_usage(), (0, 0, 0))
+
     def assertPerfectCode(self, fn, *nodes):
         ctx = Py27EmitterContext().emit(Flags(FLAG_NESTED), *nodes)
         orig = fn.__code__
@@ -156,6 +208,51 @@ class EmitterTests(TestCase):
             lambda a, b: a * b,
             Function(('a', 'b'), None, Return(Multiply(Load("a"), Load("b")))))
 
+    @forPy27
+    def test_JumpIfFalse_sanity(self):
+        else_ = Label()
+        self.assertPerfectCode(
+            lambda a: 1 if a else 2,
+            Function(('a',), None,
+                     JumpIfFalse(else_, Load("a")), Return(Const(1)),
+                     else_, Return(Const(2))))
+
+    @forPy27
+    def test_Call_sanity(self):
+        self.assertPerfectCode(
+            lambda f, a, b: f(a, b),
+            Function(('f', 'a', 'b'), None,
+                     Return(Call(2, Load("f"), Load("a"), Load("b")))))
+
+    @forPy27
+    def test_While(self):
+        def fn(n):
+            s = 0
+            while n:
+                s = s + n
+                n = n - 1
+            return s
+        ctx = Py27EmitterContext().emit(Function(
+            ('n',), None,
+            Store('s', Const(0)),
+            While(Load('n'),
+                  Store('s', Add(Load('s'), Load('n'))),
+                  Store('n', Subtract(Load('n'), Const(1)))),
+            Return(Load('s'))))
+        self.assertEqual(co(fn), ctx.last_builder.buf.tolist())
+        self.assertEqual(ctx.last_builder.stack_usage(), (0, 0, 2))
+        code = ctx.make_code(ctx.last_builder, name="fn")
+        self.assertEqual(types.FunctionType(code, {})(4), 10)
+
+    def test_Call_stack_usage(self):
+        ctx = Py27EmitterContext().emit_fragment(
+            Return(Call(2, Load(0), Load(1), Load(2))))
+        self.assertEqual(ctx.last_builder.stack_changes[3], dec_inc(-3, +1))
+        self.assertEqual(ctx.last_builder.stack_usage(), (0, 0, 3))
+
+    def test_Call_arg_count(self):
+        self.assertRaises(ValueError, Call, 2, Load('f'), Load('a'))
+
     @forPy27
     def test_it_really_works(self):
         ctx = Py27EmitterContext().emit(
@@ -174,6 +271,66 @@ class EmitterTests(TestCase):
         self.assertEqual(add(['foo'], ['bar']), ['foo', 'bar'])
 
 
+class CodeCacheTests(TestCase):
+
+    def make_code(self, cache, *nodes):
+        ctx = Py27EmitterContext(code_cache=cache).emit(*nodes)
+        return ctx.make_code(ctx.last_builder, name="fn")
+
+    def test_shared(self):
+        cache = CodeCache()
+        a = self.make_code(
+            cache, Function(('a',), None, Return(Add(Load('a'), Const(1)))))
+        b = self.make_code(
+            cache, Function(('a',), None, Return(Add(Load('a'), Const(1)))))
+        self.assertIs(a, b)
+        self.assertEqual(len(cache), 1)
+
+    def test_constant_types(self):
+        cache = CodeCache()
+        a = self.make_code(cache, Function((), None, Return(Const(1))))
+        b = self.make_code(cache, Function((), None, Return(Const(1.0))))
+        self.assertIsNot(a, b)
+        self.assertEqual(b.co_consts, (None, 1.0))
+
+    def test_bounded(self):
+        cache = CodeCache(size=1)
+        a = self.make_code(cache, Function((), None, Return(Const(1))))
+        self.make_code(cache, Function((), None, Return(Const(2))))
+        # Evicted from the bounded part but still alive
+        self.assertIs(
+            self.make_code(cache, Function((), None, Return(Const(1)))), a)
+        # Neither referenced nor recently used
+        del a
+        self.make_code(cache, Function((), None, Return(Const(3))))
+        self.assertEqual(len(cache), 1)
+
+    def test_no_cache(self):
+        fn = Function((), None, Return(Const(1)))
+        self.assertIsNot(self.make_code(None, fn), self.make_code(None, fn))
+
+
+class OpTableTests(TestCase):
+
+    def test_names(self):
+        from schnibble.cpy27_opcodes import OPNAMES
+        for op_code, name in enumerate(OPNAMES):
+            op_cls = Py27Op._by_op[op_code]
+            if op_cls is not None:
+                self.assertEqual(op_cls.__name__, name)
+            self.assertEqual(Py27Op.is_valid_op_code(op_code), name is not None)
+        self.assertFalse(Py27Op.is_valid_op_code(len(OPNAMES)))
+
+    @forPy27
+    def test_matches_opcode_module(self):
+        import opcode
+        from schnibble.cpy27_opcodes import OPNAMES, HAVE_ARGUMENT
+        self.assertEqual(HAVE_ARGUMENT, opcode.HAVE_ARGUMENT)
+        for op_code, name in enumerate(OPNAMES):
+            self.assertEqual(name or '<{}>'.format(op_code),
+                             opcode.opname[op_code])
+
+
 class AnalyzerTests(TestCase):
 
     def test_smoke(self):
@@ -202,6 +359,47 @@ class AnalyzerTests(TestCase):
         ctx = unemit(fn.__code__, Py27Op)
         self.assertEqual(ctx.retval, Return(Multiply(Load('a'), Load('b'))))
 
+    def test_unemit_Call(self):
+        fn = lambda f, a: f(a, 1)
+        ctx = unemit(fn.__code__, Py27Op)
+        self.assertEqual(
+            ctx.retval, Return(Call(2, Load('f'), Load('a'), Const(1))))
+
+    def test_iter_unemit(self):
+        def fn(z):
+            x = 3 + 6
+            y = x - 5
+            return z * y
+        stream = iter_unemit(fn.__code__, Py27Op)
+        self.assertEqual(next(stream), Store("x", Const(9)))
+        self.assertEqual(next(stream), Store("y", Subtract(Load("x"), Const(5))))
+        self.assertEqual(next(stream), Return(Multiply(Load('z'), Load('y'))))
+        self.assertRaises(StopIteration, next, stream)
+
+    def test_unemit_arrays(self):
+        def fn(z):
+            x = 3 + 6
+            y = x - 5
+            return z * y
+        ctx = unemit(fn.__code__, Py27Op, ArrayUnemitterContext)
+        self.assertEqual(len(ctx.kinds), 10)
+        self.assertEqual(list(ctx.ops), [1, 5, 9])
+        ret = ctx.view(ctx.retval)
+        self.assertIs(ret.node_type, Return)
+        self.assertIsNone(ret.arg)
+        (mul,) = ret.children
+        self.assertIs(mul.node_type, Multiply)
+        self.assertEqual([child.arg for child in mul.children], ['z', 'y'])
+        self.assertEqual(
+            [stmt.materialize() for stmt in ctx.statements],
+            unemit(fn.__code__, Py27Op).ops)
+
+    def test_iter_unemit_matches_unemit(self):
+        fn = lambda a, b: a * b - a
+        self.assertEqual(
+            list(iter_unemit(fn.__code__, Py27Op)),
+            unemit(fn.__code__, Py27Op).ops)
+
 
 class OptimizerTests(TestCase):
 
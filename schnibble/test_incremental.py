@@ -0,0 +1,179 @@
+"""Unit tests for incremental."""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from StringIO import StringIO
+from unittest import TestCase
+
+from schnibble.cpy27 import Const, Load, Add, Return
+from schnibble.incremental import Analyzer, code_digest, iter_functions
+from schnibble.incremental import main
+
+
+class CodeDigestTests(TestCase):
+
+    def test_line_numbers_ignored(self):
+        a = compile("def f(a):\n    return a + 1\n", "a.py", "exec")
+        b = compile("\n\ndef f(a):\n    return a + 1\n", "b.py", "exec")
+        self.assertEqual(
+            dict((name, code_digest(code)) for name, code in iter_functions(a)
+                 if name != '<module>'),
+            dict((name, code_digest(code)) for name, code in iter_functions(b)
+                 if name != '<module>'))
+
+    def test_constants(self):
+        a = compile("lambda a: a + 1", "a.py", "eval")
+        b = compile("lambda a: a + 1.0", "a.py", "eval")
+        self.assertNotEqual(code_digest(a), code_digest(b))
+
+    def test_iter_functions(self):
+        code = compile("def f():\n    def g(): pass\n", "a.py", "exec")
+        self.assertEqual(
+            [name for name, code in iter_functions(code)],
+            ['<module>', '<module>.f', '<module>.f.g'])
+
+    def test_iter_functions_same_name(self):
+        code = compile(
+            "f = lambda: 1\ng = lambda: 2\nh = lambda: 3, lambda: 4\n",
+            "a.py", "exec")
+        self.assertEqual(
+            [name for name, code in iter_functions(code)],
+            ['<module>', '<module>.<lambda>', '<module>.<lambda>@2',
+             '<module>.<lambda>@3', '<module>.<lambda>@3#2'])
+
+
+class AnalyzerTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = os.path.join(self.root, 'store')
+        self.src = os.path.join(self.root, 'src')
+        os.mkdir(self.src)
+        self.write('a.py', "def f(a):\n    return a + 1\n")
+        self.write('b.py', "def g(a):\n    return a\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, text):
+        path = os.path.join(self.src, name)
+        with open(path, 'w') as stream:
+            stream.write(text)
+        # Make sure the change is noticed even within one mtime tick
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + len(text)))
+        return path
+
+    def test_incremental(self):
+        a = os.path.join(self.src, 'a.py')
+        with Analyzer(self.src, self.store) as analyzer:
+            report = analyzer.scan()
+            self.assertEqual(len(report.changed), 2)
+            self.assertIn((a, '<module>.f'), report.analyzed)
+            self.assertEqual(
+                analyzer.result(a, '<module>.f').value,
+                [Return(Add(Load('a'), Const(1)))])
+            self.assertEqual(analyzer.scan(), ([], [], [], []))
+            self.write('a.py', "def f(a):\n    return a + 2\n")
+            report = analyzer.scan()
+            self.assertEqual(report.changed, [a])
+            self.assertEqual(
+                report.analyzed, [(a, '<module>'), (a, '<module>.f')])
+        # The store is persistent
+        with Analyzer(self.src, self.store) as analyzer:
+            self.assertEqual(analyzer.scan(), ([], [], [], []))
+            self.assertEqual(
+                analyzer.result(a, '<module>.f').value,
+                [Return(Add(Load('a'), Const(2)))])
+
+    def test_unchanged_function_reused(self):
+        with Analyzer(self.src, self.store) as analyzer:
+            analyzer.scan()
+            b = self.write(
+                'b.py', "\n\ndef g(a):\n    return a\n\nh = lambda: 1\n")
+            report = analyzer.scan()
+            self.assertEqual(
+                report.analyzed, [(b, '<module>'), (b, '<module>.<lambda>')])
+            self.assertEqual(report.reused, [(b, '<module>.g')])
+
+    def test_unsupported_code(self):
+        with Analyzer(self.src, self.store) as analyzer:
+            analyzer.scan()
+            result = analyzer.result(
+                os.path.join(self.src, 'a.py'), '<module>')
+            self.assertIsNone(result.value)
+            self.assertTrue(result.error.startswith('NotImplementedError'))
+
+    def test_same_name_functions(self):
+        a = self.write('a.py', "f = lambda: 1\ng = lambda: 2\n")
+        with Analyzer(self.src, self.store) as analyzer:
+            analyzer.scan()
+            self.assertEqual(
+                analyzer.result(a, '<module>.<lambda>').value,
+                [Return(Const(1))])
+            self.assertEqual(
+                analyzer.result(a, '<module>.<lambda>@2').value,
+                [Return(Const(2))])
+
+    def test_sibling_tree(self):
+        sibling = self.src + '2'
+        os.mkdir(sibling)
+        c = os.path.join(sibling, 'c.py')
+        with open(c, 'w') as stream:
+            stream.write("def h():\n    return 3\n")
+        with Analyzer(sibling, self.store) as analyzer:
+            analyzer.scan()
+        with Analyzer(self.src, self.store) as analyzer:
+            self.assertEqual(analyzer.functions, {})
+            self.assertEqual(analyzer.scan().removed, [])
+        # Results of the other tree are kept
+        with Analyzer(sibling, self.store) as analyzer:
+            self.assertEqual(analyzer.scan(), ([], [], [], []))
+            analyzer.result(c, '<module>.h')
+
+    def test_stale_results_pruned(self):
+        with Analyzer(self.src, self.store) as analyzer:
+            analyzer.scan()
+            digest = analyzer.functions[
+                os.path.join(self.src, 'a.py')]['<module>.f']
+            self.write('a.py', "def f(a):\n    return a + 2\n")
+            analyzer.scan()
+            self.assertNotIn('code:' + digest, analyzer._store)
+            # Functions of unchanged files are kept
+            analyzer.result(os.path.join(self.src, 'b.py'), '<module>.g')
+
+    def test_removed(self):
+        with Analyzer(self.src, self.store) as analyzer:
+            analyzer.scan()
+            os.unlink(os.path.join(self.src, 'b.py'))
+            report = analyzer.scan()
+            self.assertEqual(report.removed, [os.path.join(self.src, 'b.py')])
+
+    def test_command_line_store(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            main(['--once', '-s', self.store, self.src])
+        finally:
+            output, sys.stdout = sys.stdout.getvalue(), stdout
+        self.assertTrue(output.startswith('changed: 2,'))
+        with Analyzer(self.src, self.store) as analyzer:
+            self.assertEqual(
+                analyzer.result(os.path.join(self.src, 'b.py'),
+                                '<module>.g').value,
+                [Return(Load('a'))])
+
+    def test_script_store(self):
+        # Results pickled by the script must not refer to __main__
+        package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=package)
+        subprocess.check_output(
+            [sys.executable, '-m', 'schnibble.incremental', '--once',
+             '-s', self.store, self.src], env=env)
+        with Analyzer(self.src, self.store) as analyzer:
+            self.assertEqual(
+                analyzer.result(os.path.join(self.src, 'a.py'),
+                                '<module>.f').value,
+                [Return(Add(Load('a'), Const(1)))])
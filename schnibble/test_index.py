@@ -0,0 +1,88 @@
+"""Unit tests for index."""
+import os
+import py_compile
+import shutil
+import tempfile
+from unittest import TestCase
+
+from schnibble.cpy27 import LOAD_FAST, LOAD_CONST, BINARY_MULTIPLY
+from schnibble.cpy27 import BINARY_ADD
+from schnibble.index import Index, op, sequence, const, local, code_terms
+
+SOURCE = """
+def scale(x):
+    return x * 3
+
+def offset(x):
+    return x + 3
+
+def square(y):
+    return y * y
+"""
+
+
+class TermTests(TestCase):
+
+    def test_code_terms(self):
+        terms = code_terms((lambda a: a * 2).__code__)
+        self.assertIn(op(LOAD_FAST), terms)
+        self.assertIn(sequence(LOAD_FAST, LOAD_CONST, BINARY_MULTIPLY), terms)
+        self.assertIn(const(2), terms)
+        self.assertIn(local('a'), terms)
+        self.assertNotIn(const(2.0), terms)
+
+
+class IndexTests(TestCase):
+
+    def setUp(self):
+        self.index = Index(':memory:')
+        self.index.add_code('a.py', compile(SOURCE, 'a.py', 'exec'))
+
+    def tearDown(self):
+        self.index.close()
+
+    def test_query(self):
+        self.assertEqual(
+            self.index.query(
+                sequence(LOAD_FAST, LOAD_CONST, BINARY_MULTIPLY)),
+            [('a.py', '<module>.scale')])
+        self.assertEqual(
+            self.index.query(op(BINARY_MULTIPLY)),
+            [('a.py', '<module>.scale'), ('a.py', '<module>.square')])
+        self.assertEqual(
+            self.index.query(const(3), op(BINARY_ADD)),
+            [('a.py', '<module>.offset')])
+        self.assertEqual(
+            self.index.query(local('y')), [('a.py', '<module>.square')])
+        self.assertEqual(self.index.query(const(3), local('y')), [])
+
+    def test_query_too_long(self):
+        self.assertRaises(
+            ValueError, self.index.query,
+            sequence(LOAD_FAST, LOAD_FAST, LOAD_FAST, LOAD_FAST))
+
+    def test_update(self):
+        self.index.add_code('a.py', compile(
+            "def scale(x):\n    return x + 3\n", 'a.py', 'exec'))
+        self.assertEqual(self.index.query(op(BINARY_MULTIPLY)), [])
+        self.assertEqual(
+            self.index.query(op(BINARY_ADD)), [('a.py', '<module>.scale')])
+        self.index.remove('a.py')
+        self.assertEqual(self.index.query(op(BINARY_ADD)), [])
+
+    def test_add_pyc(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmp, 'mod.py')
+            with open(src, 'w') as stream:
+                stream.write(SOURCE)
+            pyc = src + 'c'
+            py_compile.compile(src, pyc, doraise=True)
+            with Index(os.path.join(tmp, 'index.db')) as index:
+                self.assertTrue(index.add_pyc(pyc))
+                self.assertFalse(index.add_pyc(pyc))
+            with Index(os.path.join(tmp, 'index.db')) as index:
+                self.assertEqual(
+                    index.query(local('y')), [(pyc, '<module>.square')])
+        finally:
+            shutil.rmtree(tmp)
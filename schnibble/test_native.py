@@ -0,0 +1,151 @@
+"""Unit tests for native."""
+import platform
+import threading
+from unittest import TestCase, skipIf
+
+from schnibble.arena import CodeArena
+from schnibble.arch.x86.disasm import disassemble
+from schnibble.arch.x86.instructions import JO
+from schnibble.cpy27 import Const, Load, Store, Multiply, Add, Subtract, Neg
+from schnibble.cpy27 import Return, Dup, Call, Function
+from schnibble.native import NativeError, NativeFunction
+from schnibble.native import lower, compile_function, jit
+
+forX86_64 = skipIf(
+    platform.machine().lower() not in ('x86_64', 'amd64'),
+    "native code requires x86-64")
+
+# t = (a + b) * (a - 3); return -t + b * b
+POLY = Function(
+    ('a', 'b'), None,
+    Store('t', Multiply(Add(Load('a'), Load('b')),
+                        Subtract(Load('a'), Const(3)))),
+    Return(Add(Neg(Load('t')), Multiply(Load('b'), Dup()))))
+
+
+def poly(a, b):
+    t = (a + b) * (a - 3)
+    return -t + b * b
+
+
+class LowerTests(TestCase):
+
+    def test_prologue_and_epilogue(self):
+        code = lower(Function(('a',), None, Return(Neg(Load('a')))))
+        self.assertEqual(list(code[:4]), [0x55, 0x48, 0x89, 0xE5])
+        # mov rax, rdi; neg rax; jo overflow; xor edx, edx; pop rbp; ret;
+        # overflow: mov rsp, rbp
+        self.assertEqual(
+            list(code[4:19]),
+            [0x48, 0x89, 0xF8, 0x48, 0xF7, 0xD8, 0x70, 0x04, 0x31, 0xD2,
+             0x5D, 0xC3, 0x48, 0x89, 0xEC])
+
+    def test_unused_frame_pointer(self):
+        # Without overflow checks nothing uses RBP
+        code = lower(Function(('a',), None, Return(Load('a'))))
+        # push rbp; mov rax, rdi; xor edx, edx; pop rbp; ret
+        self.assertEqual(
+            list(code[:8]), [0x55, 0x48, 0x89, 0xF8, 0x31, 0xD2, 0x5D, 0xC3])
+
+    def test_short_overflow_jumps(self):
+        jumps = [decoded for decoded in disassemble(lower(POLY))
+                 if decoded.mnemonic == JO.mnemonic_id]
+        self.assertEqual(len(jumps), 6)
+        # jo rel8
+        self.assertEqual(set(decoded.length for decoded in jumps), {2})
+
+    def test_unsupported_node(self):
+        self.assertRaises(NativeError, lower, Function(
+            ('f',), None, Return(Call(0, Load('f')))))
+
+    def test_unsupported_constant(self):
+        self.assertRaises(NativeError, lower, Function(
+            (), None, Return(Const(1.5))))
+        self.assertRaises(NativeError, lower, Function(
+            (), None, Return(Const(1 << 63))))
+
+    def test_unbound_local(self):
+        self.assertRaises(NativeError, lower, Function(
+            (), None, Return(Load('x'))))
+
+    def test_no_return(self):
+        self.assertRaises(NativeError, lower, Function(
+            ('a',), None, Store('b', Load('a'))))
+
+    def test_too_many_arguments(self):
+        self.assertRaises(NativeError, lower, Function(
+            tuple('abcdefg'), None, Return(Load('a'))))
+
+
+@forX86_64
+class NativeFunctionTests(TestCase):
+
+    def test_poly(self):
+        fn = compile_function(POLY)
+        self.assertIsInstance(fn, NativeFunction)
+        for a, b in [(5, 7), (0, 0), (-3, 11), (1000, -1000000)]:
+            self.assertEqual(fn(a, b), poly(a, b))
+
+    def test_callee_saved_locals(self):
+        # Enough locals to need callee-saved registers
+        names = ['l{}'.format(i) for i in range(6)]
+        progn = [Store(names[0], Add(Load('a'), Const(1)))]
+        for prev, name in zip(names, names[1:]):
+            progn.append(Store(name, Add(Load(prev), Load('a'))))
+        progn.append(Return(Load(names[-1])))
+        fn = compile_function(Function(('a',), None, *progn))
+        self.assertEqual(fn(2), 13)
+
+    def test_large_constant(self):
+        fn = compile_function(Function(
+            ('a',), None, Return(Add(Load('a'), Const(1 << 40)))))
+        self.assertEqual(fn(1), (1 << 40) + 1)
+
+    def test_overflow_falls_back(self):
+        fn = compile_function(POLY)
+        big = 1 << 62
+        self.assertEqual(fn(big, big), poly(big, big))
+        fn = compile_function(Function(('a',), None, Return(Neg(Load('a')))))
+        self.assertEqual(fn(-1 << 63), 1 << 63)
+
+    def test_non_int_falls_back(self):
+        fn = compile_function(POLY)
+        self.assertEqual(fn(1.5, 2), poly(1.5, 2))
+        self.assertEqual(fn(1 << 70, 2), poly(1 << 70, 2))
+
+    def test_arena(self):
+        arena = CodeArena()
+        self.addCleanup(arena.close)
+        fn = compile_function(POLY, arena=arena)
+        compile_function(POLY, arena=arena)
+        # Identical code is shared
+        self.assertEqual(len(arena), 1)
+        self.assertEqual(fn(5, 7), poly(5, 7))
+        # Evicted code is added again
+        arena.close()
+        self.assertEqual(fn(5, 7), poly(5, 7))
+        self.assertEqual(len(arena), 1)
+
+    def test_evicted_while_called(self):
+        arena = CodeArena()
+        self.addCleanup(arena.close)
+        fn = compile_function(POLY, arena=arena)
+        results = []
+
+        def call():
+            results.extend(fn(i, 7) for i in range(2000))
+
+        threads = [threading.Thread(target=call) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            arena.close()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(
+            sorted(results), sorted([poly(i, 7) for i in range(2000)] * 2))
+
+    def test_jit_fallback(self):
+        fn = jit(Function(('a',), None, Return(Add(Load('a'), Const(0.5)))))
+        self.assertNotIsInstance(fn, NativeFunction)
+        self.assertEqual(fn(1), 1.5)
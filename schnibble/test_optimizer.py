@@ -0,0 +1,218 @@
+"""Unit tests for optimizer."""
+import types
+from unittest import TestCase
+
+from schnibble.cpy27 import Const, Load, Store, Multiply, Add, Subtract
+from schnibble.cpy27 import Return, Dup, Call, Function
+from schnibble.cpy27 import Label, JumpIfFalse, While
+from schnibble.cpy27 import Py27EmitterContext, Py27Op
+from schnibble.common import unemit
+from schnibble.optimizer import eliminate_common_subexpressions
+from schnibble.optimizer import inline_calls, hoist_loop_invariants
+
+
+def make_function(node):
+    ctx = Py27EmitterContext().emit(node)
+    code = ctx.make_code(ctx.last_builder, name="fn")
+    return types.FunctionType(code, {}, None, (), ())
+
+
+class CommonSubexpressionTests(TestCase):
+
+    def test_sibling_uses_dup(self):
+        x1 = Add(Load('x'), Const(1))
+        fn = Function(('x',), None, Return(Multiply(x1, x1)))
+        opt = eliminate_common_subexpressions(fn)
+        self.assertEqual(opt.progn, (Return(Multiply(x1, Dup())),))
+        self.assertEqual(make_function(opt)(3), 16)
+
+    def test_dup_unemit(self):
+        x1 = Add(Load('x'), Const(1))
+        fn = make_function(eliminate_common_subexpressions(
+            Function(('x',), None, Return(Multiply(x1, x1)))))
+        ctx = unemit(fn.__code__, Py27Op)
+        self.assertEqual(ctx.retval, Return(Multiply(x1, x1)))
+
+    def test_synthesized_local(self):
+        x1 = Add(Load('x'), Const(1))
+        fn = Function(('x',), None, Return(
+            Subtract(Multiply(x1, Const(2)), x1)))
+        opt = eliminate_common_subexpressions(fn)
+        self.assertEqual(opt.progn, (
+            Store('.cse0', x1),
+            Return(Subtract(Multiply(Load('.cse0'), Const(2)),
+                            Load('.cse0')))))
+        self.assertEqual(make_function(opt)(3), 4)
+
+    def test_nested_repeats(self):
+        x1 = Add(Load('x'), Const(1))
+        x2 = Multiply(x1, Const(2))
+        fn = Function(('x',), None, Return(
+            Add(Subtract(x2, x1), Subtract(x2, Const(1)))))
+        opt = eliminate_common_subexpressions(fn)
+        self.assertEqual(opt.progn, (
+            Store('.cse1', x1),
+            Store('.cse0', Multiply(Load('.cse1'), Const(2))),
+            Return(Add(Subtract(Load('.cse0'), Load('.cse1')),
+                       Subtract(Load('.cse0'), Const(1))))))
+        self.assertEqual(make_function(opt)(3), 11)
+
+    def test_constants_of_different_type(self):
+        fn = Function(('x',), None, Return(Subtract(
+            Multiply(Add(Load('x'), Const(1)), Const(2)),
+            Add(Load('x'), Const(1.0)))))
+        self.assertEqual(eliminate_common_subexpressions(fn).progn, fn.progn)
+
+    def test_no_repeats(self):
+        fn = Function(('a', 'b'), None, Return(Add(Load('a'), Load('b'))))
+        self.assertEqual(eliminate_common_subexpressions(fn).progn, fn.progn)
+
+    def test_deep_expression(self):
+        deep = Load('x')
+        for i in range(300):
+            deep = Add(deep, Const(i))
+        fn = Function(('x',), None, Return(
+            Subtract(Multiply(deep, Const(2)), deep)))
+        opt = eliminate_common_subexpressions(fn)
+        # Comparing deep trees with == would exceed the recursion limit
+        store, ret = opt.progn
+        self.assertEqual(store.arg, '.cse0')
+        self.assertEqual(ret, Return(Subtract(
+            Multiply(Load('.cse0'), Const(2)), Load('.cse0'))))
+        self.assertEqual(make_function(opt)(1), 1 + sum(range(300)))
+
+
+class InlineTests(TestCase):
+
+    sq = Function(('v',), None, Return(Multiply(Load('v'), Load('v'))))
+
+    def test_inline_leaf(self):
+        fn = Function(('x', 'sq'), None, Return(Add(
+            Call(1, Load('sq'), Add(Load('x'), Const(1))), Const(1))))
+        opt = inline_calls(fn, {'sq': self.sq})
+        self.assertEqual(opt.progn, (
+            Store('.inl0.v', Add(Load('x'), Const(1))),
+            Return(Add(Multiply(Load('.inl0.v'), Load('.inl0.v')),
+                       Const(1)))))
+        self.assertEqual(make_function(opt)(3, None), 17)
+        self.assertEqual(make_function(fn)(3, lambda v: v * v), 17)
+
+    def test_trivial_args_substituted(self):
+        fn = Function(('x', 'sq'), None, Return(Add(
+            Call(1, Load('sq'), Load('x')), Call(1, Load('sq'), Const(2)))))
+        opt = inline_calls(fn, {'sq': self.sq})
+        self.assertEqual(opt.progn, (
+            Return(Add(Multiply(Load('x'), Load('x')),
+                       Multiply(Const(2), Const(2)))),))
+        self.assertEqual(make_function(opt)(3, None), 13)
+
+    def test_helper_locals_renamed(self):
+        helper = Function(('v',), None,
+                          Store('x', Add(Load('v'), Const(1))),
+                          Return(Multiply(Load('x'), Load('v'))))
+        fn = Function(('x', 'f'), None,
+                      Return(Add(Call(1, Load('f'), Load('x')), Load('x'))))
+        opt = inline_calls(fn, {'f': helper})
+        self.assertEqual(opt.progn, (
+            Store('.inl0.x', Add(Load('x'), Const(1))),
+            Return(Add(Multiply(Load('.inl0.x'), Load('x')), Load('x')))))
+        self.assertEqual(make_function(opt)(3, None), 15)
+
+    def test_budget(self):
+        fn = Function(('x', 'sq'), None,
+                      Return(Call(1, Load('sq'), Load('x'))))
+        self.assertEqual(inline_calls(fn, {'sq': self.sq}, 3).progn, fn.progn)
+        self.assertNotEqual(
+            inline_calls(fn, {'sq': self.sq}, 4).progn, fn.progn)
+
+    def test_non_leaf_not_inlined(self):
+        helper = Function(('v',), None,
+                          Return(Call(1, Load('g'), Load('v'))))
+        fn = Function(('x', 'f'), None,
+                      Return(Call(1, Load('f'), Load('x'))))
+        self.assertEqual(inline_calls(fn, {'f': helper}).progn, fn.progn)
+
+    def test_rebound_helper_not_inlined(self):
+        fn = Function(('x', 'sq'), None,
+                      Store('sq', Load('x')),
+                      Return(Call(1, Load('sq'), Load('x'))))
+        self.assertEqual(inline_calls(fn, {'sq': self.sq}).progn, fn.progn)
+
+
+class LoopInvariantTests(TestCase):
+
+    def sum_loop(self, step):
+        # s = 0; while n: s = s + n * step; n = n - 1; return s
+        return Function(
+            ('n', 'k'), None,
+            Store('s', Const(0)),
+            While(Load('n'),
+                  Store('s', Add(Load('s'), Multiply(Load('n'), step))),
+                  Store('n', Subtract(Load('n'), Const(1)))),
+            Return(Load('s')))
+
+    def test_hoist(self):
+        step = Multiply(Load('k'), Const(2))
+        fn = self.sum_loop(step)
+        opt = hoist_loop_invariants(fn)
+        skip = opt.progn[-2]
+        self.assertEqual(opt.progn, (
+            Store('s', Const(0)),
+            JumpIfFalse(skip, Load('n')),
+            Store('.licm0', step),
+            While(Load('n'),
+                  Store('s', Add(Load('s'),
+                                 Multiply(Load('n'), Load('.licm0')))),
+                  Store('n', Subtract(Load('n'), Const(1)))),
+            skip,
+            Return(Load('s'))))
+        self.assertEqual(make_function(opt)(4, 3), 60)
+        self.assertEqual(make_function(fn)(4, 3), 60)
+
+    def test_zero_iterations(self):
+        opt = hoist_loop_invariants(
+            self.sum_loop(Multiply(Load('k'), Const(2))))
+        # k * 2 would raise TypeError if it was computed
+        self.assertEqual(make_function(opt)(0, None), 0)
+
+    def test_variant_not_hoisted(self):
+        fn = self.sum_loop(Add(Load('n'), Const(1)))
+        self.assertEqual(hoist_loop_invariants(fn).progn, fn.progn)
+
+    def test_nested_loops(self):
+        # while i: j = n; while j: s = s + k * 2; j = j - 1; i = i - 1
+        fn = Function(
+            ('i', 'n', 'k'), None,
+            Store('s', Const(0)),
+            While(Load('i'),
+                  Store('j', Load('n')),
+                  While(Load('j'),
+                        Store('s', Add(Load('s'),
+                                       Multiply(Load('k'), Const(2)))),
+                        Store('j', Subtract(Load('j'), Const(1)))),
+                  Store('i', Subtract(Load('i'), Const(1)))),
+            Return(Load('s')))
+        opt = hoist_loop_invariants(fn)
+        # k * 2 is computed before the inner loop, when it runs
+        outer = opt.progn[1]
+        self.assertEqual(outer.body[2], Store('.licm0', Multiply(
+            Load('k'), Const(2))))
+        self.assertEqual(make_function(opt)(2, 3, 5), 60)
+        self.assertEqual(make_function(opt)(2, 0, None), 0)
+
+    def test_guarded(self):
+        # while n: if flag: s = s + k * 2; n = n - 1
+        done = Label('done')
+        fn = Function(
+            ('n', 'k', 'flag'), None,
+            Store('s', Const(0)),
+            While(Load('n'),
+                  JumpIfFalse(done, Load('flag')),
+                  Store('s', Add(Load('s'), Multiply(Load('k'), Const(2)))),
+                  done,
+                  Store('n', Subtract(Load('n'), Const(1)))),
+            Return(Load('s')))
+        opt = hoist_loop_invariants(fn)
+        self.assertEqual(opt.progn, fn.progn)
+        self.assertEqual(make_function(opt)(3, None, 0), 0)
+        self.assertEqual(make_function(opt)(3, 5, 1), 30)
@@ -0,0 +1,66 @@
+"""Unit tests for stats."""
+from unittest import TestCase, skipIf
+
+from schnibble import stats
+from schnibble.cpy27 import Const, Load, Store, Multiply, Add, Neg
+from schnibble.cpy27 import Return, Function, Label, JumpIfFalse
+from schnibble.cpy27 import Py27EmitterContext
+
+
+def builders():
+    else_ = Label()
+    ctx = Py27EmitterContext().emit(
+        Function(('a',), None, Return(Add(Load('a'), Const(1)))),
+        Function(('a', 'b'), None,
+                 Store('c', Multiply(Load('a'), Neg(Load('b')))),
+                 Return(Add(Load('c'), Add(Load('a'), Const(2))))),
+        Function(('a',), None,
+                 JumpIfFalse(else_, Load('a')), Return(Const(1)),
+                 else_, Return(Const(2))))
+    return ctx._complete
+
+
+class StatsTests(object):
+
+    def test_fast_stack_usage(self):
+        for builder in builders():
+            self.assertEqual(
+                stats.fast_stack_usage(builder), builder.stack_usage())
+        ctx = Py27EmitterContext().emit_fragment(Add(), Neg())
+        self.assertEqual(
+            stats.fast_stack_usage(ctx.last_builder), (-2, -1, 0))
+
+    def test_opcode_histogram(self):
+        counts = stats.opcode_histogram(builders()[1])
+        self.assertEqual(len(counts), 256)
+        self.assertEqual(counts[124], 4)  # LOAD_FAST
+        self.assertEqual(counts[23], 2)  # BINARY_ADD
+        self.assertEqual(sum(counts), 11)
+
+    def test_profile(self):
+        profile = stats.profile(builders())
+        self.assertEqual(profile.opcode_counts[83], 4)  # RETURN_VALUE
+        self.assertEqual(sum(profile.opcode_counts), 21)
+        self.assertEqual(list(profile.const_pool_sizes), [2, 2, 3])
+        self.assertEqual(list(profile.final_sizes), [0, 0, 0])
+        self.assertEqual(list(profile.max_sizes), [2, 3, 1])
+
+    def test_profile_empty(self):
+        profile = stats.profile([])
+        self.assertEqual(sum(profile.opcode_counts), 0)
+        self.assertEqual(list(profile.max_sizes), [])
+
+
+@skipIf(stats.numpy is None, "NumPy is not available")
+class NumPyStatsTests(StatsTests, TestCase):
+    pass
+
+
+class PurePythonStatsTests(StatsTests, TestCase):
+
+    def setUp(self):
+        self.numpy = stats.numpy
+        stats.numpy = None
+
+    def tearDown(self):
+        stats.numpy = self.numpy
@@ -0,0 +1,85 @@
+"""Unit tests for trace."""
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from schnibble import trace
+from schnibble.arch.x86.assembler import assemble
+from schnibble.arch.x86.instructions import MOV, RET
+from schnibble.arch.x86.operands import imm32
+from schnibble.arch.x86.registers import EAX
+from schnibble.binfmt import elf
+from schnibble.common import unemit
+from schnibble.cpy27 import Add, Load, Return, Function, LOAD_FAST
+from schnibble.cpy27 import Py27EmitterContext, Py27Op
+
+
+class TraceTests(TestCase):
+
+    def setUp(self):
+        self.events = []
+        trace.subscribe(self.record)
+
+    def tearDown(self):
+        if self.record in trace._subscribers:
+            trace.unsubscribe(self.record)
+
+    def record(self, event, phase, info):
+        self.events.append((event, phase, info))
+
+    def test_enabled(self):
+        self.assertTrue(trace.enabled)
+        trace.unsubscribe(self.record)
+        self.assertFalse(trace.enabled)
+        Py27EmitterContext().emit(Function((), None))
+        self.assertEqual(self.events, [])
+
+    def test_emit(self):
+        Py27EmitterContext().emit(
+            Function(('a',), None, Return(Add(Load('a'), Load('a')))))
+        (begin, end) = self.events
+        self.assertEqual(begin, ('emit', 'begin', {'nodes': 1}))
+        self.assertEqual(end[:2], ('emit', 'end'))
+        self.assertEqual(end[2]['size'], 8)
+        self.assertEqual(end[2]['completed'], 1)
+        self.assertGreaterEqual(end[2]['elapsed'], 0)
+
+    def test_simulate(self):
+        unemit((lambda a: a).__code__, Py27Op)
+        self.assertEqual(
+            [(event, phase, info['op']) for event, phase, info in self.events],
+            [('simulate', 'begin', LOAD_FAST), ('simulate', 'end', LOAD_FAST),
+             ('simulate', 'begin', Py27Op.by_op_code(83)),
+             ('simulate', 'end', Py27Op.by_op_code(83))])
+        self.assertEqual(self.events[1][2]['stack'], 1)
+
+    def test_x86_emit(self):
+        buf = bytearray()
+        MOV.emit(buf, EAX, imm32(42))
+        RET.emit(buf)
+        self.assertEqual(
+            [(event, phase, info['instruction'], info.get('size'))
+             for event, phase, info in self.events],
+            [('x86.emit', 'begin', MOV, None), ('x86.emit', 'end', MOV, 5),
+             ('x86.emit', 'begin', RET, None), ('x86.emit', 'end', RET, 1)])
+
+    def test_x86_assemble(self):
+        assemble([(MOV, EAX, imm32(42)), (RET,)])
+        self.assertEqual(
+            [(event, phase, info['instructions'], info.get('size'))
+             for event, phase, info in self.events],
+            [('x86.assemble', 'begin', 2, None),
+             ('x86.assemble', 'end', 2, 6)])
+
+    def test_elf_build(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmp, 'a.out'), 'wb') as stream:
+                builder = elf.Builder(stream, elf.X86StaticExec)
+                builder.add_program_header()
+                self.assertEqual(builder.build(), 0x34 + 0x20)
+        finally:
+            shutil.rmtree(tmp)
+        self.assertEqual(self.events[-1][:2], ('elf.build', 'end'))
+        self.assertEqual(self.events[-1][2]['size'], 0x34 + 0x20)
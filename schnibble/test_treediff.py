@@ -0,0 +1,76 @@
+"""Unit tests for treediff."""
+from unittest import TestCase
+
+from schnibble.cpy27 import Const, Load, Store, Multiply, Add, Subtract
+from schnibble.cpy27 import Return, Py27Op
+from schnibble.common import unemit
+from schnibble.treediff import Edit, diff, hash_tree
+
+
+class HashTests(TestCase):
+
+    def test_identical_trees(self):
+        a = Return(Add(Load('a'), Const(1)))
+        b = Return(Add(Load('a'), Const(1)))
+        self.assertEqual(hash_tree(a).digest, hash_tree(b).digest)
+
+    def test_constant_types(self):
+        self.assertNotEqual(
+            hash_tree(Const(1)).digest, hash_tree(Const(1.0)).digest)
+
+    def test_children_order(self):
+        self.assertNotEqual(
+            hash_tree(Add(Load('a'), Load('b'))).digest,
+            hash_tree(Add(Load('b'), Load('a'))).digest)
+
+
+class DiffTests(TestCase):
+
+    old = [
+        Store("x", Const(9)),
+        Store("y", Subtract(Load("x"), Const(5))),
+        Return(Multiply(Load('z'), Load('y'))),
+    ]
+
+    def test_same(self):
+        self.assertEqual(diff(self.old, list(self.old)), [])
+
+    def test_update(self):
+        new = list(self.old)
+        new[1] = Store("y", Subtract(Load("x"), Const(6)))
+        self.assertEqual(diff(self.old, new), [
+            Edit('update', (1, 0, 1), 5, 6)])
+
+    def test_replace(self):
+        new = list(self.old)
+        new[2] = Return(Add(Load('z'), Load('y')))
+        self.assertEqual(diff(self.old, new), [
+            Edit('replace', (2, 0), self.old[2].children[0],
+                 new[2].children[0])])
+
+    def test_insert(self):
+        stmt = Store("w", Const(1))
+        new = self.old[:1] + [stmt] + self.old[1:]
+        self.assertEqual(diff(self.old, new), [Edit('insert', (1,), None, stmt)])
+
+    def test_delete(self):
+        new = self.old[:1] + self.old[2:]
+        self.assertEqual(
+            diff(self.old, new), [Edit('delete', (1,), self.old[1], None)])
+
+    def test_unemit(self):
+        def old(z):
+            x = 3 + 6
+            y = x - 5
+            return z * y
+
+        def new(z):
+            x = 3 + 6
+            y = x - 5
+            w = y + z
+            return z * w
+        self.assertEqual(
+            diff(unemit(old.__code__, Py27Op).ops,
+                 unemit(new.__code__, Py27Op).ops),
+            [Edit('insert', (2,), None, Store('w', Add(Load('y'), Load('z')))),
+             Edit('update', (2, 0, 1), 'y', 'w')])
@@ -0,0 +1,96 @@
+"""
+Instrumentation hooks for profilers and tracing backends.
+
+Subscribers are called with ``(event, phase, info)`` where ``event`` names
+the traced operation, ``phase`` is either ``'begin'`` or ``'end'`` and
+``info`` is a dictionary with details of the event. The ``'end'`` phase
+always carries the ``elapsed`` time, in seconds. The following events are
+reported:
+
+``'emit'``
+    :meth:`schnibble.common.BaseEmitterContext.emit()`. ``nodes`` is the
+    number of nodes, ``size`` is the number of bytes added to the current
+    builder and ``completed`` is the number of builders completed.
+``'simulate'``
+    Simulation of one operation by :func:`schnibble.common.unemit()` and
+    :func:`schnibble.common.iter_unemit()`. ``op`` is the operation class,
+    ``stack`` is the depth of the simulated stack after the operation.
+``'elf.build'``
+    :meth:`schnibble.binfmt.elf.Builder.build()`. ``size`` is the number of
+    bytes written.
+``'x86.emit'``
+    ``emit()`` of x86 instructions. ``instruction`` is the instruction class
+    and ``size`` is the number of bytes emitted.
+``'x86.assemble'``
+    :meth:`schnibble.arch.x86.assembler.Assembler.assemble()`.
+    ``instructions`` is the number of instructions and ``size`` is the
+    number of bytes written.
+
+Code on hot paths checks :data:`enabled` before doing anything else so
+tracing costs a single flag check when nobody is subscribed.
+"""
+import timeit
+
+__all__ = ('enabled', 'subscribe', 'unsubscribe', 'begin', 'end')
+
+#: True when at least one subscriber is registered.
+enabled = False
+
+_subscribers = []
+_clock = timeit.default_timer
+
+
+def subscribe(callback):
+    """
+    Register a subscriber.
+
+    :param callback:
+        Callable invoked with ``(event, phase, info)``.
+    """
+    global enabled
+    _subscribers.append(callback)
+    enabled = True
+
+
+def unsubscribe(callback):
+    """
+    Remove a previously registered subscriber.
+
+    :raises ValueError:
+        If the callback is not subscribed.
+    """
+    global enabled
+    _subscribers.remove(callback)
+    enabled = bool(_subscribers)
+
+
+def begin(event, **info):
+    """
+    Report the beginning of an event.
+
+    :param event:
+        Name of the event.
+    :param info:
+        Details of the event.
+    :returns:
+        Token that must be passed to :func:`end()`.
+    """
+    for callback in list(_subscribers):
+        callback(event, 'begin', info)
+    return _clock()
+
+
+def end(event, token, **info):
+    """
+    Report the end of an event.
+
+    :param event:
+        Name of the event.
+    :param token:
+        Value returned by :func:`begin()`.
+    :param info:
+        Details of the event.
+    """
+    info['elapsed'] = _clock() - token
+    for callback in list(_subscribers):
+        callback(event, 'end', info)
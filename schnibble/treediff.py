@@ -0,0 +1,242 @@
+"""Structural diff between trees of operation nodes."""
+import collections
+import hashlib
+
+from schnibble.cpy27 import OperationNode
+
+#: A single step of an edit script.
+#:
+#: ``kind`` is one of ``'insert'``, ``'delete'``, ``'replace'`` or
+#: ``'update'``. ``path`` is a tuple of indices, the first one selects
+#: a statement and the remaining ones select children. Paths of insertions
+#: refer to the new tree, all the other paths refer to the old tree.
+#: ``'update'`` changes only the argument of a node, ``old`` and ``new`` are
+#: then the old and new arguments, otherwise they are the affected nodes.
+Edit = collections.namedtuple("Edit", "kind path old new")
+
+
+class HashedNode(object):
+    """Node tree annotated with content hashes of each subtree."""
+
+    __slots__ = ('node', 'digest', 'children')
+
+    def __init__(self, node, digest, children):
+        """
+        Initialize a hashed node.
+
+        :param node:
+            The original node.
+        :param digest:
+            Content hash (bytes) of the whole subtree rooted at ``node``.
+        :param children:
+            Tuple of :class:`HashedNode` for each child of ``node``.
+        """
+        self.node = node
+        self.digest = digest
+        self.children = children
+
+    def __repr__(self):
+        """Compute the representation of a HashedNode."""
+        return "<HashedNode {} {!r}>".format(
+            hashlib.sha1(self.digest).hexdigest()[:8], self.node)
+
+
+def hash_tree(node, memo=None):
+    """
+    Compute content hashes of a node and all of its descendants.
+
+    :param node:
+        Root of the tree.
+    :param memo:
+        Optional dictionary used to reuse results for nodes shared between
+        trees (keys are ``id()`` of nodes). The caller must keep the nodes
+        alive for as long as the dictionary is used.
+    :returns:
+        A :class:`HashedNode`.
+
+    The digest covers the type of each node, the type and value of its
+    argument and, recursively, the digests of its children. Identical
+    subtrees therefore have identical digests.
+    """
+    if memo is None:
+        memo = {}
+    try:
+        return memo[id(node)]
+    except KeyError:
+        pass
+    if isinstance(node, OperationNode):
+        children = tuple(hash_tree(child, memo) for child in node.children)
+        h = hashlib.sha1(type(node).__name__)
+        if node.op.has_arg:
+            h.update(b'\0')
+            h.update(type(node.arg).__name__)
+            h.update(b'\0')
+            h.update(repr(node.arg))
+        for child in children:
+            h.update(b'\1')
+            h.update(child.digest)
+        digest = h.digest()
+    else:
+        # Opaque nodes (labels, nested functions) are only equal to themselves
+        children = ()
+        digest = hashlib.sha1(
+            '{}@{}'.format(type(node).__name__, id(node))).digest()
+    hashed = memo[id(node)] = HashedNode(node, digest, children)
+    return hashed
+
+
+def _shortest_edit(a, b):
+    """
+    Compute the shortest insert/delete script turning ``a`` into ``b``.
+
+    :returns:
+        List of ``('equal' | 'delete' | 'insert', i, j)`` tuples where ``i``
+        and ``j`` are positions in ``a`` and ``b`` respectively.
+
+    This is the O(ND) algorithm by Eugene W. Myers, so its cost grows with
+    the number of differences rather than the size of the inputs.
+    """
+    n, m = len(a), len(b)
+    v = {1: 0}
+    trace = []
+    for d in range(n + m + 1):
+        trace.append(dict(v))
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x, y = x + 1, y + 1
+            v[k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m)
+    raise AssertionError("unreachable")
+
+
+def _backtrack(trace, x, y):
+    """Recover the edit script of :func:`_shortest_edit()` from its trace."""
+    script = []
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x, y = x - 1, y - 1
+            script.append(('equal', x, y))
+        if d > 0:
+            if x == prev_x:
+                script.append(('insert', x, prev_y))
+            else:
+                script.append(('delete', prev_x, y))
+        x, y = prev_x, prev_y
+    script.reverse()
+    return script
+
+
+def _diff_nodes(old, new, path, edits):
+    """Diff two hashed nodes known to be different."""
+    a, b = old.node, new.node
+    if (type(a) is not type(b) or not isinstance(a, OperationNode)
+            or len(old.children) != len(new.children)):
+        edits.append(Edit('replace', path, a, b))
+        return
+    if a.op.has_arg and (
+            (type(a.arg), repr(a.arg)) != (type(b.arg), repr(b.arg))):
+        edits.append(Edit('update', path, a.arg, b.arg))
+    for i, (old_child, new_child) in enumerate(
+            zip(old.children, new.children)):
+        if old_child.digest != new_child.digest:
+            _diff_nodes(old_child, new_child, path + (i,), edits)
+
+
+def diff_hashed(old, new):
+    """
+    Compute an edit script between two sequences of hashed statements.
+
+    :param old:
+        Sequence of :class:`HashedNode` of the old version.
+    :param new:
+        Sequence of :class:`HashedNode` of the new version.
+    :returns:
+        List of :class:`Edit` tuples.
+    """
+    old_digests = [hashed.digest for hashed in old]
+    new_digests = [hashed.digest for hashed in new]
+    # Trim the common prefix and suffix, in practice most of the function
+    start = 0
+    end = 0
+    limit = min(len(old), len(new))
+    while start < limit and old_digests[start] == new_digests[start]:
+        start += 1
+    while (end < limit - start
+           and old_digests[-1 - end] == new_digests[-1 - end]):
+        end += 1
+    script = _shortest_edit(
+        old_digests[start:len(old) - end], new_digests[start:len(new) - end])
+    edits = []
+    deleted = []
+    inserted = []
+
+    def flush():
+        # Pair deletions with insertions of statements of the same type and
+        # describe them as modifications of the statement.
+        pairs = {}
+        pos = 0
+        for i in deleted:
+            for k in range(pos, len(inserted)):
+                j = inserted[k]
+                if type(old[i].node) is type(new[j].node):
+                    pairs[j] = i
+                    pos = k + 1
+                    break
+        paired = set(pairs.values())
+        for i in deleted:
+            if i not in paired:
+                edits.append(Edit('delete', (i,), old[i].node, None))
+        for j in inserted:
+            if j in pairs:
+                _diff_nodes(old[pairs[j]], new[j], (pairs[j],), edits)
+            else:
+                edits.append(Edit('insert', (j,), None, new[j].node))
+        del deleted[:]
+        del inserted[:]
+
+    for kind, i, j in script:
+        if kind == 'equal':
+            flush()
+        elif kind == 'delete':
+            deleted.append(start + i)
+        else:
+            inserted.append(start + j)
+    flush()
+    return edits
+
+
+def diff(old, new):
+    """
+    Compute an edit script between two versions of a function.
+
+    :param old:
+        List of top-level statements of the old version, as found in
+        ``ops`` of the context returned by :func:`schnibble.common.unemit()`.
+    :param new:
+        List of top-level statements of the new version.
+    :returns:
+        List of :class:`Edit` tuples. An empty list means that both versions
+        are structurally identical.
+
+    Each subtree is hashed once, identical subtrees are then skipped with
+    a single comparison of their digests and only the differing regions are
+    walked. Statements are aligned with a shortest edit script.
+    """
+    memo = {}
+    return diff_hashed(
+        [hash_tree(node, memo) for node in old],
+        [hash_tree(node, memo) for node in new])